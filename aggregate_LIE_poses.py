@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+"""
+Combines the LIE ΔG of the docking poses of every ligand.
+
+The pose scripts report ΔG per pose; choosing a pose by its error against
+experiment is not possible for new ligands. For every ligand of the
+manifest this script computes, from the ΔG of its poses (pooled over
+replicas, as in analyze_LIE_pose_replica.py):
+
+    dG_boltzmann   -RT ln Σ exp(-ΔG_pose / RT), the exponentially weighted
+                   multi-pose ΔG
+    dG_min         ΔG of the best (lowest ΔG) pose
+    probability    Boltzmann probability of every pose
+
+for all ligands at once (see lie_engine.aggregate_poses). Errors are
+propagated from the pose errors or, with --bootstrap, taken from a block
+bootstrap of every pose aggregated resample by resample, which also gives
+the fraction of resamples in which each pose is the best one.
+
+Ligand and complex directories hold pose folders with replica folders
+(ligand/pose1/1/*.log) as in analysis-by-R-P; a directory without pose
+folders is a single pose. Usage:
+
+    python aggregate_LIE_poses.py --manifest results/poses_manifest.csv --alpha 0.68 --beta 0.11 --bootstrap 1000
+"""
+
+import argparse
+import csv
+
+import numpy as np
+
+import analyze_LIE_noqgui as lie
+import energy_store
+import lie_engine
+import mdlog_energies as mdle
+
+AGGREGATE_COLUMNS = ('ligand_name', 'n_poses', 'alpha', 'beta', 'gamma', 'temperature',
+                     'dG_boltzmann', 'dG_boltzmann_stderr', 'dG_min', 'dG_min_stderr', 'best_pose', 'dG_exp')
+POSE_COLUMNS = ('ligand_name', 'pose', 'dG_calc', 'stderr', 'probability')
+
+
+def load_pose_energies(entries, energy_source="log", workers=None, store_dir=None, equilibrate=False):
+    """
+    Energies of every replica of every pose of the manifest entries, from the
+    logs (read in parallel) or from an energy store. Segments of a replica
+    are joined. Returns a dict mapping (ligand, pose) to a dict with the
+    'ligand' and 'complex' lists of per-replica energy arrays.
+    """
+    ids = [entry['id'] for entry in entries]
+    if store_dir:
+        store = energy_store.open_store(store_dir)
+        runs = [run for run in store['runs'] if run['ligand'] in ids]
+        parsed = [energy_store.run_energies(store, run) for run in runs]
+    else:
+        runs = []
+        for entry in entries:
+            ligand_runs = energy_store.discover_runs(entry['id'], entry['ligand_dir'], entry['complex_dir'])
+            if not ligand_runs:
+                print(f"{entry['id']}: no .log files found, skipped.")
+            runs.extend(ligand_runs)
+        paths = [run['path'] for run in runs]
+        if energy_source == "en":
+            paths = mdle.to_energy_files(paths)
+        parsed = mdle.read_q_energies_parallel(paths, workers=workers)
+
+    replicas = {}
+    for run, (steps, energies) in sorted(zip(runs, parsed), key=lambda item: (ids.index(item[0]['ligand']),
+                                                                                item[0]['pose'], item[0]['replica'],
+                                                                                item[0]['segment'])):
+        key = (run['ligand'], run['pose'], run['system'], run['replica'])
+        replicas.setdefault(key, []).append((steps, energies))
+
+    keys = list(replicas)
+    joined = [(np.concatenate([steps for steps, energies in segments]),
+               np.concatenate([energies for steps, energies in segments])) for segments in replicas.values()]
+    energies, cuts = lie.trim_energies(joined, equilibrate)
+
+    poses = {}
+    for (ligand, pose, system, replica), ene in zip(keys, energies):
+        poses.setdefault((ligand, pose), {'ligand': [], 'complex': []})[system].append(ene)
+    return {key: systems for key, systems in poses.items() if systems['ligand'] and systems['complex']}
+
+
+def pose_terms(poses, ligands, pose_numbers, error_method="blocks"):
+    """
+    Mean terms and errors of every pose pooled over its replicas, shaped
+    (system, ligand, pose, term); poses a ligand does not have are NaN.
+    """
+    shape = (2, len(ligands), len(pose_numbers), len(lie_engine.TERMS))
+    ave, stderr = np.full(shape, np.nan), np.full(shape, np.nan)
+    for (ligand, pose), systems in poses.items():
+        k, i = ligands.index(ligand), pose_numbers.index(pose)
+        for system, name in enumerate(('ligand', 'complex')):
+            qene, q_ave, q_stderr = mdle.q_energy_statistics(systems[name], error_method)
+            ave[system, k, i] = lie_engine.terms_from_qterms(q_ave)
+            stderr[system, k, i] = lie_engine.terms_from_qterms(q_stderr)
+    return ave, stderr
+
+
+def bootstrap_samples(poses, ligands, pose_numbers, alpha, beta, gamma, n_boot, seed=None):
+    """
+    Block bootstrap ΔG resamples of every pose, shaped (ligand, pose,
+    resample). Every pose is resampled with its own random stream, so the
+    poses are independent.
+    """
+    samples = np.full((len(ligands), len(pose_numbers), n_boot), np.nan)
+    streams = np.random.SeedSequence(seed).spawn(len(poses))
+    for stream, ((ligand, pose), systems) in zip(streams, poses.items()):
+        boot = lie_engine.bootstrap_dg(lie.run_terms(systems['ligand']), lie.run_terms(systems['complex']),
+                                       alpha, beta, gamma, n_boot, seed=stream)
+        samples[ligands.index(ligand), pose_numbers.index(pose)] = boot['dg']
+    return samples
+
+
+def main(args):
+    entries = lie.read_manifest(args.manifest)
+    poses = load_pose_energies(entries, args.energy_source, args.workers, args.store, args.equilibrate)
+    if not poses:
+        print("No poses with ligand and complex .log files found.")
+        return
+
+    ligands = [entry['id'] for entry in entries if any(key[0] == entry['id'] for key in poses)]
+    pose_numbers = sorted({pose for ligand, pose in poses})
+    dg_exp = {entry['id']: entry['dg_exp'] if entry['reference'] else '' for entry in entries}
+
+    ave, stderr = pose_terms(poses, ligands, pose_numbers, args.error_method)
+    dg, dg_stderr = lie_engine.compute_dg(ave[0], stderr[0], ave[1], stderr[1], args.alpha, args.beta, args.gamma)
+    aggregate = lie_engine.aggregate_poses(dg, dg_stderr, args.temperature, axis=1)
+
+    aggregate_columns = list(AGGREGATE_COLUMNS)
+    pose_columns = list(POSE_COLUMNS)
+    if args.bootstrap:
+        samples = bootstrap_samples(poses, ligands, pose_numbers, args.alpha, args.beta, args.gamma,
+                                    args.bootstrap, args.seed)
+        boot = lie_engine.bootstrap_poses(samples, args.temperature, args.ci)
+        #As in the pose scripts, the bootstrap std replaces the propagated errors
+        aggregate['dg_boltzmann_stderr'] = boot['dg_boltzmann_std']
+        aggregate['dg_min_stderr'] = boot['dg_min_std']
+        aggregate_columns += ['dG_boltzmann_ci_low', 'dG_boltzmann_ci_high', 'dG_min_ci_low', 'dG_min_ci_high']
+        pose_columns += ['probability_std', 'p_best']
+
+    with open(args.output, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(aggregate_columns)
+        for k, ligand in enumerate(ligands):
+            best = aggregate['best_pose'][k]
+            row = [ligand, int(np.sum(~np.isnan(dg[k]))), args.alpha, args.beta, args.gamma, args.temperature,
+                   round(aggregate['dg_boltzmann'][k], 2), round(aggregate['dg_boltzmann_stderr'][k], 2),
+                   round(aggregate['dg_min'][k], 2), round(aggregate['dg_min_stderr'][k], 2),
+                   pose_numbers[best], dg_exp[ligand]]
+            if args.bootstrap:
+                row += [round(boot[name][k], 2) for name in ('dg_boltzmann_ci_low', 'dg_boltzmann_ci_high',
+                                                             'dg_min_ci_low', 'dg_min_ci_high')]
+            writer.writerow(row)
+            print(f"{ligand}: ΔG Boltzmann = {row[6]:.2f} ± {row[7]:.2f}, "
+                  f"ΔG min = {row[8]:.2f} ± {row[9]:.2f} kcal/mol (pose {row[10]}, "
+                  f"p = {aggregate['probability'][k, best]:.2f})")
+
+    with open(args.poses_output, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(pose_columns)
+        for k, ligand in enumerate(ligands):
+            for i, pose in enumerate(pose_numbers):
+                if np.isnan(dg[k, i]):
+                    continue
+                row = [ligand, pose, round(dg[k, i], 2), round(dg_stderr[k, i], 2),
+                       round(aggregate['probability'][k, i], 4)]
+                if args.bootstrap:
+                    row[3] = round(np.nanstd(samples[k, i]), 2)
+                    row += [round(boot['probability_std'][k, i], 4), round(boot['p_best'][k, i], 4)]
+                writer.writerow(row)
+
+    print(f"Aggregated ΔG of {len(ligands)} ligands saved to {args.output}, "
+          f"pose probabilities to {args.poses_output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Boltzmann-weighted and best-pose LIE ΔG over docking poses")
+    parser.add_argument("--manifest", required=True,
+                        help="CSV with columns id,ligand_dir,complex_dir[,dg_exp] (as for analyze_LIE_noqgui.py)")
+    parser.add_argument("--store", default=None, help="Read energies from a store built with energy_store.py")
+    parser.add_argument("--energy_source", choices=["log", "en"], default="log",
+                        help="Read energies from the .log files or from the binary Qdyn .en files")
+    parser.add_argument("--error_method", choices=sorted(mdle.ERROR_METHODS), default="blocks",
+                        help="Standard error estimator of the mean energies")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Worker processes to read logs (default: CPUs allocated by SLURM)")
+    parser.add_argument("--equilibrate", action="store_true",
+                        help="Discard the equilibration region of every replica before averaging")
+    parser.add_argument("--alpha", type=float, default=0.18, help="Alpha parameter")
+    parser.add_argument("--beta", type=float, default=0.50, help="Beta parameter")
+    parser.add_argument("--gamma", type=float, default=0.00, help="Gamma parameter")
+    parser.add_argument("--temperature", type=float, default=lie_engine.TEMPERATURE,
+                        help="Temperature (K) of the Boltzmann weights")
+    parser.add_argument("--bootstrap", type=int, default=0,
+                        help="Block bootstrap resamples of every pose (e.g. 1000); errors become bootstrap "
+                             "standard deviations and CIs and best-pose frequencies are added")
+    parser.add_argument("--ci", type=float, default=95.0, help="Confidence level of the bootstrap intervals (%%)")
+    parser.add_argument("--seed", type=int, default=None, help="Bootstrap seed")
+    parser.add_argument("--output", default="LIE_poses_aggregate.csv", help="CSV with the aggregated ΔG per ligand")
+    parser.add_argument("--poses_output", default="LIE_poses_probabilities.csv",
+                        help="CSV with the ΔG and Boltzmann probability of every pose")
+
+    mdle.add_cache_arguments(parser)
+
+    args = parser.parse_args()
+    mdle.configure_cache_from_args(args)
+    main(args)
@@ -42,6 +42,7 @@ import csv
 import os
 import numpy as np
 import mdlog_energies as mdle  # Assumed to be available in your environment
+import lie_engine
 
 def get_pose_dirs(path):
     """
@@ -96,7 +97,19 @@ def get_logfiles(pose_dir, n_replicas):
     
     return logfiles
 
-def main(ligand_dir, complex_dir, alpha, beta, gamma, output_file, ligand_name, dg_exp, n_replicas, n_poses=None):
+def read_energies(logfile, equilibrate=False):
+    """
+    Energies of one log or energy file, without the equilibration region if
+    equilibrate. Returns (energies, first step kept).
+    """
+    steps, energies = mdle.read_q_energies(logfile)
+    if equilibrate:
+        blocks, cuts = mdle.trim_equilibration([(steps, energies)])
+        return blocks[0], cuts[0]
+    return energies, 0
+
+def main(ligand_dir, complex_dir, alpha, beta, gamma, output_file, ligand_name, dg_exp, n_replicas, n_poses=None,
+         energy_source="log", error_method="blocks", n_boot=0, ci=95.0, seed=None, equilibrate=False):
     """
     Main function to run the LIE analysis on all poses and replicas.
 
@@ -122,6 +135,22 @@ def main(ligand_dir, complex_dir, alpha, beta, gamma, output_file, ligand_name,
         Number of replicas to process for each pose.
     n_poses : int or None
         Number of poses to analyze (defaults to all if None).
+    energy_source : str
+        'log' to read the .log files, 'en' to read the binary .en energy file of each run.
+    error_method : str
+        Standard error estimator, 'blocks' or 'acf' (see mdlog_energies.ERROR_METHODS).
+    n_boot : int
+        Block bootstrap resamples (0 disables it). The stderr of every pose and
+        replica becomes the bootstrap standard deviation and percentile
+        confidence intervals are added; the pose summary resamples the
+        replicas of the pose together with their time series.
+    ci : float
+        Confidence level of the bootstrap intervals (%).
+    seed : int or None
+        Seed of the bootstrap.
+    equilibrate : bool
+        Discard the equilibration region of every run (mdlog_energies.trim_equilibration)
+        before averaging, and record the first step kept in the output.
     """
     ligand_poses = get_pose_dirs(ligand_dir)
     complex_poses = get_pose_dirs(complex_dir)
@@ -138,6 +167,16 @@ def main(ligand_dir, complex_dir, alpha, beta, gamma, output_file, ligand_name,
         ligand_poses = ligand_poses[:n_poses]
         complex_poses = complex_poses[:n_poses]
 
+    # Mean energies and errors shaped (pose, replica, term); missing poses stay NaN
+    shape = (len(ligand_poses), n_replicas, len(lie_engine.TERMS))
+    lig_terms, lig_errs = np.full(shape, np.nan), np.full(shape, np.nan)
+    comp_terms, comp_errs = np.full(shape, np.nan), np.full(shape, np.nan)
+    # Bootstrap std and CI of every pose and replica, and of every pose over its replicas
+    boot = np.full(shape[:2] + (3,), np.nan)
+    pose_boot = np.full((shape[0], 3), np.nan)
+    # First step kept of the ligand and complex run of every pose and replica
+    cuts = np.zeros(shape[:2] + (2,), dtype=int)
+
     for i, (lig_pose, comp_pose) in enumerate(zip(ligand_poses, complex_poses), start=1):
         ligand_logs = get_logfiles(lig_pose, n_replicas)
         complex_logs = get_logfiles(comp_pose, n_replicas)
@@ -146,31 +185,69 @@ def main(ligand_dir, complex_dir, alpha, beta, gamma, output_file, ligand_name,
             print(f"❌ Pose {i}: Insufficient .log files found, skipping.")
             continue
 
+        if energy_source == "en":
+            ligand_logs = mdle.to_energy_files(ligand_logs)
+            complex_logs = mdle.to_energy_files(complex_logs)
+
+        for r in range(n_replicas):
+            lig_energies, cuts[i - 1, r, 0] = read_energies(ligand_logs[r], equilibrate)
+            comp_energies, cuts[i - 1, r, 1] = read_energies(complex_logs[r], equilibrate)
+            lig_qene, lig_ave, lig_stderr = mdle.q_energy_statistics([lig_energies], error_method)
+            comp_qene, comp_ave, comp_stderr = mdle.q_energy_statistics([comp_energies], error_method)
+
+            print(f"\n📌 Pose {i} replica {r+1}")
+            print(f"Ligand EL_w: {lig_ave[2][0]}, VDW_w: {lig_ave[2][1]}")
+            print(f"Complex EL_w: {comp_ave[2][0]}, VDW_w: {comp_ave[2][1]}")
+            print(f"Complex EL_p: {comp_ave[1][0]}, VDW_p: {comp_ave[1][1]}")
+
+            lig_terms[i - 1, r] = lie_engine.terms_from_qterms(lig_ave)
+            lig_errs[i - 1, r] = lie_engine.terms_from_qterms(lig_stderr)
+            comp_terms[i - 1, r] = lie_engine.terms_from_qterms(comp_ave)
+            comp_errs[i - 1, r] = lie_engine.terms_from_qterms(comp_stderr)
+
+        if n_boot:
+            lig_runs = [lie_engine.terms_from_energies(read_energies(f, equilibrate)[0]) for f in ligand_logs]
+            comp_runs = [lie_engine.terms_from_energies(read_energies(f, equilibrate)[0]) for f in complex_logs]
+            for r in range(n_replicas):
+                b = lie_engine.bootstrap_dg([lig_runs[r]], [comp_runs[r]], alpha, beta, gamma, n_boot, ci, seed=seed)
+                boot[i - 1, r] = b['std'], b['ci_low'], b['ci_high']
+            b = lie_engine.bootstrap_dg(lig_runs, comp_runs, alpha, beta, gamma, n_boot, ci, seed=seed)
+            pose_boot[i - 1] = b['std'], b['ci_low'], b['ci_high']
+
+    # ΔG of every pose and replica in one call, and the per-pose mean over replicas
+    dg, dg_stderr = lie_engine.compute_dg(lig_terms, lig_errs, comp_terms, comp_errs, alpha, beta, gamma)
+    pose_dg, pose_stderr, pose_std = lie_engine.reduce_dg(dg, dg_stderr, axis=1)
+
+    for i in range(1, len(ligand_poses) + 1):
+        if np.all(np.isnan(dg[i - 1])):
+            continue
+
         for r in range(n_replicas):
             output_file_pose_replica = f"results_LIE-pose{i}-r{r+1}.csv"
 
             with open(output_file_pose_replica, 'w', newline='') as f:
                 writer = csv.writer(f)
-                writer.writerow(['ligand_name', 'pose', 'replica', 'alpha', 'beta', 'gamma', 'dG_calc', 'stderr', 'dG_exp'])
-
-                lig_qene, lig_ave, lig_stderr = mdle.get_q_energies([ligand_logs[r]])
-                comp_qene, comp_ave, comp_stderr = mdle.get_q_energies([complex_logs[r]])
-
-                print(f"\n📌 Pose {i} replica {r+1}")
-                print(f"Ligand EL_w: {lig_ave[2][0]}, VDW_w: {lig_ave[2][1]}")
-                print(f"Complex EL_w: {comp_ave[2][0]}, VDW_w: {comp_ave[2][1]}")
-                print(f"Complex EL_p: {comp_ave[1][0]}, VDW_p: {comp_ave[1][1]}")
-
-                dg = (beta * ((comp_ave[2][0] + comp_ave[1][0]) - lig_ave[2][0]) +
-                      alpha * ((comp_ave[2][1] + comp_ave[1][1]) - lig_ave[2][1]) +
-                      gamma)
-
-                dg_stderr = np.sqrt(beta**2 * (lig_stderr[2][0]**2 + comp_stderr[2][0]**2 + comp_stderr[1][0]**2) +
-                                    alpha**2 * (lig_stderr[2][1]**2 + comp_stderr[2][1]**2 + comp_stderr[1][1]**2))
-
-                print(f"✅ ΔG = {dg:.2f} ± {dg_stderr:.2f} kcal/mol")
-
-                writer.writerow([ligand_name, i, r+1, alpha, beta, gamma, round(dg, 2), round(dg_stderr, 2), dg_exp])
+                header = ['ligand_name', 'pose', 'replica', 'alpha', 'beta', 'gamma', 'dG_calc', 'stderr', 'dG_exp']
+                row = [ligand_name, i, r+1, alpha, beta, gamma,
+                       round(dg[i - 1, r], 2), round(dg_stderr[i - 1, r], 2), dg_exp]
+                if n_boot:
+                    header += ['dG_ci_low', 'dG_ci_high']
+                    row[7] = round(boot[i - 1, r, 0], 2)
+                    row += [round(boot[i - 1, r, 1], 2), round(boot[i - 1, r, 2], 2)]
+                if equilibrate:
+                    header += ['eq_cut_ligand', 'eq_cut_complex']
+                    row += cuts[i - 1, r].tolist()
+                writer.writerow(header)
+
+                print(f"✅ Pose {i} replica {r+1}: ΔG = {dg[i - 1, r]:.2f} ± {row[7]:.2f} kcal/mol")
+
+                writer.writerow(row)
+
+        print(f"   Pose {i} mean over replicas: ΔG = {pose_dg[i - 1]:.2f} ± {pose_stderr[i - 1]:.2f} "
+              f"(SD {pose_std[i - 1]:.2f}) kcal/mol")
+        if n_boot:
+            print(f"   Pose {i} bootstrap over replicas: σ = {pose_boot[i - 1, 0]:.2f}, "
+                  f"{ci:g}% CI = [{pose_boot[i - 1, 1]:.2f}, {pose_boot[i - 1, 2]:.2f}] kcal/mol")
 
     print(f"\n✅ Results saved in separate CSV files per pose and replica.")
 
@@ -186,8 +263,25 @@ if __name__ == "__main__":
     parser.add_argument("--dg_exp", type=float, default=0.0, help="Experimental ΔG value")
     parser.add_argument("--n_replicas", type=int, default=3, help="Number of replicas per pose")
     parser.add_argument("--n_poses", type=int, default=None, help="Number of poses to analyze (default: all)")
+    parser.add_argument("--energy_source", choices=["log", "en"], default="log",
+                        help="Read energies from the .log files or from the binary Qdyn .en files")
+    parser.add_argument("--error_method", choices=sorted(mdle.ERROR_METHODS), default="blocks",
+                        help="Standard error estimator: blocks (statistical inefficiency) or acf (FFT autocorrelation time)")
+
+    parser.add_argument("--bootstrap", type=int, default=0,
+                        help="Block bootstrap resamples of replicas and time series (e.g. 10000); "
+                             "stderr becomes the bootstrap standard deviation and CIs are added")
+    parser.add_argument("--ci", type=float, default=95.0, help="Confidence level of the bootstrap intervals (%%)")
+    parser.add_argument("--seed", type=int, default=None, help="Bootstrap seed")
+    parser.add_argument("--equilibrate", action="store_true",
+                        help="Discard the equilibration region of every run (start maximizing the effective "
+                             "sample count) before averaging, and record the cut")
+
+    mdle.add_cache_arguments(parser)
 
     args = parser.parse_args()
+    mdle.configure_cache_from_args(args)
 
     main(args.ligand_dir, args.complex_dir, args.alpha, args.beta, args.gamma,
-         args.output, args.ligand_name, args.dg_exp, args.n_replicas, args.n_poses)
+         args.output, args.ligand_name, args.dg_exp, args.n_replicas, args.n_poses, args.energy_source,
+         args.error_method, args.bootstrap, args.ci, args.seed, args.equilibrate)
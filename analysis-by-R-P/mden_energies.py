@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+Functions to read Q-atom energies from the binary energy files (.en) written
+by Qdyn.
+
+Qdyn writes the energy file as unformatted (sequential) Fortran records: one
+header record, followed by two records per frame, the Q-atom energies of every
+FEP state and the EVB off-diagonal elements. The file is decoded with a single
+NumPy structured dtype instead of tokenizing text, and it is sampled every
+`energy` interval (10 steps in our production inputs) instead of every `output`
+interval (50 steps) like the .log files.
+"""
+
+import numpy as np
+
+# Magic number that opens the header record of Qdyn 6 energy files
+CANARY = 1337
+
+# Per-state fields of a frame record, in the order Qdyn writes them
+STATE_FIELDS = ('lambda', 'total', 'bond', 'angle', 'torsion', 'improper',
+                'el', 'vdw', 'qq_el', 'qq_vdw', 'qp_el', 'qp_vdw', 'qw_el', 'qw_vdw',
+                'restraint')
+
+
+def _state_dtype(endian):
+    return np.dtype([(name, endian + 'f8') for name in STATE_FIELDS])
+
+
+def read_energy_header(enfile):
+    """
+    Reads the header record of a Qdyn energy file.
+
+    Returns a dict with the byte order, the header length in bytes, the
+    integer header fields and the Qdyn version string.
+    Raises ValueError if the file is not a Qdyn 6 energy file.
+    """
+    with open(enfile, 'rb') as f:
+        head = f.read(8)
+        if len(head) < 8:
+            raise ValueError(f"{enfile}: too short to be a Qdyn energy file")
+
+        for endian in ('<', '>'):
+            reclen, canary = np.frombuffer(head, dtype=endian + 'i4')
+            if canary == CANARY and 8 <= reclen < 4096:
+                break
+        else:
+            raise ValueError(f"{enfile}: not a Qdyn 6 energy file (no header canary)")
+
+        record = head[4:] + f.read(int(reclen) - 4 + 4)
+
+    nints = (int(reclen) - 80) // 4
+    ints = np.frombuffer(record[:4 * nints], dtype=endian + 'i4')
+    version = record[4 * nints:int(reclen)].decode('ascii', 'replace').strip()
+
+    return {'endian': endian,
+            'header_bytes': int(reclen) + 8,
+            'fields': ints[1:].tolist(),
+            'version': version}
+
+
+def _frame_dtype(data, endian):
+    """
+    Builds the dtype of one frame (energy record + off-diagonal record) from
+    the record markers of the first frame.
+    """
+    ene_len = int(np.frombuffer(data[:4], dtype=endian + 'i4')[0])
+    if (ene_len - 4) % (len(STATE_FIELDS) * 8) != 0:
+        raise ValueError(f"Unexpected energy record length {ene_len}")
+    nstates = (ene_len - 4) // (len(STATE_FIELDS) * 8)
+
+    offd_at = ene_len + 8
+    offd_len = int(np.frombuffer(data[offd_at:offd_at + 4], dtype=endian + 'i4')[0])
+
+    fields = [('head', endian + 'i4'),
+              ('lead', endian + 'i4'),
+              ('states', _state_dtype(endian), (nstates,)),
+              ('tail', endian + 'i4'),
+              ('offd_head', endian + 'i4')]
+    if offd_len > 0:
+        fields.append(('offd', 'V%d' % offd_len))
+    fields.append(('offd_tail', endian + 'i4'))
+
+    return np.dtype(fields), ene_len, offd_len
+
+
+def read_energy_file(enfile, interval=10):
+    """
+    Reads all frames of a Qdyn energy file.
+
+    Returns (steps, energies) where energies is a structured array of shape
+    (n_frames, n_states) with the fields in STATE_FIELDS. The file stores no
+    step numbers; frame k was written at step (k + 1) * interval, where
+    interval is the `energy` interval of the MD input.
+    An incomplete last frame (run still going) is ignored.
+    """
+    header = read_energy_header(enfile)
+    endian = header['endian']
+
+    with open(enfile, 'rb') as f:
+        f.seek(header['header_bytes'])
+        data = f.read()
+
+    if len(data) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros((0, 1), dtype=_state_dtype(endian))
+
+    dtype, ene_len, offd_len = _frame_dtype(data, endian)
+    nframes = len(data) // dtype.itemsize
+    frames = np.frombuffer(data, dtype=dtype, count=nframes)
+
+    if (np.any(frames['head'] != ene_len) or np.any(frames['tail'] != ene_len) or
+            np.any(frames['offd_head'] != offd_len) or np.any(frames['offd_tail'] != offd_len)):
+        raise ValueError(f"{enfile}: corrupt or variable-length frame records")
+
+    steps = (np.arange(nframes, dtype=np.int64) + 1) * interval
+
+    return steps, frames['states']
+
+
+def _fill_columns(columns, rows, picked):
+    columns[rows, 0] = picked['qq_el']
+    columns[rows, 1] = picked['qq_vdw']
+    columns[rows, 2] = picked['qp_el']
+    columns[rows, 3] = picked['qp_vdw']
+    columns[rows, 4] = picked['qw_el']
+    columns[rows, 5] = picked['qw_vdw']
+    columns[rows, 6] = picked['qp_el'] + picked['qw_el']
+    columns[rows, 7] = picked['qp_vdw'] + picked['qw_vdw']
+    columns[rows, 8] = picked['el']
+    columns[rows, 9] = picked['vdw']
+    columns[rows, 10] = picked['bond']
+    columns[rows, 11] = picked['angle']
+    columns[rows, 12] = picked['torsion']
+    columns[rows, 13] = picked['improper']
+
+
+def to_state_columns(states):
+    """
+    Converts the energies of every state into the column layout of
+    mdlog_energies.QCOLUMNS. Returns a dict mapping (state, lambda), with
+    states numbered from 1 and lambda taken from the first frame, to an
+    (n_frames, 14) array.
+    """
+    n, nstates = states.shape
+    result = {}
+    for i in range(nstates):
+        columns = np.full((n, 14), np.nan)
+        _fill_columns(columns, slice(None), states[:, i])
+        lam = float(states['lambda'][0, i]) if n else 0.0
+        result[(i + 1, round(lam, 6))] = columns
+    return result
+
+
+def to_q_columns(states, lambda_='1.00'):
+    """
+    Converts the energies of the state at lambda_ into the (n_frames, 14)
+    column layout of mdlog_energies.QCOLUMNS. Q-surr. is not stored in the
+    energy file and is rebuilt as Q-prot + Q-wat.
+    Frames where no state has the requested lambda are NaN.
+    """
+    lam = float(lambda_)
+    n = states.shape[0]
+    columns = np.full((n, 14), np.nan)
+
+    # Pick the first state at lambda_ in every frame
+    match = np.isclose(states['lambda'], lam, atol=5e-5)
+    has_state = match.any(axis=1)
+    picked = states[np.arange(n), match.argmax(axis=1)][has_state]
+
+    _fill_columns(columns, has_state, picked)
+
+    return columns
@@ -4,7 +4,7 @@
 #SBATCH --error=logs/ligand-energy_%j.err
 #SBATCH --nodes=1
 #SBATCH --ntasks=1
-#SBATCH --cpus-per-task=1
+#SBATCH --cpus-per-task=8
 #SBATCH --mem=8G
 #SBATCH --time=01:00:00
 #SBATCH -p long
@@ -18,24 +18,51 @@ module load python/3.8  # Cambia a la versión que tengas disponible
 mkdir -p logs
 mkdir -p results
 
+# Caché de energías ya leídas (.mdlog_cache/): deja vacío para reutilizarla,
+# o usa "--rebuild-cache" / "--no-cache" para forzar la lectura de los .log
+CACHE_FLAGS=""
+
+# Manifiesto con todos los ligandos: id,ligand_dir,complex_dir,dg_exp
+# dg_exp queda vacío: llénalo solo para los ligandos con ΔG experimental medido,
+# que son las referencias de fit_LIE_parameters.py. El manifiesto solo se crea si
+# no existe y después solo se agregan los ligandos que faltan, así los valores de
+# dg_exp ya escritos se conservan entre ejecuciones
+MANIFEST="results/ligands_manifest.csv"
+[ -f "$MANIFEST" ] || echo "id,ligand_dir,complex_dir,dg_exp" > "$MANIFEST"
 for i in $(seq 1 38); do
-    LIGAND_DIR="ligands/ligand_${i}"
-    COMPLEX_DIR="complex/complex_${i}"
-    OUTPUT_FILE="results/LIE_result_${i}.csv"
-    LIGAND_NAME="ligand_${i}"
-
-    echo "Ejecutando ligando $i..."
-    python analyze_LIE_noqgui.py \
-      --ligand_dir "$LIGAND_DIR" \
-      --complex_dir "$COMPLEX_DIR" \
-      --output "$OUTPUT_FILE" \
-      --ligand_name "$LIGAND_NAME" \
-      --dg_exp 0.0 \
-      --alpha 0.68 \
-      --beta 0.11 \
-      --gamma 0.0
-
-    echo "Ligando $i terminado."
+    grep -q "^ligand_${i}," "$MANIFEST" || \
+        echo "ligand_${i},ligands/ligand_${i},complex/complex_${i}," >> "$MANIFEST"
 done
 
+# Un solo proceso para todos los ligandos; los .log se leen en paralelo con las
+# CPUs de --cpus-per-task. Agrega "--per_ligand_dir results" para obtener
+# también results/LIE_result_ligand_#.csv. Agrega "--bootstrap 10000 --seed 1" para que
+# la columna stderr sea la desviación estándar bootstrap de ΔG y se añadan los
+# intervalos de confianza al 95% (sin --seed el resultado cambia en cada ejecución).
+# Agrega "--equilibrate" para descartar la región de equilibración de cada .log antes
+# de promediar; el corte de cada réplica se imprime y se guarda en las columnas
+# eq_cut_ligand/eq_cut_complex
+echo "Ejecutando todos los ligandos de $MANIFEST..."
+python analyze_LIE_noqgui.py \
+  --manifest "$MANIFEST" \
+  --output "results/LIE_results.csv" \
+  --alpha 0.68 \
+  --beta 0.11 \
+  --gamma 0.0 \
+  $CACHE_FLAGS
+
+# ΔG por ventanas deslizantes de cada réplica del complejo (suma acumulada, sin
+# copiar ventanas): results/LIE_time_resolved.npz y, con los posibles cambios de
+# modo de unión (saltos de ΔG mayores que --threshold), results/LIE_transitions.csv
+python lie_time_resolved.py \
+  --manifest "$MANIFEST" \
+  --output "results/LIE_time_resolved.npz" \
+  --summary "results/LIE_transitions.csv" \
+  --alpha 0.68 \
+  --beta 0.11 \
+  --gamma 0.0 \
+  --window 100 \
+  --stride 5 \
+  $CACHE_FLAGS
+
 echo "Todos los ligandos procesados."
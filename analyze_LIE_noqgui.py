@@ -2,6 +2,8 @@ import os
 import argparse
 import numpy as np
 import mdlog_energies as mdle  # Asegúrate que mdlog_energies.py esté en el mismo directorio
+import energy_store
+import lie_engine
 import csv
 
 def get_logfiles(path):
@@ -14,7 +16,48 @@ def get_logfiles(path):
                 logfiles.append(os.path.join(subdir, file))
     return logfiles
 
-def main(ligand_dir, complex_dir, alpha, beta, gamma, output_file, ligand_name, dg_exp):
+def write_results(output_file, rows, bootstrap=False, equilibrate=False):
+    header = ['ligand_name', 'alpha', 'beta', 'gamma', 'dG_calc', 'stderr', 'dG_exp']
+    if bootstrap:
+        header += ['dG_ci_low', 'dG_ci_high']
+    if equilibrate:
+        header += ['eq_cut_ligand', 'eq_cut_complex']
+    with open(output_file, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(rows)
+
+def trim_energies(parsed, equilibrate=False):
+    """
+    Energías (pasos, energías) de cada .log, sin la región de equilibración si
+    equilibrate. Devuelve (energías, cortes) con el primer paso conservado de cada .log.
+    """
+    if equilibrate:
+        return mdle.trim_equilibration(parsed)
+    return [ene for steps, ene in parsed], [0] * len(parsed)
+
+def format_cuts(cuts):
+    """Cortes de equilibración de las réplicas, separados por '/'."""
+    return '/'.join(str(cut) for cut in cuts)
+
+def run_terms(energies):
+    """Series de los términos LIE (muestras, término) de cada .log."""
+    return [lie_engine.terms_from_energies(ene) for ene in energies]
+
+def bootstrap_row(row, lig_energies, comp_energies, alpha, beta, gamma, n_boot, ci, seed):
+    """
+    Sustituye el error de la fila por la desviación estándar bootstrap de ΔG
+    y añade el intervalo de confianza por percentiles.
+    """
+    boot = lie_engine.bootstrap_dg(run_terms(lig_energies), run_terms(comp_energies),
+                                   alpha, beta, gamma, n_boot, ci, seed=seed)
+    print(f"   Bootstrap ({n_boot} remuestreos): σ = {boot['std']:.2f}, "
+          f"IC {ci:g}% = [{boot['ci_low']:.2f}, {boot['ci_high']:.2f}] kcal/mol")
+    row[5] = round(boot['std'], 2)
+    return row + [round(boot['ci_low'], 2), round(boot['ci_high'], 2)]
+
+def main(ligand_dir, complex_dir, alpha, beta, gamma, output_file, ligand_name, dg_exp, energy_source="log", error_method="blocks",
+         n_boot=0, ci=95.0, seed=None, equilibrate=False):
 
     ligand_logs = get_logfiles(ligand_dir)
     complex_logs = get_logfiles(complex_dir)
@@ -23,30 +66,160 @@ def main(ligand_dir, complex_dir, alpha, beta, gamma, output_file, ligand_name,
         print("❌ No se encontraron archivos .log en ligand o complex.")
         return
 
-    lig_qene, lig_ave, lig_stderr = mdle.get_q_energies(ligand_logs)
-    comp_qene, comp_ave, comp_stderr = mdle.get_q_energies(complex_logs)
+    if energy_source == "en":
+        ligand_logs = mdle.to_energy_files(ligand_logs)
+        complex_logs = mdle.to_energy_files(complex_logs)
+
+    lig_energies, lig_cuts = trim_energies([mdle.read_q_energies(f) for f in ligand_logs], equilibrate)
+    comp_energies, comp_cuts = trim_energies([mdle.read_q_energies(f) for f in complex_logs], equilibrate)
+    if equilibrate:
+        print(f"Equilibración descartada hasta el paso: ligand {format_cuts(lig_cuts)}, complex {format_cuts(comp_cuts)}")
+
+    lig_qene, lig_ave, lig_stderr = mdle.q_energy_statistics(lig_energies, error_method)
+    comp_qene, comp_ave, comp_stderr = mdle.q_energy_statistics(comp_energies, error_method)
 
     # Imprimir valores para depuración
     print("Ligand EL_w:", lig_ave[2][0], "VDW_w:", lig_ave[2][1])
     print("Complex EL_w:", comp_ave[2][0], "VDW_w:", comp_ave[2][1])
     print("Complex EL_p:", comp_ave[1][0], "VDW_p:", comp_ave[1][1])
 
-    dg = (beta * ((comp_ave[2][0] + comp_ave[1][0]) - lig_ave[2][0]) +
-          (alpha * ((comp_ave[2][1] + comp_ave[1][1]) - lig_ave[2][1])) + gamma)
-
-    dg_stderr = np.sqrt(beta**2 * (lig_stderr[2][0]**2 + comp_stderr[2][0]**2 + comp_stderr[1][0]**2) +
-                        alpha**2 * (lig_stderr[2][1]**2 + comp_stderr[2][1]**2 + comp_stderr[1][1]**2))
+    dg, dg_stderr = lie_engine.compute_dg(lie_engine.terms_from_qterms(lig_ave), lie_engine.terms_from_qterms(lig_stderr),
+                                          lie_engine.terms_from_qterms(comp_ave), lie_engine.terms_from_qterms(comp_stderr),
+                                          alpha, beta, gamma)
 
     print(f"✅ LIGAND: {ligand_name}")
     print(f"ΔG = {dg:.2f} ± {dg_stderr:.2f} kcal/mol")
 
-    with open(output_file, 'w', newline='') as f:
-        writer = csv.writer(f)
-        writer.writerow(['ligand_name', 'alpha', 'beta', 'gamma', 'dG_calc', 'stderr', 'dG_exp'])
-        writer.writerow([ligand_name, alpha, beta, gamma, round(dg, 2), round(dg_stderr, 2), dg_exp])
+    row = [ligand_name, alpha, beta, gamma, round(dg, 2), round(dg_stderr, 2), dg_exp]
+    if n_boot:
+        row = bootstrap_row(row, lig_energies, comp_energies, alpha, beta, gamma, n_boot, ci, seed)
+    if equilibrate:
+        row += [format_cuts(lig_cuts), format_cuts(comp_cuts)]
+    write_results(output_file, [row], bootstrap=n_boot > 0, equilibrate=equilibrate)
 
     print(f"✅ Resultados guardados en: {output_file}")
 
+def read_manifest(manifest):
+    """Lee el manifiesto de ligandos: columnas id, ligand_dir, complex_dir y dg_exp."""
+    with open(manifest, newline='') as f:
+        rows = list(csv.DictReader(f))
+    for row in rows:
+        # Solo los ligandos con dg_exp sirven de referencia para ajustar α, β y γ
+        row['reference'] = bool((row.get('dg_exp') or '').strip())
+        row['dg_exp'] = float(row.get('dg_exp') or 0.0)
+    return rows
+
+def store_energies(store_dir, entries):
+    """
+    Energías de ligando y complejo de cada entrada del manifiesto leídas de un
+    almacén de energy_store.py, sin volver a leer los .log.
+    """
+    store = energy_store.open_store(store_dir)
+    runs = []
+    blocks = []
+    for entry in entries:
+        lig_runs = energy_store.select_runs(store, ligand=entry['id'], system='ligand')
+        comp_runs = energy_store.select_runs(store, ligand=entry['id'], system='complex')
+        if not lig_runs or not comp_runs:
+            print(f"❌ {entry['id']}: No hay energías de ligand o complex en {store_dir}.")
+            continue
+        runs.append((entry, len(blocks), len(lig_runs), len(comp_runs)))
+        blocks.extend(energy_store.run_energies(store, run) for run in lig_runs + comp_runs)
+    return runs, blocks
+
+def load_batch_energies(entries, energy_source="log", workers=None, store_dir=None):
+    """
+    Lee las energías de ligando y complejo de las entradas del manifiesto.
+    Devuelve (runs, parsed): runs tiene (entrada, primer bloque, n_ligand, n_complex)
+    por ligando e indexa la lista de (pasos, energías) de todos los .log.
+    """
+    if store_dir:
+        return store_energies(store_dir, entries)
+
+    files = []
+    runs = []
+    for entry in entries:
+        if not (os.path.isdir(entry['ligand_dir']) and os.path.isdir(entry['complex_dir'])):
+            print(f"❌ {entry['id']}: No existe {entry['ligand_dir']} o {entry['complex_dir']}.")
+            continue
+        ligand_logs = get_logfiles(entry['ligand_dir'])
+        complex_logs = get_logfiles(entry['complex_dir'])
+        if not ligand_logs or not complex_logs:
+            print(f"❌ {entry['id']}: No se encontraron archivos .log en ligand o complex.")
+            continue
+        if energy_source == "en":
+            ligand_logs = mdle.to_energy_files(ligand_logs)
+            complex_logs = mdle.to_energy_files(complex_logs)
+        runs.append((entry, len(files), len(ligand_logs), len(complex_logs)))
+        files.extend(ligand_logs + complex_logs)
+
+    return runs, mdle.read_q_energies_parallel(files, workers=workers)
+
+def batch_terms(runs, energies, error_method="blocks"):
+    """
+    Promedios y errores de los términos LIE con forma (sistema, ligando, término),
+    donde el sistema 0 es el ligando en agua y el 1 el complejo.
+    """
+    ave = np.zeros((2, len(runs), len(lie_engine.TERMS)))
+    stderr = np.zeros_like(ave)
+    for k, (entry, first, n_lig, n_comp) in enumerate(runs):
+        for system, blocks in enumerate((energies[first:first + n_lig],
+                                         energies[first + n_lig:first + n_lig + n_comp])):
+            qene, q_ave, q_stderr = mdle.q_energy_statistics(blocks, error_method)
+            ave[system, k] = lie_engine.terms_from_qterms(q_ave)
+            stderr[system, k] = lie_engine.terms_from_qterms(q_stderr)
+    return ave, stderr
+
+def batch_main(manifest, alpha, beta, gamma, output_file, per_ligand_dir=None,
+               energy_source="log", error_method="blocks", workers=None, store_dir=None,
+               n_boot=0, ci=95.0, seed=None, equilibrate=False):
+    """
+    Calcula ΔG de todos los ligandos del manifiesto en un solo proceso.
+
+    Los .log de todos los ligandos y complejos se leen en paralelo
+    (mdle.read_q_energies_parallel) y los resultados se escriben en una sola
+    tabla; con per_ligand_dir también se escribe LIE_result_<id>.csv por ligando.
+    Con store_dir las energías se toman del almacén de energy_store.py.
+    Con n_boot > 0 el error es la desviación estándar bootstrap de ΔG y se
+    añade su intervalo de confianza (lie_engine.bootstrap_dg).
+    Con equilibrate se descarta la región de equilibración de cada .log
+    (mdle.trim_equilibration) y el corte se guarda en la tabla.
+    """
+    entries = read_manifest(manifest)
+    runs, parsed = load_batch_energies(entries, energy_source, workers, store_dir)
+    energies, cuts = trim_energies(parsed, equilibrate)
+    write_batch_results(runs, energies, alpha, beta, gamma, output_file, per_ligand_dir, error_method,
+                        n_boot, ci, seed, cuts if equilibrate else None)
+
+def write_batch_results(runs, energies, alpha, beta, gamma, output_file, per_ligand_dir, error_method,
+                        n_boot=0, ci=95.0, seed=None, cuts=None):
+    """Calcula ΔG de cada ligando a partir de sus energías y escribe la tabla de resultados."""
+    # Promedios y errores con forma (ligando, término) y ΔG de todos los ligandos a la vez
+    ave, stderr = batch_terms(runs, energies, error_method)
+    dg, dg_stderr = lie_engine.compute_dg(ave[0], stderr[0], ave[1], stderr[1], alpha, beta, gamma)
+
+    rows = []
+    for k, (entry, first, n_lig, n_comp) in enumerate(runs):
+        print(f"✅ {entry['id']}: ΔG = {dg[k]:.2f} ± {dg_stderr[k]:.2f} kcal/mol")
+        if cuts is not None:
+            print(f"   Equilibración descartada hasta el paso: ligand {format_cuts(cuts[first:first + n_lig])}, "
+                  f"complex {format_cuts(cuts[first + n_lig:first + n_lig + n_comp])}")
+
+        row = [entry['id'], alpha, beta, gamma, round(dg[k], 2), round(dg_stderr[k], 2), entry['dg_exp']]
+        if n_boot:
+            row = bootstrap_row(row, energies[first:first + n_lig], energies[first + n_lig:first + n_lig + n_comp],
+                                alpha, beta, gamma, n_boot, ci, seed)
+        if cuts is not None:
+            row += [format_cuts(cuts[first:first + n_lig]), format_cuts(cuts[first + n_lig:first + n_lig + n_comp])]
+        rows.append(row)
+        if per_ligand_dir:
+            os.makedirs(per_ligand_dir, exist_ok=True)
+            write_results(os.path.join(per_ligand_dir, f"LIE_result_{entry['id']}.csv"), [row],
+                          bootstrap=n_boot > 0, equilibrate=cuts is not None)
+
+    write_results(output_file, rows, bootstrap=n_boot > 0, equilibrate=cuts is not None)
+    print(f"✅ {len(rows)} ligandos guardados en: {output_file}")
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Análisis LIE sin GUI")
     parser.add_argument("--ligand_dir", default="ligand", help="Ruta al directorio de ligando")
@@ -57,7 +230,37 @@ if __name__ == "__main__":
     parser.add_argument("--output", default="LIE_results.csv", help="Nombre del archivo de salida CSV")
     parser.add_argument("--ligand_name", default="LIG", help="Nombre del ligando")
     parser.add_argument("--dg_exp", type=float, default=0.0, help="Valor experimental de ΔG")
+    parser.add_argument("--energy_source", choices=["log", "en"], default="log",
+                        help="Leer energías de los .log o de los archivos binarios .en de Qdyn")
+    parser.add_argument("--manifest", default=None,
+                        help="CSV con columnas id,ligand_dir,complex_dir,dg_exp: calcula todos los ligandos en un solo proceso")
+    parser.add_argument("--per_ligand_dir", default=None,
+                        help="Con --manifest, escribe también LIE_result_<id>.csv por ligando en este directorio")
+    parser.add_argument("--store", default=None,
+                        help="Con --manifest, toma las energías del almacén creado con energy_store.py")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Procesos para leer los .log con --manifest (por defecto, las CPUs asignadas por SLURM)")
+    parser.add_argument("--error_method", choices=sorted(mdle.ERROR_METHODS), default="blocks",
+                        help="Estimador del error estándar: bloques (ineficiencia estadística) o autocorrelación (FFT)")
+
+    parser.add_argument("--bootstrap", type=int, default=0,
+                        help="Remuestreos bootstrap por bloques de réplicas y series temporales (p. ej. 10000); "
+                             "el error pasa a ser la desviación estándar bootstrap y se añade el intervalo de confianza")
+    parser.add_argument("--ci", type=float, default=95.0, help="Nivel del intervalo de confianza bootstrap (%%)")
+    parser.add_argument("--seed", type=int, default=None, help="Semilla del bootstrap")
+    parser.add_argument("--equilibrate", action="store_true",
+                        help="Descarta la región de equilibración de cada .log (punto que maximiza las muestras "
+                             "efectivas) antes de promediar; el corte se guarda en la tabla")
+
+    mdle.add_cache_arguments(parser)
 
     args = parser.parse_args()
-    main(args.ligand_dir, args.complex_dir, args.alpha, args.beta, args.gamma,
-         args.output, args.ligand_name, args.dg_exp)
\ No newline at end of file
+    mdle.configure_cache_from_args(args)
+    if args.manifest:
+        batch_main(args.manifest, args.alpha, args.beta, args.gamma, args.output, args.per_ligand_dir,
+                   args.energy_source, args.error_method, args.workers, args.store,
+                   args.bootstrap, args.ci, args.seed, args.equilibrate)
+    else:
+        main(args.ligand_dir, args.complex_dir, args.alpha, args.beta, args.gamma,
+             args.output, args.ligand_name, args.dg_exp, args.energy_source, args.error_method,
+             args.bootstrap, args.ci, args.seed, args.equilibrate)
\ No newline at end of file
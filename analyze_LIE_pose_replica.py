@@ -1,7 +1,7 @@
 import os
 import argparse
-import numpy as np
 import mdlog_energies as mdle
+import lie_engine
 import csv
 
 def get_logfiles(path, n_replicas):
@@ -20,7 +20,22 @@ def get_pose_dirs(path):
     return sorted([os.path.join(path, d) for d in os.listdir(path)
                    if os.path.isdir(os.path.join(path, d))])
 
-def main(ligand_dir, complex_dir, alpha, beta, gamma, output_file, ligand_name, dg_exp, n_replicas):
+def read_energies(logfiles, equilibrate=False):
+    """
+    Energías de cada .log, sin la región de equilibración si equilibrate.
+    Devuelve (energías, cortes) con el primer paso conservado de cada .log.
+    """
+    parsed = [mdle.read_q_energies(f) for f in logfiles]
+    if equilibrate:
+        return mdle.trim_equilibration(parsed)
+    return [ene for steps, ene in parsed], [0] * len(parsed)
+
+def run_terms(energies):
+    """Series de los términos LIE (muestras, término) de cada .log."""
+    return [lie_engine.terms_from_energies(ene) for ene in energies]
+
+def main(ligand_dir, complex_dir, alpha, beta, gamma, output_file, ligand_name, dg_exp, n_replicas,
+         energy_source="log", error_method="blocks", n_boot=0, ci=95.0, seed=None, equilibrate=False):
     ligand_poses = get_pose_dirs(ligand_dir)
     complex_poses = get_pose_dirs(complex_dir)
 
@@ -32,35 +47,72 @@ def main(ligand_dir, complex_dir, alpha, beta, gamma, output_file, ligand_name,
         print("❌ El número de poses no coincide entre ligand y complex.")
         return
 
+    # Promedios y errores con forma (pose, término); ΔG de todas las poses a la vez
+    poses = []
+    lig_terms, lig_errs, comp_terms, comp_errs = [], [], [], []
+    boots = []
+    cuts = []
+    for i, (lig_pose, comp_pose) in enumerate(zip(ligand_poses, complex_poses), start=1):
+        ligand_logs = get_logfiles(lig_pose, n_replicas)
+        complex_logs = get_logfiles(comp_pose, n_replicas)
+
+        if not ligand_logs or not complex_logs:
+            print(f"❌ Pose {i}: No se encontraron archivos .log suficientes.")
+            continue
+
+        if energy_source == "en":
+            ligand_logs = mdle.to_energy_files(ligand_logs)
+            complex_logs = mdle.to_energy_files(complex_logs)
+
+        lig_energies, lig_cuts = read_energies(ligand_logs, equilibrate)
+        comp_energies, comp_cuts = read_energies(complex_logs, equilibrate)
+        lig_qene, lig_ave, lig_stderr = mdle.q_energy_statistics(lig_energies, error_method)
+        comp_qene, comp_ave, comp_stderr = mdle.q_energy_statistics(comp_energies, error_method)
+
+        print(f"\n📌 Pose {i}")
+        print("Ligand EL_w:", lig_ave[2][0], "VDW_w:", lig_ave[2][1])
+        print("Complex EL_w:", comp_ave[2][0], "VDW_w:", comp_ave[2][1])
+        print("Complex EL_p:", comp_ave[1][0], "VDW_p:", comp_ave[1][1])
+
+        poses.append(i)
+        cuts.append(['/'.join(map(str, lig_cuts)), '/'.join(map(str, comp_cuts))])
+        lig_terms.append(lie_engine.terms_from_qterms(lig_ave))
+        lig_errs.append(lie_engine.terms_from_qterms(lig_stderr))
+        comp_terms.append(lie_engine.terms_from_qterms(comp_ave))
+        comp_errs.append(lie_engine.terms_from_qterms(comp_stderr))
+
+        if n_boot:
+            # Remuestreo conjunto de las réplicas de la pose y de bloques de sus series
+            boots.append(lie_engine.bootstrap_dg(run_terms(lig_energies), run_terms(comp_energies),
+                                                 alpha, beta, gamma, n_boot, ci, seed=seed))
+
+    if not poses:
+        dg, dg_stderr = [], []
+    else:
+        dg, dg_stderr = lie_engine.compute_dg(lig_terms, lig_errs, comp_terms, comp_errs, alpha, beta, gamma)
+
     with open(output_file, 'w', newline='') as f:
         writer = csv.writer(f)
-        writer.writerow(['ligand_name', 'pose', 'alpha', 'beta', 'gamma', 'dG_calc', 'stderr', 'dG_exp'])
-
-        for i, (lig_pose, comp_pose) in enumerate(zip(ligand_poses, complex_poses), start=1):
-            ligand_logs = get_logfiles(lig_pose, n_replicas)
-            complex_logs = get_logfiles(comp_pose, n_replicas)
-
-            if not ligand_logs or not complex_logs:
-                print(f"❌ Pose {i}: No se encontraron archivos .log suficientes.")
-                continue
-
-            lig_qene, lig_ave, lig_stderr = mdle.get_q_energies(ligand_logs)
-            comp_qene, comp_ave, comp_stderr = mdle.get_q_energies(complex_logs)
-
-            print(f"\n📌 Pose {i}")
-            print("Ligand EL_w:", lig_ave[2][0], "VDW_w:", lig_ave[2][1])
-            print("Complex EL_w:", comp_ave[2][0], "VDW_w:", comp_ave[2][1])
-            print("Complex EL_p:", comp_ave[1][0], "VDW_p:", comp_ave[1][1])
-
-            dg = (beta * ((comp_ave[2][0] + comp_ave[1][0]) - lig_ave[2][0]) +
-                  (alpha * ((comp_ave[2][1] + comp_ave[1][1]) - lig_ave[2][1])) + gamma)
-
-            dg_stderr = np.sqrt(beta**2 * (lig_stderr[2][0]**2 + comp_stderr[2][0]**2 + comp_stderr[1][0]**2) +
-                                alpha**2 * (lig_stderr[2][1]**2 + comp_stderr[2][1]**2 + comp_stderr[1][1]**2))
-
-            print(f"✅ ΔG = {dg:.2f} ± {dg_stderr:.2f} kcal/mol")
-
-            writer.writerow([ligand_name, i, alpha, beta, gamma, round(dg, 2), round(dg_stderr, 2), dg_exp])
+        header = ['ligand_name', 'pose', 'alpha', 'beta', 'gamma', 'dG_calc', 'stderr', 'dG_exp']
+        if n_boot:
+            header += ['dG_ci_low', 'dG_ci_high']
+        if equilibrate:
+            header += ['eq_cut_ligand', 'eq_cut_complex']
+        writer.writerow(header)
+
+        for k, (i, pose_dg, pose_stderr) in enumerate(zip(poses, dg, dg_stderr)):
+            print(f"✅ Pose {i}: ΔG = {pose_dg:.2f} ± {pose_stderr:.2f} kcal/mol")
+
+            row = [ligand_name, i, alpha, beta, gamma, round(pose_dg, 2), round(pose_stderr, 2), dg_exp]
+            if n_boot:
+                boot = boots[k]
+                print(f"   Bootstrap ({n_boot} remuestreos): σ = {boot['std']:.2f}, "
+                      f"IC {ci:g}% = [{boot['ci_low']:.2f}, {boot['ci_high']:.2f}] kcal/mol")
+                row[6] = round(boot['std'], 2)
+                row += [round(boot['ci_low'], 2), round(boot['ci_high'], 2)]
+            if equilibrate:
+                row += cuts[k]
+            writer.writerow(row)
 
     print(f"\n✅ Resultados guardados en: {output_file}")
 
@@ -74,10 +126,27 @@ if __name__ == "__main__":
     parser.add_argument("--output", default="LIE_results.csv", help="Nombre del archivo de salida CSV")
     parser.add_argument("--ligand_name", default="LIG", help="Nombre del ligando")
     parser.add_argument("--dg_exp", type=float, default=0.0, help="Valor experimental de ΔG")
+    parser.add_argument("--energy_source", choices=["log", "en"], default="log",
+                        help="Leer energías de los .log o de los archivos binarios .en de Qdyn")
     parser.add_argument("--n_replicas", type=int, default=3, help="Número de réplicas a analizar por pose")
+    parser.add_argument("--error_method", choices=sorted(mdle.ERROR_METHODS), default="blocks",
+                        help="Estimador del error estándar: bloques (ineficiencia estadística) o autocorrelación (FFT)")
+
+    parser.add_argument("--bootstrap", type=int, default=0,
+                        help="Remuestreos bootstrap por bloques de réplicas y series temporales (p. ej. 10000); "
+                             "el error pasa a ser la desviación estándar bootstrap y se añade el intervalo de confianza")
+    parser.add_argument("--ci", type=float, default=95.0, help="Nivel del intervalo de confianza bootstrap (%%)")
+    parser.add_argument("--seed", type=int, default=None, help="Semilla del bootstrap")
+    parser.add_argument("--equilibrate", action="store_true",
+                        help="Descarta la región de equilibración de cada .log (punto que maximiza las muestras "
+                             "efectivas) antes de promediar; el corte se guarda en la tabla")
+
+    mdle.add_cache_arguments(parser)
 
     args = parser.parse_args()
+    mdle.configure_cache_from_args(args)
 
     main(args.ligand_dir, args.complex_dir, args.alpha, args.beta, args.gamma,
-         args.output, args.ligand_name, args.dg_exp, args.n_replicas)
+         args.output, args.ligand_name, args.dg_exp, args.n_replicas, args.energy_source,
+         args.error_method, args.bootstrap, args.ci, args.seed, args.equilibrate)
 
@@ -1,26 +1,55 @@
 import os
+import re
+import csv
+import json
+import argparse
 import numpy as np
+import mdlog_energies as mdle
+import energy_store
 
-def extract_qsurr_energies(filename):
+REPORT_COLUMNS = ("ligand", "system", "pose", "replica", "segment", "path", "samples", "eq_cut",
+                  "error_el", "error_vdw", "high_error")
+
+def qsurr_energies(steps, energies, equilibrate=False):
+    """
+    Electrostatic and vdW Q-surr. energies of parsed (steps, energies) arrays.
+
+    Parameters:
+        steps (np.array): MD step of every energy block.
+        energies (np.array): Energies in the mdlog_energies.QCOLUMNS layout.
+        equilibrate (bool): Discard the equilibration region detected by
+            mdlog_energies.trim_equilibration() first.
+
+    Returns:
+        tuple: Two numpy arrays containing electrostatic energies and vdW energies,
+        and the first step kept.
+    """
+    cut = 0
+    if equilibrate and len(steps):
+        (energies,), (cut,) = mdle.trim_equilibration([(steps, energies)])
+    elecs, vdws = energies[:, 6], energies[:, 7]
+    printed = ~np.isnan(elecs)
+    return elecs[printed], vdws[printed], cut
+
+def extract_qsurr_energies(filename, equilibrate=False):
     """
-    Extracts electrostatic and van der Waals (vdW) Q-surr. energies from a log file.
+    Extracts electrostatic and van der Waals (vdW) Q-surr. energies from a log file
+    or from a binary Qdyn energy file (.en).
+
+    Energies are read through mdlog_energies, so unchanged files are loaded from
+    its parsed-energy cache instead of being parsed again.
 
     Parameters:
-        filename (str): Path to the .log file.
+        filename (str): Path to the .log or .en file.
+        equilibrate (bool): Discard the equilibration region detected by
+            mdlog_energies.trim_equilibration() first.
 
     Returns:
         tuple: Two numpy arrays containing electrostatic energies and vdW energies.
     """
-    vdws = []
-    elecs = []
-    with open(filename, 'r') as f:
-        for line in f:
-            if line.startswith("Q-surr."):
-                parts = line.split()
-                if len(parts) >= 5:
-                    elecs.append(float(parts[3]))
-                    vdws.append(float(parts[4]))
-    return np.array(elecs), np.array(vdws)
+    steps, energies = mdle.read_q_energies(filename)
+    elecs, vdws, cut = qsurr_energies(steps, energies, equilibrate)
+    return elecs, vdws
 
 def compute_error_bind_separate(elecs, vdws):
     """
@@ -45,68 +74,194 @@ def compute_error_bind_separate(elecs, vdws):
     error_el = abs(el_f - el_b) / 2
     return error_vdw, error_el
 
-def main():
+def compute_error_acf(elecs, vdws):
+    """
+    Computes the standard errors of the mean electrostatic and vdW energies from
+    their integrated autocorrelation times (FFT), i.e. std / sqrt(N_eff).
+
+    Parameters:
+        elecs (np.array): Electrostatic energies.
+        vdws (np.array): vdW energies.
+
+    Returns:
+        tuple: error_vdw, error_el (both floats)
+    """
+    error_vdw, error_el = mdle.estimate_error_acf(np.vstack([vdws, elecs]))
+    return error_vdw, error_el
+
+ERROR_METHODS = {"halves": compute_error_bind_separate,
+                 "acf": compute_error_acf}
+
+def scan_ligands(ligand_base="ligands", complex_base="complex"):
     """
-    Main function that searches through production log files for each ligand,
-    calculates the errors in electrostatic and vdW energies, and writes
-    a report listing files where the error exceeds 1 kcal/mol.
+    Finds the ligands with a ligand_base/ligand_# or complex_base/complex_# folder.
 
-    The report suggests extending the MD simulation until the error is below 1.
+    Returns:
+        list: (ligand id, ligand folder, complex folder) of every ligand, by number.
     """
-    ligand_numbers = range(1, 39)  # Adjust based on your ligands count
-    log_files = []
+    numbers = set()
+    for base, prefix in ((ligand_base, "ligand_"), (complex_base, "complex_")):
+        if os.path.isdir(base):
+            for name in os.listdir(base):
+                match = re.fullmatch(prefix + r"(\d+)", name)
+                if match and os.path.isdir(os.path.join(base, name)):
+                    numbers.add(int(match.group(1)))
 
-    # Adjust these paths to match your directory structure
-    for ligand in ligand_numbers:
-        path1 = os.path.join("complex", f"complex_{ligand}", "1", f"production1_{ligand}.log")
-        path2 = os.path.join("complex", f"complex_{ligand}", "2", f"production2_{ligand}.log")
-        if os.path.isfile(path1):
-            log_files.append(path1)
-        if os.path.isfile(path2):
-            log_files.append(path2)
+    return [(f"ligand_{i}", os.path.join(ligand_base, f"ligand_{i}"), os.path.join(complex_base, f"complex_{i}"))
+            for i in sorted(numbers)]
 
-    if not log_files:
-        print("No .log files found to process.")
-        return
+def scan_runs(ligand_base="ligands", complex_base="complex"):
+    """
+    Finds the runs of every ligand by scanning ligand_base/ligand_# and
+    complex_base/complex_# folders (replica folders, or pose folders with
+    replica folders).
+
+    Returns:
+        list: Runs as returned by energy_store.discover_runs().
+    """
+    runs = []
+    for ligand_id, ligand_dir, complex_dir in scan_ligands(ligand_base, complex_base):
+        runs.extend(energy_store.discover_runs(ligand_id, ligand_dir, complex_dir))
+    return runs
 
-    high_errors = []
+def manifest_runs(manifest):
+    """
+    Finds the runs of every ligand of a manifest (columns id, ligand_dir, complex_dir).
+
+    Returns:
+        list: Runs as returned by energy_store.discover_runs().
+    """
+    runs = []
+    for entry in energy_store.read_manifest(manifest):
+        runs.extend(energy_store.discover_runs(entry["id"], entry["ligand_dir"], entry["complex_dir"]))
+    return runs
+
+def check_runs(runs, energy_source="log", error_method="halves", equilibrate=False, workers=None, threshold=1.0):
+    """
+    Reads all runs across a pool of worker processes (through the parsed-energy
+    cache) and computes the electrostatic and vdW errors of every run.
+
+    Returns:
+        list: One dict per run with the REPORT_COLUMNS fields; runs without
+        Q-surr. energies have no errors (None).
+    """
+    paths = [run["path"] for run in runs]
+    if energy_source == "en":
+        paths = mdle.to_energy_files(paths)
 
-    for log_file in log_files:
-        elecs, vdws = extract_qsurr_energies(log_file)
+    compute_error = ERROR_METHODS[error_method]
+    results = []
+    for run, path, (steps, energies) in zip(runs, paths, mdle.read_q_energies_parallel(paths, workers=workers)):
+        elecs, vdws, cut = qsurr_energies(steps, energies, equilibrate)
         if len(elecs) == 0 or len(vdws) == 0:
-            print(f"{log_file}: No Q-surr. energies found.")
-            continue
-
-        error_vdw, error_el = compute_error_bind_separate(elecs, vdws)
-
-        if error_vdw > 1.0:
-            high_errors.append(
-                (log_file, "vdW", error_vdw)
-            )
-        if error_el > 1.0:
-            high_errors.append(
-                (log_file, "Electrostatic", error_el)
-            )
-
-    if not high_errors:
-        print("No errors greater than 1.0 kcal/mol found in the analyzed simulations.")
-        return
+            print(f"{path}: No Q-surr. energies found.")
+            error_vdw = error_el = np.nan
+        else:
+            error_vdw, error_el = compute_error(elecs, vdws)
+        results.append({"ligand": run["ligand"], "system": run["system"], "pose": run["pose"],
+                        "replica": run["replica"], "segment": run["segment"], "path": path,
+                        "samples": len(elecs), "eq_cut": int(cut),
+                        "error_el": None if np.isnan(error_el) else round(float(error_el), 4),
+                        "error_vdw": None if np.isnan(error_vdw) else round(float(error_vdw), 4),
+                        "high_error": bool(error_el > threshold or error_vdw > threshold)})
+    return results
 
-    # Create output folder if it doesn't exist
-    output_dir = "individual_plots"
+def write_reports(results, output_dir, threshold=1.0, equilibrate=False, error_method="halves"):
+    """
+    Writes the per-run errors to high_errors_report.json and high_errors_report.csv,
+    and the runs with errors above threshold to the text summary
+    high_errors_report.txt, in output_dir.
+
+    Returns:
+        list: Text messages of the runs with high errors.
+    """
     os.makedirs(output_dir, exist_ok=True)
+    base = os.path.join(output_dir, "high_errors_report")
 
-    output_file = os.path.join(output_dir, "high_errors_report.txt")
-    with open(output_file, "w") as f:
-        f.write("Production log files with errors greater than 1 kcal/mol\n")
+    with open(base + ".json", "w") as f:
+        json.dump({"threshold": threshold, "error_method": error_method, "equilibrate": equilibrate,
+                   "runs": results}, f, indent=1)
+
+    with open(base + ".csv", "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=REPORT_COLUMNS)
+        writer.writeheader()
+        writer.writerows(results)
+
+    messages = []
+    for result in results:
+        for error_type, key in (("vdW", "error_vdw"), ("Electrostatic", "error_el")):
+            if result[key] is not None and result[key] > threshold:
+                msg = (f"File: {result['path']}\n"
+                       f"Error type: {error_type} = {result[key]:.2f} kcal/mol\n")
+                if equilibrate:
+                    msg += f"Equilibration discarded up to step: {result['eq_cut']}\n"
+                msg += f"Recommendation: Extend the MD simulation until the error is below {threshold:g} kcal/mol.\n\n"
+                messages.append(msg)
+
+    with open(base + ".txt", "w") as f:
+        f.write(f"Production log files with errors greater than {threshold:g} kcal/mol\n")
         f.write("-------------------------------------------------------\n\n")
-        for filename, error_type, value in high_errors:
-            msg = (f"File: {filename}\n"
-                   f"Error type: {error_type} = {value:.2f} kcal/mol\n"
-                   "Recommendation: Extend the MD simulation until the error is below 1 kcal/mol.\n\n")
-            print(msg)
-            f.write(msg)
+        f.writelines(messages)
+    return messages
+
+def main(energy_source="log", error_method="halves", equilibrate=False, manifest=None, ligand_base="ligands",
+         complex_base="complex", systems=("complex",), workers=None, threshold=1.0, output_dir="individual_plots"):
+    """
+    Main function that finds the production runs of every ligand, pose and replica,
+    calculates the errors in electrostatic and vdW energies, and writes a report
+    of every run, flagging the runs where the error exceeds threshold (1 kcal/mol).
+
+    Runs are taken from a manifest (columns id, ligand_dir, complex_dir) or found by
+    scanning the ligand_base/ligand_# and complex_base/complex_# folders, and only
+    the systems given ("ligand", "complex") are checked. All logs are read at once
+    across workers processes.
+    With energy_source="en" the binary .en file of each run is read instead of its log.
+    error_method selects how the error is estimated: "halves" (difference between the
+    two halves of the trajectory) or "acf" (autocorrelation-based standard error).
+    With equilibrate the equilibration region of each run is discarded before
+    estimating the error, and the first step kept is reported.
+
+    The report suggests extending the MD simulation until the error is below threshold.
+    """
+    runs = manifest_runs(manifest) if manifest else scan_runs(ligand_base, complex_base)
+    runs = [run for run in runs if run["system"] in systems]
+
+    if not runs:
+        print("No .log files found to process.")
+        return
+
+    results = check_runs(runs, energy_source, error_method, equilibrate, workers, threshold)
+    messages = write_reports(results, output_dir, threshold, equilibrate, error_method)
+
+    if not messages:
+        print(f"No errors greater than {threshold:g} kcal/mol found in the {len(results)} analyzed simulations.")
+    for msg in messages:
+        print(msg)
+    print(f"Errors of {len(results)} runs saved to {os.path.join(output_dir, 'high_errors_report')}.json/.csv/.txt")
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Report production runs with Q-surr. energy errors above 1 kcal/mol")
+    parser.add_argument("--energy_source", choices=["log", "en"], default="log",
+                        help="Read energies from the .log files or from the binary Qdyn .en files")
+    parser.add_argument("--error_method", choices=sorted(ERROR_METHODS), default="halves",
+                        help="Error estimate: half-trajectory difference or FFT autocorrelation standard error")
+    parser.add_argument("--equilibrate", action="store_true",
+                        help="Discard the detected equilibration region of each run before estimating errors")
+    parser.add_argument("--manifest", default=None,
+                        help="CSV with columns id,ligand_dir,complex_dir (default: scan --ligand_base and --complex_base)")
+    parser.add_argument("--ligand_base", default="ligands", help="Folder with the ligand_# folders to scan")
+    parser.add_argument("--complex_base", default="complex", help="Folder with the complex_# folders to scan")
+    parser.add_argument("--systems", nargs="+", choices=["ligand", "complex"], default=["complex"],
+                        help="Systems whose runs are checked")
+    parser.add_argument("--threshold", type=float, default=1.0, help="Error (kcal/mol) above which a run is flagged")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Worker processes to read logs (default: CPUs allocated by SLURM)")
+    parser.add_argument("--output_dir", default="individual_plots",
+                        help="Folder of the high_errors_report .json, .csv and .txt files")
+    mdle.add_cache_arguments(parser)
+
+    args = parser.parse_args()
+    mdle.configure_cache_from_args(args)
+    main(args.energy_source, args.error_method, args.equilibrate, args.manifest, args.ligand_base,
+         args.complex_base, args.systems, args.workers, args.threshold, args.output_dir)
 
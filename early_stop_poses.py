@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+"""
+Stops production of docking poses that cannot become the best pose.
+
+While the complex runs of every pose and replica are going, this script
+polls their logs (parsing only what was appended since the previous poll,
+see mdlog_energies.tail_q_energies), computes the running ΔG of every pose
+pooled over its replicas and tests it against the best pose of the same
+ligand (lie_engine.sequential_pose_test). When a pose is worse than the best
+one by more than --margin beyond a boundary that is stricter early in the
+run, a stop marker is written to the folder of every replica of that pose
+still running, the pose is added to the stop list and the SLURM jobs to
+cancel are printed. The rule is a heuristic: --confidence sets how strict the
+boundary is, it does not bound the rate of wrongly stopped poses.
+
+Qdyn does not read the marker: check it in the production script before
+starting the next replica, e.g.
+
+    [ -f complex_$n/2/LIE_STOP ] || Qdyn6 production2_$n.inp > complex_$n/2/production2_$n.log
+
+and cancel the listed jobs (job_id column of the manifest, a template that
+may use {ligand}, {pose} and {replica}, e.g. 812345_{pose}) with scancel.
+
+Usage:
+    python early_stop_poses.py --manifest results/poses_manifest.csv --alpha 0.68 --beta 0.11 --margin 1.5
+"""
+
+import argparse
+import csv
+import os
+import time
+
+import numpy as np
+
+import analyze_LIE_noqgui as lie
+import energy_store
+import lie_engine
+import mdlog_energies as mdle
+
+STOP_COLUMNS = ('ligand', 'pose', 'step', 'fraction', 'dG', 'dG_stderr', 'dG_best', 'best_pose',
+                'z', 'boundary', 'markers', 'job_ids')
+
+
+class RunPoller:
+    """Energies of many logs, re-reading only the logs that are still running."""
+
+    def __init__(self):
+        self.finished = {}
+        self.nsteps = {}
+
+    def poll(self, path):
+        """Returns (steps, energies, finished, planned steps) of one log."""
+        if path not in self.finished:
+            steps, energies, finished = mdle.tail_q_energies(path)
+            if finished:
+                self.finished[path] = (steps, energies)
+        else:
+            steps, energies = self.finished[path]
+            finished = True
+        if path not in self.nsteps:
+            self.nsteps[path] = mdle.read_run_info(path)['nsteps']
+        return steps, energies, finished, self.nsteps[path]
+
+
+def pose_estimates(entries, poller, error_method="blocks", alpha=0.18, beta=0.50, gamma=0.0):
+    """
+    Running ΔG of every pose of the manifest entries. Returns (ligands,
+    poses, dg, dg_stderr, fraction, runs) with arrays shaped (ligand, pose),
+    NaN for poses without ligand and complex Q-energies; fraction is the
+    part of the planned complex production written so far and runs maps
+    (ligand, pose) to the complex runs with their last step and state.
+    """
+    systems = {}
+    for entry in entries:
+        for run in energy_store.discover_runs(entry['id'], entry['ligand_dir'], entry['complex_dir']):
+            steps, energies, finished, nsteps = poller.poll(run['path'])
+            if len(steps) == 0:
+                continue
+            pose = systems.setdefault((run['ligand'], run['pose']), {'ligand': [], 'complex': [], 'runs': []})
+            pose[run['system']].append(energies)
+            if run['system'] == 'complex':
+                pose['runs'].append(dict(run, step=int(steps[-1]), nsteps=nsteps, finished=finished))
+
+    keys = [key for key, pose in systems.items() if pose['ligand'] and pose['complex']]
+    ligands = list(dict.fromkeys(ligand for ligand, pose in keys))
+    poses = sorted({pose for ligand, pose in keys})
+
+    shape = (2, len(ligands), len(poses), len(lie_engine.TERMS))
+    ave, stderr = np.full(shape, np.nan), np.full(shape, np.nan)
+    fraction = np.full(shape[1:3], np.nan)
+    for ligand, pose in keys:
+        k, i = ligands.index(ligand), poses.index(pose)
+        for system, name in enumerate(('ligand', 'complex')):
+            qene, q_ave, q_stderr = mdle.q_energy_statistics(systems[(ligand, pose)][name], error_method)
+            ave[system, k, i] = lie_engine.terms_from_qterms(q_ave)
+            stderr[system, k, i] = lie_engine.terms_from_qterms(q_stderr)
+        runs = systems[(ligand, pose)]['runs']
+        fraction[k, i] = np.mean([1.0 if run['finished'] or not run['nsteps'] else run['step'] / run['nsteps']
+                                  for run in runs])
+
+    dg, dg_stderr = lie_engine.compute_dg(ave[0], stderr[0], ave[1], stderr[1], alpha, beta, gamma)
+    return ligands, poses, dg, dg_stderr, fraction, {key: systems[key]['runs'] for key in keys}
+
+
+def job_ids(entry, runs):
+    """SLURM job IDs of the runs from the job_id template of the manifest entry."""
+    template = (entry.get('job_id') or '').strip()
+    if not template:
+        return []
+    return list(dict.fromkeys(template.format(ligand=run['ligand'], pose=run['pose'], replica=run['replica'])
+                              for run in runs))
+
+
+def write_markers(runs, marker, reason):
+    """Writes the stop marker next to the log of every run still going."""
+    paths = []
+    for run in runs:
+        if run['finished']:
+            continue
+        path = os.path.join(os.path.dirname(run['path']), marker)
+        with open(path, 'w') as f:
+            f.write(reason + '\n')
+        paths.append(path)
+    return paths
+
+
+def check(entries, poller, stopped, args):
+    """One poll of all runs. Returns the new stop rows and whether runs are still going."""
+    ligands, poses, dg, dg_stderr, fraction, runs = pose_estimates(
+        entries, poller, args.error_method, args.alpha, args.beta, args.gamma)
+    if not ligands:
+        return [], True
+
+    z, boundary, stop = lie_engine.sequential_pose_test(dg, dg_stderr, fraction, args.margin, args.confidence)
+    stop &= fraction >= args.min_fraction
+    best = np.argmin(np.where(np.isnan(dg), np.inf, dg), axis=1)
+    manifest = {entry['id']: entry for entry in entries}
+
+    #Poses already marked by an earlier check, and poses whose runs have all finished, are left alone
+    for key, pose_runs in runs.items():
+        if any(os.path.isfile(os.path.join(os.path.dirname(run['path']), args.marker)) for run in pose_runs):
+            stopped.add(key)
+
+    rows = []
+    for k, i in zip(*np.nonzero(stop)):
+        key = (ligands[k], poses[i])
+        if key in stopped or all(run['finished'] for run in runs[key]):
+            continue
+        stopped.add(key)
+        b = best[k]
+        reason = (f"{ligands[k]} pose {poses[i]}: ΔG = {dg[k, i]:.2f} ± {dg_stderr[k, i]:.2f} kcal/mol, "
+                  f"best pose {poses[b]} ΔG = {dg[k, b]:.2f} ± {dg_stderr[k, b]:.2f} kcal/mol "
+                  f"(z = {z[k, i]:.2f} > {boundary[k, i]:.2f} at {fraction[k, i]:.0%} of production)")
+        markers = [] if args.dry_run else write_markers(runs[key], args.marker, reason)
+        jobs = job_ids(manifest[ligands[k]], [run for run in runs[key] if not run['finished']])
+        rows.append([ligands[k], poses[i], max(run['step'] for run in runs[key]), round(fraction[k, i], 3),
+                     round(dg[k, i], 2), round(dg_stderr[k, i], 2), round(dg[k, b], 2), poses[b],
+                     round(z[k, i], 2), round(boundary[k, i], 2), ' '.join(markers), ' '.join(jobs)])
+        print(f"Stop {reason}")
+        if jobs:
+            print(f"   scancel {' '.join(jobs)}")
+
+    running = any(not run['finished'] for key, pose_runs in runs.items() if key not in stopped for run in pose_runs)
+    return rows, running
+
+
+def main(args):
+    entries = lie.read_manifest(args.manifest)
+    poller = RunPoller()
+    stopped = set()
+
+    new_file = not os.path.isfile(args.output)
+    with open(args.output, 'a', newline='') as f:
+        writer = csv.writer(f)
+        if new_file:
+            writer.writerow(STOP_COLUMNS)
+        while True:
+            rows, running = check(entries, poller, stopped, args)
+            writer.writerows(rows)
+            f.flush()
+            if args.once or not running:
+                break
+            time.sleep(args.interval)
+
+    print(f"{len(stopped)} poses stopped, listed in {args.output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stop production of poses clearly worse than the best pose")
+    parser.add_argument("--manifest", required=True,
+                        help="CSV with columns id,ligand_dir,complex_dir[,job_id] (as for analyze_LIE_noqgui.py)")
+    parser.add_argument("--alpha", type=float, default=0.18, help="Alpha parameter")
+    parser.add_argument("--beta", type=float, default=0.50, help="Beta parameter")
+    parser.add_argument("--gamma", type=float, default=0.00, help="Gamma parameter")
+    parser.add_argument("--margin", type=float, default=1.0,
+                        help="Stop poses worse than the best pose of the ligand by more than this (kcal/mol)")
+    parser.add_argument("--confidence", type=float, default=0.99,
+                        help="Normal quantile level of the stopping boundary (sets its strictness, not an error rate)")
+    parser.add_argument("--min_fraction", type=float, default=0.1,
+                        help="Do not stop poses before this fraction of the production is written")
+    parser.add_argument("--error_method", choices=sorted(mdle.ERROR_METHODS), default="blocks",
+                        help="Standard error estimator of the mean energies")
+    parser.add_argument("--interval", type=float, default=300, help="Seconds between polls of the logs")
+    parser.add_argument("--once", action="store_true", help="Check once and exit")
+    parser.add_argument("--marker", default="LIE_STOP", help="Name of the stop marker written in the replica folders")
+    parser.add_argument("--dry_run", action="store_true", help="List the poses to stop without writing markers")
+    parser.add_argument("--output", default="LIE_early_stop.csv", help="CSV the stopped poses are appended to")
+
+    mdle.add_cache_arguments(parser)
+
+    args = parser.parse_args()
+    mdle.configure_cache_from_args(args)
+    main(args)
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+"""
+Columnar store of the Q-atom energies of a whole LIE campaign.
+
+The store is a directory with one .npy file per column and a store.json
+description:
+
+    ligand, system, pose, replica, segment, step    index columns
+    qq_el, qq_vdw, ..., qany_imp                    mdlog_energies.QCOLUMNS
+
+Rows of one run (one log: ligand x system x pose x replica x segment) are
+contiguous, and store.json lists the row range of every run. Columns are
+opened memory-mapped, so reading a store does not parse logs and only the
+pages of the columns and runs that are sliced are loaded.
+
+Build a store from the ligand manifest used by analyze_LIE_noqgui.py:
+
+    python energy_store.py --manifest results/ligands_manifest.csv --store results/energy_store
+
+Ligand and complex directories may hold replica folders with .log files
+(ligand_#/1/*.log, ligand_#/2/*.log), or pose folders with replica folders
+(ligand/pose1/1/*.log) as in analysis-by-R-P. Several logs in one replica
+folder are stored as consecutive segments of that replica.
+"""
+
+import argparse
+import csv
+import json
+import os
+import re
+
+import numpy as np
+
+import mdlog_energies as mdle
+
+STORE_VERSION = 1
+SYSTEMS = ('ligand', 'complex')
+INDEX_COLUMNS = (('ligand', '<i4'), ('system', '<i1'), ('pose', '<i2'),
+                 ('replica', '<i2'), ('segment', '<i2'), ('step', '<i8'))
+ENERGY_DTYPE = '<f8'
+
+
+def _numbered_dirs(path):
+    """Subdirectories of path with their number (pose3 -> 3, 2 -> 2), sorted."""
+    dirs = []
+    for index, name in enumerate(sorted(d for d in os.listdir(path)
+                                        if os.path.isdir(os.path.join(path, d))), start=1):
+        match = re.search(r'(\d+)$', name)
+        dirs.append((int(match.group(1)) if match else index, os.path.join(path, name)))
+    return sorted(dirs)
+
+
+def discover_runs(ligand_id, ligand_dir, complex_dir):
+    """
+    Lists the runs (logs) of one ligand as dicts with ligand, system, pose,
+    replica, segment and path.
+    """
+    runs = []
+    for system, path in zip(SYSTEMS, (ligand_dir, complex_dir)):
+        if not os.path.isdir(path):
+            continue
+        subdirs = _numbered_dirs(path)
+        if subdirs and all(os.path.basename(d).startswith('pose') for n, d in subdirs):
+            poses = subdirs
+        else:
+            poses = [(1, path)]
+
+        for pose, pose_dir in poses:
+            for replica, replica_dir in _numbered_dirs(pose_dir):
+                logs = sorted(f for f in os.listdir(replica_dir) if f.endswith('.log'))
+                for segment, log in enumerate(logs, start=1):
+                    runs.append({'ligand': ligand_id, 'system': system, 'pose': pose,
+                                 'replica': replica, 'segment': segment,
+                                 'path': os.path.join(replica_dir, log)})
+    return runs
+
+
+def _header(dtype, rows):
+    return {'descr': np.lib.format.dtype_to_descr(np.dtype(dtype)),
+            'fortran_order': False,
+            'shape': (rows,)}
+
+
+def _open_column(path, dtype):
+    """Starts a .npy file whose length is written by _close_column()."""
+    f = open(path, 'wb')
+    np.lib.format.write_array_header_1_0(f, _header(dtype, 0))
+    return f
+
+
+def _close_column(f, dtype, rows):
+    #The header is padded to a fixed size, so the final shape fits in place
+    data_start = f.tell() - rows * np.dtype(dtype).itemsize
+    f.seek(0)
+    np.lib.format.write_array_header_1_0(f, _header(dtype, rows))
+    if f.tell() != data_start:
+        raise RuntimeError(f"{f.name}: header size changed while writing the store")
+    f.close()
+
+
+def build_store(directory, runs, lambda_='1.00', workers=None, chunk=64):
+    """
+    Parses the logs of runs (see discover_runs()) and writes them to a store
+    in directory. Logs are read chunk runs at a time across a process pool,
+    so memory use does not grow with the campaign size.
+    """
+    os.makedirs(directory, exist_ok=True)
+
+    ligands = []
+    for run in runs:
+        if run['ligand'] not in ligands:
+            ligands.append(run['ligand'])
+    codes = {ligand: i for i, ligand in enumerate(ligands)}
+
+    dtypes = dict(INDEX_COLUMNS)
+    dtypes.update((name, ENERGY_DTYPE) for name in mdle.QCOLUMNS)
+    files = {name: _open_column(os.path.join(directory, name + '.npy'), dtype)
+             for name, dtype in dtypes.items()}
+
+    rows = 0
+    stored = []
+    try:
+        for first in range(0, len(runs), chunk):
+            batch = runs[first:first + chunk]
+            parsed = mdle.read_q_energies_parallel([run['path'] for run in batch], lambda_, workers)
+            for run, (steps, energies) in zip(batch, parsed):
+                n = len(steps)
+                index = {'ligand': codes[run['ligand']], 'system': SYSTEMS.index(run['system']),
+                         'pose': run['pose'], 'replica': run['replica'], 'segment': run['segment']}
+                for name, value in index.items():
+                    files[name].write(np.full(n, value, dtype=dtypes[name]).tobytes())
+                files['step'].write(np.asarray(steps, dtype=dtypes['step']).tobytes())
+                for j, name in enumerate(mdle.QCOLUMNS):
+                    files[name].write(np.ascontiguousarray(energies[:, j], dtype=ENERGY_DTYPE).tobytes())
+
+                stored.append(dict(run, start=rows, stop=rows + n))
+                rows += n
+    finally:
+        for name, f in files.items():
+            _close_column(f, dtypes[name], rows)
+
+    meta = {'version': STORE_VERSION,
+            'lambda': float(lambda_),
+            'rows': rows,
+            'ligands': ligands,
+            'systems': list(SYSTEMS),
+            'columns': [name for name, dtype in INDEX_COLUMNS] + list(mdle.QCOLUMNS),
+            'runs': stored}
+    with open(os.path.join(directory, 'store.json'), 'w') as f:
+        json.dump(meta, f, indent=1)
+
+    return meta
+
+
+def open_store(directory):
+    """
+    Opens a store. Returns its store.json description with a 'columns_data'
+    dict of read-only, memory-mapped column arrays.
+    """
+    with open(os.path.join(directory, 'store.json')) as f:
+        store = json.load(f)
+    if store['version'] != STORE_VERSION:
+        raise ValueError(f"{directory}: store version {store['version']} is not supported")
+
+    mode = 'r' if store['rows'] > 0 else None
+    store['columns_data'] = {name: np.load(os.path.join(directory, name + '.npy'), mmap_mode=mode)
+                             for name in store['columns']}
+    return store
+
+
+def select_runs(store, ligand=None, system=None, pose=None, replica=None, segment=None):
+    """Runs of the store matching all the given criteria."""
+    criteria = {'ligand': ligand, 'system': system, 'pose': pose,
+                'replica': replica, 'segment': segment}
+    return [run for run in store['runs']
+            if all(value is None or run[key] == value for key, value in criteria.items())]
+
+
+def run_column(store, run, name):
+    """Zero-copy view of one column of one run."""
+    return store['columns_data'][name][run['start']:run['stop']]
+
+
+def run_energies(store, run):
+    """(steps, energies) of one run in the layout of mdlog_energies.read_q_energies()."""
+    energies = np.column_stack([run_column(store, run, name) for name in mdle.QCOLUMNS])
+    return np.asarray(run_column(store, run, 'step')), energies
+
+
+def read_manifest(manifest):
+    with open(manifest, newline='') as f:
+        return list(csv.DictReader(f))
+
+
+def main(manifest, directory, lambda_, workers):
+    runs = []
+    for entry in read_manifest(manifest):
+        ligand_runs = discover_runs(entry['id'], entry['ligand_dir'], entry['complex_dir'])
+        if not ligand_runs:
+            print(f"{entry['id']}: no .log files found, skipped.")
+        runs.extend(ligand_runs)
+
+    meta = build_store(directory, runs, lambda_, workers)
+    print(f"Stored {meta['rows']} rows of {len(meta['runs'])} runs "
+          f"({len(meta['ligands'])} ligands) in {directory}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build a columnar Q-energy store for a LIE campaign")
+    parser.add_argument('--manifest', required=True,
+                        help='CSV with columns id,ligand_dir,complex_dir (as for analyze_LIE_noqgui.py)')
+    parser.add_argument('--store', default='energy_store', help='Output store directory')
+    parser.add_argument('--lambda', dest='lambda_', default='1.00', help='Lambda of the Q-energies to store')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Worker processes (default: CPUs allocated by SLURM)')
+    mdle.add_cache_arguments(parser)
+
+    args = parser.parse_args()
+    mdle.configure_cache_from_args(args)
+
+    main(args.manifest, args.store, args.lambda_, args.workers)
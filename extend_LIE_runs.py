@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+"""
+Predicts how long every flagged run must be extended and writes the Qdyn
+inputs that continue it.
+
+check_high_errors.py only says that a run must be extended until its
+Q-surr. error is below 1 kcal/mol. For every replica (segments joined) of
+every ligand, pose and system whose el or vdW error is above --threshold,
+this script predicts the length needed from the decay of the error of
+the mean with the effective number of samples,
+
+    error = c N_eff^b,    N_eff = N / tau
+
+anchored at the current error (tau, the integrated autocorrelation time,
+kept at its current value), so N_target = N (error / threshold)^(-1/b). The
+exponent b is fitted to the errors of growing prefixes of the run (a
+quarter, half, three quarters and all of it) and reported in the decay
+column; it is clipped to at most -0.5, the 1/sqrt(N_eff) decay of the
+standard error of a stationary run, so a run whose error does not decay
+(near zero or above: the energies drift and it needs to equilibrate rather
+than a longer average) is still given the 1/sqrt(N_eff) extension. The
+samples are converted to MD steps with the energy print-out interval of the
+log and rounded up to --round_steps.
+
+The default error is the autocorrelation standard error (acf), the error
+the model describes. With --error_method halves (the half-trajectory
+difference of check_high_errors.py) the errors are single noisy
+differences that do not follow the decay law, and the predicted
+extensions are only a rough guide.
+
+The continuation of a replica restarts from the final coordinates (.re) of
+its last segment. Its input is the input of that segment (found by the
+name in the log, in the folder Qdyn was run from) or the --ligand_template
+or --complex_template input, with the number of steps replaced,
+initial_temperature switched off, so velocities are read from the
+restart, and numbered final, trajectory and energy files
+(prod1_complex_1.re -> prod1_complex_1_ext01.re -> ..._ext02.re). The
+log of the continuation goes to the replica folder, after the existing
+segments, so the analysis scripts join it to the run. One SLURM array
+script (extend_runs.sh) per run folder runs all the continuations:
+
+    python extend_LIE_runs.py --systems ligand complex
+    cd complex && sbatch extend_runs.sh
+"""
+
+import argparse
+import csv
+import os
+import re
+
+import numpy as np
+
+import check_high_errors
+import mdlog_energies as mdle
+
+EXTENSION_COLUMNS = ('ligand', 'system', 'pose', 'replica', 'segments', 'samples', 'tau', 'error_el',
+                     'error_vdw', 'decay', 'target_samples', 'extension_steps', 'predicted_el', 'predicted_vdw',
+                     'input', 'log')
+
+#Fractions of every run the error decay is fitted on
+PREFIXES = (0.25, 0.5, 0.75, 1.0)
+
+#Files of the [files] section and the log lines that echo them
+LOG_FILES = {'topology': 'Topology file', 'restart': 'Initial coord. file', 'final': 'Final coord. file',
+             'trajectory': 'Trajectory file', 'energy': 'Energy output file', 'fep': 'FEP input file'}
+
+_HEAD_BYTES = 16384
+
+
+def read_log_files(logfile):
+    """
+    Input file and [files] of a Qdyn run, from the echo at the top of its log.
+    Returns a dict with 'input' and the LOG_FILES keys (missing ones None).
+    """
+    with open(logfile, 'rb') as f:
+        head = f.read(_HEAD_BYTES).decode(errors='replace')
+    match = re.search(r'Reading input from (\S+)', head)
+    files = {'input': match.group(1) if match else None}
+    for key, label in LOG_FILES.items():
+        match = re.search(r'^' + re.escape(label) + r'\s*=\s*(\S+)', head, re.MULTILINE)
+        files[key] = match.group(1) if match else None
+    return files
+
+
+def replica_runs(runs):
+    """Groups runs by (ligand, system, pose, replica), segments in order."""
+    replicas = {}
+    for run in sorted(runs, key=lambda run: run['segment']):
+        replicas.setdefault((run['ligand'], run['system'], run['pose'], run['replica']), []).append(run)
+    return replicas
+
+
+def error_decay(series, error_method="halves"):
+    """
+    Exponent b of error ~ N_eff^b fitted (log-log least squares) to the
+    errors of the PREFIXES of the el and vdW series, N_eff = N / tau with
+    tau of every prefix. About -0.5 for a stationary run; near zero or
+    positive when the energies drift. NaN with fewer than two prefixes.
+    """
+    n = series.shape[-1]
+    compute_error = check_high_errors.ERROR_METHODS[error_method]
+    points = []
+    for fraction in PREFIXES:
+        m = int(n * fraction)
+        if m < 8:
+            continue
+        error_vdw, error_el = compute_error(series[0, :m], series[1, :m])
+        points.append((np.log(mdle.effective_sample_size(series[:, :m])), np.log([error_el, error_vdw])))
+    if len(points) < 2:
+        return np.full(2, np.nan)
+
+    x = np.array([point[0] for point in points])
+    y = np.array([point[1] for point in points])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dx = x - x.mean(axis=0)
+        return np.sum(dx * (y - y.mean(axis=0)), axis=0) / np.sum(dx ** 2, axis=0)
+
+
+def decay_exponent(decay):
+    """Fitted decay exponents clipped to at most -0.5 (-0.5 where they could not be fitted)."""
+    decay = np.asarray(decay, dtype=float)
+    return np.minimum(np.where(np.isnan(decay), -0.5, decay), -0.5)
+
+
+def predict_extension(series, errors, threshold=1.0, decay=-0.5):
+    """
+    Samples the el and vdW series need for both errors to fall below
+    threshold, from error = c N_eff^b anchored at the current errors:
+    N_target = N * (error / threshold)^(-1/b), tau kept at its current
+    value, b the decay exponents clipped by decay_exponent().
+    Returns (target samples, tau, predicted el and vdW errors at that length).
+    """
+    n = series.shape[-1]
+    errors = np.asarray(errors, dtype=float)
+    b = decay_exponent(decay)
+    tau = mdle.autocorrelation_time(series)
+    samples = int(max(n, np.max(np.ceil(n * (errors / threshold) ** (-1 / b)))))
+    return samples, float(np.max(tau)), errors * (samples / n) ** b
+
+
+def numbered(name, number):
+    """prod1_1.re -> prod1_1_ext01.re; an existing _extNN suffix is replaced."""
+    root, ext = os.path.splitext(name)
+    root = re.sub(r'_ext\d+$', '', root)
+    return f"{root}_ext{number:02d}{ext}"
+
+
+def extension_number(logfile):
+    match = re.search(r'_ext(\d+)$', os.path.splitext(os.path.basename(logfile))[0])
+    return int(match.group(1)) + 1 if match else 1
+
+
+def continuation_input(content, steps, files):
+    """
+    Qdyn input continuing a run: steps replaced, initial_temperature
+    commented out and the given [files] entries replaced (or added).
+    """
+    content = re.sub(r'^(\s*steps\s+)\d+[^\n]*', lambda m: f"{m.group(1)}{steps}", content, count=1,
+                     flags=re.MULTILINE)
+    content = re.sub(r'^(\s*)(initial_temperature\b)', r'\1!\2', content, flags=re.MULTILINE)
+
+    sections = re.split(r'^(?=\[)', content, flags=re.MULTILINE)
+    for k, section in enumerate(sections):
+        if not section.startswith('[files]'):
+            continue
+        for key, value in files.items():
+            pattern = r'^(\s*' + re.escape(key) + r'\s+)\S+'
+            if re.search(pattern, section, re.MULTILINE):
+                section = re.sub(pattern, lambda m: m.group(1) + value, section, count=1, flags=re.MULTILINE)
+            else:
+                section = section.rstrip('\n') + f"\n{key:<25}{value:>25}\n\n"
+        sections[k] = section
+    return ''.join(sections)
+
+
+def run_folder(run):
+    """
+    Folder Qdyn was run from: the parent of the ligand_#/complex_# folder
+    (as with production.sh), above the replica and pose folders.
+    """
+    folder = os.path.dirname(os.path.dirname(run['path']))
+    if os.path.basename(folder).startswith('pose'):
+        folder = os.path.dirname(folder)
+    return os.path.dirname(folder)
+
+
+def slurm_header(folder, tasks, job_name="LIE-ext"):
+    """SBATCH lines of production.sh in folder (array resized to the tasks), or a minimal header."""
+    lines = []
+    production = os.path.join(folder, 'production.sh')
+    if os.path.isfile(production):
+        with open(production) as f:
+            lines = [line.rstrip('\n') for line in f if line.startswith('#SBATCH') and '--array' not in line]
+    if not lines:
+        lines = [f"#SBATCH --job-name={job_name}", "#SBATCH -N 1", "#SBATCH -n 1", "#SBATCH --cpus-per-task=1"]
+    return lines + [f"#SBATCH --array=1-{tasks}"]
+
+
+def write_job_script(folder, jobs, qdyn="Qdyn6"):
+    """Writes extend_runs.sh in folder, one array task per (input, log) pair."""
+    path = os.path.join(folder, 'extend_runs.sh')
+    with open(path, 'w') as f:
+        f.write("#!/bin/bash\n\n")
+        f.write("# ###### SLURM Resource Request Zone ############################\n#\n")
+        f.write('\n'.join(slurm_header(folder, len(jobs))) + "\n")
+        f.write("#\n#################################################################\n\n")
+        f.write("# ################## Module Load Zone ###########################\n\n")
+        f.write("# Extensiones generadas por extend_LIE_runs.py, una por tarea del array\n")
+        f.write("inputs=(" + ' '.join(inp for inp, log in jobs) + ")\n")
+        f.write("logs=(" + ' '.join(log for inp, log in jobs) + ")\n")
+        f.write("i=$((SLURM_ARRAY_TASK_ID - 1))\n\n")
+        f.write("# Ejecutar la extensión y escribir el log junto a los segmentos anteriores\n")
+        f.write('mkdir -p "$(dirname ${logs[$i]})"\n')
+        f.write(f"{qdyn} ${{inputs[$i]}} > ${{logs[$i]}}\n")
+    return path
+
+
+def extend_replica(segments, steps, template=None, dry_run=False):
+    """
+    Writes the continuation input of a replica. Returns (input path, log
+    path relative to the run folder) or None when the input or the restart
+    file is missing.
+    """
+    last = segments[-1]['path']
+    folder = run_folder(segments[-1])
+    files = read_log_files(last)
+    if not files['final']:
+        print(f"{last}: no final coordinate file in the log, skipped.")
+        return None
+    if not os.path.isfile(os.path.join(folder, files['final'])):
+        print(f"{last}: restart file {os.path.join(folder, files['final'])} not found, skipped.")
+        return None
+
+    source = os.path.join(folder, files['input']) if files['input'] else None
+    if not source or not os.path.isfile(source):
+        source = template
+    if not source or not os.path.isfile(source):
+        print(f"{last}: input {files['input']} not found in {folder} and no --template, skipped.")
+        return None
+    with open(source) as f:
+        content = f.read()
+
+    number = extension_number(last)
+    new_files = {key: value for key, value in files.items() if key in ('topology', 'fep') and value}
+    new_files['restart'] = files['final']
+    for key in ('final', 'trajectory', 'energy'):
+        if files[key]:
+            new_files[key] = numbered(files[key], number)
+
+    name = numbered(files['input'] or os.path.basename(source), number)
+    inp = os.path.join(folder, name)
+    log = os.path.relpath(os.path.join(os.path.dirname(last), numbered(os.path.basename(last), number)), folder)
+    if not dry_run:
+        with open(inp, 'w') as f:
+            f.write(continuation_input(content, steps, new_files))
+    return inp, log
+
+
+def main(args):
+    runs = (check_high_errors.manifest_runs(args.manifest) if args.manifest
+            else check_high_errors.scan_runs(args.ligand_base, args.complex_base))
+    runs = [run for run in runs if run['system'] in args.systems]
+    if not runs:
+        print("No .log files found to process.")
+        return
+
+    replicas = replica_runs(runs)
+    paths = [run['path'] for segments in replicas.values() for run in segments]
+    parsed = iter(mdle.read_q_energies_parallel(paths, workers=args.workers))
+    templates = {'ligand': args.ligand_template, 'complex': args.complex_template}
+
+    rows = []
+    jobs = {}
+    for (ligand, system, pose, replica), segments in replicas.items():
+        joined = [next(parsed) for run in segments]
+        steps = np.concatenate([seg_steps for seg_steps, seg_energies in joined])
+        energies = np.concatenate([seg_energies for seg_steps, seg_energies in joined])
+        elecs, vdws, cut = check_high_errors.qsurr_energies(steps, energies, args.equilibrate)
+        if len(elecs) < 2:
+            print(f"{segments[-1]['path']}: No Q-surr. energies found.")
+            continue
+        error_vdw, error_el = check_high_errors.ERROR_METHODS[args.error_method](elecs, vdws)
+        if not (error_el > args.threshold or error_vdw > args.threshold):
+            continue
+
+        info = mdle.read_run_info(segments[-1]['path'])
+        if not info['terminated']:
+            print(f"{segments[-1]['path']}: run not finished, skipped.")
+            continue
+        series = np.vstack([elecs, vdws])
+        decays = error_decay(series, args.error_method)
+        target, tau, predicted = predict_extension(series, (error_el, error_vdw), args.threshold, decays)
+        #Decay of the larger error, which sets the extension
+        decay = decays[0 if error_el >= error_vdw else 1]
+        interval = info['interval'] or 1
+        extension = int(np.ceil(max((target - len(elecs)) * interval, 1) / args.round_steps) * args.round_steps)
+        if args.max_steps and extension > args.max_steps:
+            extension = args.max_steps
+            predicted = (np.array([error_el, error_vdw]) *
+                         ((len(elecs) + extension // interval) / len(elecs)) ** decay_exponent(decays))
+
+        written = extend_replica(segments, extension, templates[system], args.dry_run)
+        inp, log = written if written else ('', '')
+        if written:
+            jobs.setdefault(os.path.dirname(inp), []).append((os.path.basename(inp), log))
+        rows.append([ligand, system, pose, replica, len(segments), len(elecs), round(tau, 1),
+                     round(float(error_el), 2), round(float(error_vdw), 2), round(float(decay), 2), target, extension,
+                     round(float(predicted[0]), 2), round(float(predicted[1]), 2), inp, log])
+        print(f"{ligand} {system} pose {pose} replica {replica}: el {error_el:.2f}, vdW {error_vdw:.2f} "
+              f"kcal/mol, extend {extension} steps -> el {predicted[0]:.2f}, vdW {predicted[1]:.2f}")
+
+    if not args.dry_run:
+        for folder, folder_jobs in jobs.items():
+            print(f"{len(folder_jobs)} continuations to run from {folder}: sbatch "
+                  f"{write_job_script(folder, folder_jobs, args.qdyn)}")
+
+    with open(args.output, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(EXTENSION_COLUMNS)
+        writer.writerows(rows)
+    print(f"{len(rows)} runs with errors above {args.threshold:g} kcal/mol listed in {args.output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Predict the extension of every flagged run and write its "
+                                                 "continuation input")
+    parser.add_argument("--manifest", default=None,
+                        help="CSV with columns id,ligand_dir,complex_dir (default: scan --ligand_base and --complex_base)")
+    parser.add_argument("--ligand_base", default="ligands", help="Folder with the ligand_# folders to scan")
+    parser.add_argument("--complex_base", default="complex", help="Folder with the complex_# folders to scan")
+    parser.add_argument("--systems", nargs="+", choices=["ligand", "complex"], default=["complex"],
+                        help="Systems whose runs are extended")
+    parser.add_argument("--error_method", choices=sorted(check_high_errors.ERROR_METHODS), default="acf",
+                        help="Error estimate: FFT autocorrelation standard error, or half-trajectory difference "
+                             "(a noisy single difference: the predicted extensions are only a rough guide)")
+    parser.add_argument("--equilibrate", action="store_true",
+                        help="Discard the detected equilibration region of each run before estimating errors")
+    parser.add_argument("--threshold", type=float, default=1.0, help="Target error (kcal/mol)")
+    parser.add_argument("--round_steps", type=int, default=1000, help="Round the extensions up to this many steps")
+    parser.add_argument("--max_steps", type=int, default=None, help="Longest extension of one run (steps)")
+    parser.add_argument("--ligand_template", default=None,
+                        help="Input used for ligand runs whose own input is not found (e.g. ligands/production.inp)")
+    parser.add_argument("--complex_template", default=None,
+                        help="Input used for complex runs whose own input is not found (e.g. complex/production.inp)")
+    parser.add_argument("--qdyn", default="Qdyn6", help="Qdyn executable of the job scripts")
+    parser.add_argument("--dry_run", action="store_true", help="Only predict, do not write inputs or job scripts")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Worker processes to read logs (default: CPUs allocated by SLURM)")
+    parser.add_argument("--output", default="LIE_extensions.csv", help="CSV with the predicted extension of every run")
+
+    mdle.add_cache_arguments(parser)
+
+    args = parser.parse_args()
+    mdle.configure_cache_from_args(args)
+    main(args)
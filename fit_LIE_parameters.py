@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""
+Fits the LIE parameters α, β and γ to the experimental ΔG of reference ligands.
+
+The mean ΔV_el and ΔV_vdW of every reference ligand (manifest rows with a
+dg_exp value) are read once, from the parsed-log cache or from an energy
+store, and then:
+
+- α, β and γ are fitted by weighted least squares in closed form, and
+- the fit is cross-validated by leave-one-out (closed form, from the hat
+  matrix) and by repeated random k-fold splits, and
+- MAE, RMSE and R² are evaluated on a dense α x β x γ grid in one
+  vectorized pass and saved as surfaces to an .npz file.
+
+Usage:
+    python fit_LIE_parameters.py --manifest results/ligands_manifest.csv \\
+        --alpha_grid 0 1 101 --beta_grid 0 1 101 --gamma_grid -10 10 81
+"""
+
+import argparse
+import csv
+import warnings
+
+import numpy as np
+import matplotlib.pyplot as plt
+
+import analyze_LIE_noqgui as lie
+import lie_engine
+import mdlog_energies as mdle
+
+FIT_COLUMNS = ('method', 'alpha', 'alpha_stderr', 'beta', 'beta_stderr', 'gamma', 'gamma_stderr',
+               'mae', 'rmse', 'r2', 'n_ligands')
+
+
+def load_references(manifest, energy_source="log", error_method="blocks", workers=None, store_dir=None,
+                    equilibrate=False):
+    """
+    Mean ΔV_el and ΔV_vdW of the reference ligands of the manifest.
+    Returns (entries, dv_el, dv_vdw, dv_el_stderr, dv_vdw_stderr).
+    """
+    entries = [entry for entry in lie.read_manifest(manifest) if entry['reference']]
+    runs, parsed = lie.load_batch_energies(entries, energy_source, workers, store_dir)
+    energies, cuts = lie.trim_energies(parsed, equilibrate)
+    ave, stderr = lie.batch_terms(runs, energies, error_method)
+    return ([entry for entry, first, n_lig, n_comp in runs],) + \
+        lie_engine.delta_energies(ave[0], stderr[0], ave[1], stderr[1])
+
+
+def fit_weights(entries, dv_el_stderr, dv_vdw_stderr, alpha, beta, mode):
+    """
+    Weights of the reference ligands in the fit: none, or the inverse variance
+    of ΔG_exp - ΔG_calc from the dg_exp_err manifest column and the ΔG error
+    propagated with the starting α and β.
+    """
+    if mode == "none":
+        return None
+    exp_err = np.array([float(entry.get('dg_exp_err') or 0.0) for entry in entries])
+    variance = exp_err ** 2 + beta ** 2 * dv_el_stderr ** 2 + alpha ** 2 * dv_vdw_stderr ** 2
+    if np.any(variance <= 0):
+        raise ValueError("Reference ligands without error estimates, use --weights none")
+    return 1.0 / variance
+
+
+def grid(spec):
+    start, stop, num = spec
+    return np.linspace(float(start), float(stop), int(num))
+
+
+def best_point(surface, alphas, betas, gammas, largest=False):
+    index = np.unravel_index(np.nanargmax(surface) if largest else np.nanargmin(surface), surface.shape)
+    return index, (alphas[index[0]], betas[index[1]], gammas[index[2]])
+
+
+def plot_surface(path, rmse, alphas, betas, gammas, index):
+    """RMSE over α and β at the γ of the best grid point."""
+    fig, ax = plt.subplots(figsize=(6, 5), dpi=150)
+    mesh = ax.pcolormesh(betas, alphas, rmse[:, :, index[2]], shading='auto', cmap='viridis')
+    ax.plot(betas[index[1]], alphas[index[0]], 'r+', markersize=12)
+    fig.colorbar(mesh, ax=ax, label='RMSE (kcal/mol)')
+    ax.set_xlabel('β')
+    ax.set_ylabel('α')
+    ax.set_title(f'LIE fit RMSE at γ = {gammas[index[2]]:.2f}')
+    fig.tight_layout()
+    fig.savefig(path)
+    plt.close(fig)
+
+
+def main(args):
+    entries, dv_el, dv_vdw, dv_el_stderr, dv_vdw_stderr = load_references(
+        args.manifest, args.energy_source, args.error_method, args.workers, args.store, args.equilibrate)
+    if len(entries) < 2:
+        print("At least two reference ligands with dg_exp are needed to fit LIE parameters.")
+        return
+    dg_exp = np.array([entry['dg_exp'] for entry in entries])
+    if np.all(dg_exp == 0):
+        #Manifests written by older versions of analyze_LIE_ligands.sh have 0.0 as a placeholder
+        print("All dg_exp values are 0.0: fill dg_exp only for ligands with a measured ΔG "
+              "and leave it empty for the others.")
+        return
+    weights = fit_weights(entries, dv_el_stderr, dv_vdw_stderr, args.alpha, args.beta, args.weights)
+
+    rows = []
+    fit = lie_engine.fit_parameters(dv_el, dv_vdw, dg_exp, weights, args.fix_gamma)
+    rows.append(['wls'] + [fit[name] for name in FIT_COLUMNS[1:-1]] + [len(entries)])
+
+    #Cross-validated errors of the same fit; R² of these rows is the predictive Q²
+    loo = lie_engine.loo_parameters(dv_el, dv_vdw, dg_exp, weights, args.fix_gamma)
+    loo['r2'] = loo['q2']
+    rows.append(['loo'] + [loo[name] for name in FIT_COLUMNS[1:-1]] + [len(entries)])
+    parameters = 3 if args.fix_gamma is None else 2
+    folds = lie_engine.kfold_count(len(entries), parameters, args.cv_folds) if args.cv_repeats > 0 else 0
+    if args.cv_repeats > 0 and not folds:
+        print(f"Warning: {len(entries)} reference ligands are too few for k-fold cross-validation of "
+              f"{parameters} parameters, k-fold skipped; use the loo row.")
+    elif folds and folds != args.cv_folds:
+        print(f"Warning: {folds}-fold instead of {args.cv_folds}-fold cross-validation, so that every training "
+              f"set of the {len(entries)} reference ligands keeps at least {parameters}.")
+    if folds:
+        kfold = lie_engine.kfold_parameters(dv_el, dv_vdw, dg_exp, weights, args.fix_gamma,
+                                            args.cv_folds, args.cv_repeats, args.seed)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            summary = {name: np.nanmean(kfold[name]) for name in ('alpha', 'beta', 'gamma', 'mae', 'rmse')}
+            summary['r2'] = np.nanmean(kfold['q2'])
+            rmse_spread = np.nanpercentile(kfold['rmse'], [5, 95])
+        summary.update((name, kfold[name]) for name in ('alpha_stderr', 'beta_stderr', 'gamma_stderr'))
+        rows.append(['kfold'] + [summary[name] for name in FIT_COLUMNS[1:-1]] + [len(entries)])
+
+    alphas, betas, gammas = grid(args.alpha_grid), grid(args.beta_grid), grid(args.gamma_grid)
+    mae, rmse, r2 = lie_engine.sweep_parameters(dv_el, dv_vdw, dg_exp, alphas, betas, gammas, weights)
+    for method, surface, largest in (('grid_mae', mae, False), ('grid_rmse', rmse, False), ('grid_r2', r2, True)):
+        index, (a, b, g) = best_point(surface, alphas, betas, gammas, largest)
+        rows.append([method, a, np.nan, b, np.nan, g, np.nan, mae[index], rmse[index], r2[index], len(entries)])
+
+    np.savez(args.surfaces, alphas=alphas, betas=betas, gammas=gammas, mae=mae, rmse=rmse, r2=r2,
+             ligands=np.array([entry['id'] for entry in entries]), dv_el=dv_el, dv_vdw=dv_vdw, dg_exp=dg_exp)
+
+    with open(args.output, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(FIT_COLUMNS)
+        writer.writerows([[row[0]] + [round(float(value), 4) for value in row[1:-1]] + [row[-1]]
+                          for row in rows])
+
+    for row in rows:
+        print(f"{row[0]:>9}: α = {row[1]:.3f} ± {row[2]:.3f}, β = {row[3]:.3f} ± {row[4]:.3f}, "
+              f"γ = {row[5]:.2f} ± {row[6]:.2f} | MAE = {row[7]:.2f}, RMSE = {row[8]:.2f}, R² = {row[9]:.3f}")
+    if folds:
+        print(f"{folds}-fold CV over {args.cv_repeats} random splits: "
+              f"RMSE 90% range {rmse_spread[0]:.2f} - {rmse_spread[1]:.2f} kcal/mol")
+    print(f"Fitted parameters saved to {args.output}, grid surfaces ({mae.size} points) to {args.surfaces}")
+
+    if args.plot:
+        index, point = best_point(rmse, alphas, betas, gammas)
+        plot_surface(args.plot, rmse, alphas, betas, gammas, index)
+        print(f"RMSE surface plot saved to {args.plot}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fit LIE α, β and γ to reference ligands")
+    parser.add_argument("--manifest", required=True,
+                        help="CSV with columns id,ligand_dir,complex_dir,dg_exp[,dg_exp_err]; rows with dg_exp are references")
+    parser.add_argument("--store", default=None, help="Read energies from a store built with energy_store.py")
+    parser.add_argument("--energy_source", choices=["log", "en"], default="log",
+                        help="Read energies from the .log files or from the Qdyn .en binary files")
+    parser.add_argument("--error_method", choices=sorted(mdle.ERROR_METHODS), default="blocks",
+                        help="Standard error estimator of the mean energies")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Worker processes to read logs (default: CPUs allocated by SLURM)")
+    parser.add_argument("--equilibrate", action="store_true",
+                        help="Discard the equilibration region of every run before averaging")
+    parser.add_argument("--alpha_grid", nargs=3, default=[0.0, 1.0, 101], metavar=("START", "STOP", "NUM"),
+                        help="α values of the grid")
+    parser.add_argument("--beta_grid", nargs=3, default=[0.0, 1.0, 101], metavar=("START", "STOP", "NUM"),
+                        help="β values of the grid")
+    parser.add_argument("--gamma_grid", nargs=3, default=[-10.0, 10.0, 81], metavar=("START", "STOP", "NUM"),
+                        help="γ values of the grid")
+    parser.add_argument("--fix_gamma", type=float, default=None,
+                        help="Keep γ fixed to this value in the least-squares fit")
+    parser.add_argument("--weights", choices=["none", "stderr"], default="none",
+                        help="Weight references by the inverse variance of dg_exp_err and the ΔG error")
+    parser.add_argument("--alpha", type=float, default=0.18, help="α used to propagate ΔG errors for --weights stderr")
+    parser.add_argument("--beta", type=float, default=0.50, help="β used to propagate ΔG errors for --weights stderr")
+    parser.add_argument("--cv_folds", type=int, default=5, help="Folds of the repeated k-fold cross-validation")
+    parser.add_argument("--cv_repeats", type=int, default=1000,
+                        help="Random k-fold splits to evaluate (0 to skip; leave-one-out is always reported)")
+    parser.add_argument("--seed", type=int, default=None, help="Seed of the k-fold splits")
+    parser.add_argument("--output", default="LIE_fit.csv", help="CSV with the fitted parameters and metrics")
+    parser.add_argument("--surfaces", default="LIE_fit_surfaces.npz", help="NPZ file with the MAE/RMSE/R² grids")
+    parser.add_argument("--plot", default=None, help="Save the RMSE(α, β) surface at the best γ to this image")
+
+    mdle.add_cache_arguments(parser)
+
+    args = parser.parse_args()
+    mdle.configure_cache_from_args(args)
+    main(args)
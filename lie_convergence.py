@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""
+Convergence of the LIE ΔG along the production runs.
+
+For every ligand, pose and replica the ligand-in-water and complex runs of
+the same replica are paired and ΔG(t) is computed at every output step from
+cumulative sums of their Q-wat/Q-prot el and vdW energies (see
+lie_engine.running_dg), in one pass per run:
+
+    forward   ΔG from the start of the run up to t
+    reverse   ΔG from t to the end of the run
+    sliding   ΔG over a window of samples ending at t
+
+A flat forward curve that meets the reverse curve means the run has
+converged; a drifting sliding curve means it has not.
+
+The curves are saved to one .npz file with NaN-padded arrays shaped
+(curve, sample) and, optionally, one plot per ligand:
+
+    python lie_convergence.py --manifest results/ligands_manifest.csv --plot_dir results/convergence
+    python lie_convergence.py --ligand_dir ligands/ligand_1 --complex_dir complex/complex_1 --ligand_name ligand_1
+"""
+
+import argparse
+import os
+
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+
+import energy_store
+import lie_engine
+import mdlog_energies as mdle
+
+
+def pair_runs(runs):
+    """
+    Groups the runs of energy_store.discover_runs() by (ligand, pose, replica)
+    with the paths of the ligand and complex segments of each, in order.
+    """
+    order = {ligand: i for i, ligand in enumerate(dict.fromkeys(run['ligand'] for run in runs))}
+    pairs = {}
+    for run in sorted(runs, key=lambda run: (order[run['ligand']], run['pose'], run['replica'], run['segment'])):
+        key = (run['ligand'], run['pose'], run['replica'])
+        pairs.setdefault(key, {'ligand': [], 'complex': []})[run['system']].append(run['path'])
+    return {key: paths for key, paths in pairs.items() if paths['ligand'] and paths['complex']}
+
+
+def join_segments(parsed):
+    """
+    Joins the (steps, energies) of consecutive segments of a replica; steps of
+    a later segment continue from the last step of the previous one.
+    """
+    steps, energies = [], []
+    offset = 0
+    for seg_steps, seg_energies in parsed:
+        steps.append(np.asarray(seg_steps) + offset)
+        energies.append(seg_energies)
+        if len(seg_steps):
+            offset = steps[-1][-1]
+    return np.concatenate(steps), np.concatenate(energies)
+
+
+def concatenate_segments(parsed):
+    """Joined steps (join_segments()) and LIE term series of the segments of a replica."""
+    steps, energies = join_segments(parsed)
+    return steps, lie_engine.terms_from_energies(energies)
+
+
+def convergence_curves(pairs, alpha, beta, gamma, window, energy_source="log", workers=None):
+    """
+    ΔG(t) curves of every pair of runs. Returns a dict with the ligand, pose
+    and replica of every curve and NaN-padded step and forward, reverse and
+    sliding arrays shaped (curve, sample).
+    """
+    files = []
+    for paths in pairs.values():
+        for system in ('ligand', 'complex'):
+            files.extend(mdle.to_energy_files(paths[system]) if energy_source == "en" else paths[system])
+    parsed = iter(mdle.read_q_energies_parallel(files, workers=workers))
+
+    curves = []
+    for key, paths in pairs.items():
+        lig_steps, lig_terms = concatenate_segments([next(parsed) for path in paths['ligand']])
+        comp_steps, comp_terms = concatenate_segments([next(parsed) for path in paths['complex']])
+        n = min(len(lig_steps), len(comp_steps))
+        curves.append((key, comp_steps[:n],
+                       [lie_engine.running_dg(lig_terms, comp_terms, alpha, beta, gamma, mode, window)
+                        for mode in lie_engine.RUNNING_MODES]))
+
+    length = max((len(steps) for key, steps, dg in curves), default=0)
+    result = {'ligand': np.array([key[0] for key, steps, dg in curves]),
+              'pose': np.array([key[1] for key, steps, dg in curves], dtype=int),
+              'replica': np.array([key[2] for key, steps, dg in curves], dtype=int),
+              'step': np.full((len(curves), length), -1, dtype=np.int64)}
+    for mode in lie_engine.RUNNING_MODES:
+        result[mode] = np.full((len(curves), length), np.nan, dtype=np.float32)
+    for k, (key, steps, dg) in enumerate(curves):
+        result['step'][k, :len(steps)] = steps
+        for mode, values in zip(lie_engine.RUNNING_MODES, dg):
+            result[mode][k, :len(steps)] = values
+    return result
+
+
+def plot_ligand(result, ligand, window, path):
+    """Forward, reverse and sliding ΔG(t) of every pose and replica of one ligand."""
+    styles = {'forward': '-', 'reverse': '--', 'sliding': ':'}
+    fig, ax = plt.subplots(figsize=(8, 5), dpi=150)
+    for k in np.flatnonzero(result['ligand'] == ligand):
+        valid = result['step'][k] >= 0
+        color = None
+        for mode in lie_engine.RUNNING_MODES:
+            line, = ax.plot(result['step'][k, valid], result[mode][k, valid], styles[mode], color=color,
+                            linewidth=1, label=f"pose {result['pose'][k]} r{result['replica'][k]} {mode}")
+            color = line.get_color()
+    ax.set_xlabel('Step')
+    ax.set_ylabel('ΔG (kcal/mol)')
+    ax.set_title(f'{ligand}: running ΔG (sliding window {window} samples)')
+    ax.legend(fontsize=6, ncol=3)
+    fig.tight_layout()
+    fig.savefig(path)
+    plt.close(fig)
+
+
+def main(args):
+    runs = []
+    if args.manifest:
+        for entry in energy_store.read_manifest(args.manifest):
+            runs.extend(energy_store.discover_runs(entry['id'], entry['ligand_dir'], entry['complex_dir']))
+    else:
+        runs = energy_store.discover_runs(args.ligand_name, args.ligand_dir, args.complex_dir)
+
+    pairs = pair_runs(runs)
+    if not pairs:
+        print("No ligand/complex replicas with .log files found.")
+        return
+
+    result = convergence_curves(pairs, args.alpha, args.beta, args.gamma, args.window,
+                                args.energy_source, args.workers)
+    np.savez_compressed(args.output, window=args.window, alpha=args.alpha, beta=args.beta, gamma=args.gamma,
+                        **result)
+
+    for k in range(len(result['ligand'])):
+        forward = result['forward'][k][~np.isnan(result['forward'][k])]
+        reverse = result['reverse'][k][~np.isnan(result['reverse'][k])]
+        print(f"{result['ligand'][k]} pose {result['pose'][k]} replica {result['replica'][k]}: "
+              f"ΔG = {forward[-1]:.2f} kcal/mol, forward - reverse at half run "
+              f"{forward[len(forward) // 2] - reverse[len(reverse) // 2]:+.2f} kcal/mol")
+    print(f"Convergence curves of {len(result['ligand'])} replicas saved to {args.output}")
+
+    if args.plot_dir:
+        os.makedirs(args.plot_dir, exist_ok=True)
+        for ligand in dict.fromkeys(result['ligand']):
+            plot_ligand(result, ligand, args.window, os.path.join(args.plot_dir, f"convergence_{ligand}.png"))
+        print(f"Plots saved in {args.plot_dir}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Running ΔG(t) convergence curves of LIE runs")
+    parser.add_argument("--manifest", default=None,
+                        help="CSV with columns id,ligand_dir,complex_dir (as for analyze_LIE_noqgui.py)")
+    parser.add_argument("--ligand_dir", default="ligand", help="Ligand directory (without --manifest)")
+    parser.add_argument("--complex_dir", default="complex", help="Complex directory (without --manifest)")
+    parser.add_argument("--ligand_name", default="LIG", help="Ligand name (without --manifest)")
+    parser.add_argument("--alpha", type=float, default=0.18, help="Alpha parameter")
+    parser.add_argument("--beta", type=float, default=0.50, help="Beta parameter")
+    parser.add_argument("--gamma", type=float, default=0.00, help="Gamma parameter")
+    parser.add_argument("--window", type=int, default=50, help="Samples in the sliding window")
+    parser.add_argument("--energy_source", choices=["log", "en"], default="log",
+                        help="Read energies from the .log files or from the binary Qdyn .en files")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Worker processes to read logs (default: CPUs allocated by SLURM)")
+    parser.add_argument("--output", default="LIE_convergence.npz", help="Output .npz file with the curves")
+    parser.add_argument("--plot_dir", default=None, help="Save one convergence plot per ligand in this directory")
+
+    mdle.add_cache_arguments(parser)
+
+    args = parser.parse_args()
+    mdle.configure_cache_from_args(args)
+    main(args)
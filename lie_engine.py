@@ -0,0 +1,622 @@
+#!/usr/bin/env python3
+"""
+Vectorized LIE (Linear Interaction Energy) engine.
+
+    ΔG = β * ((EL_w_complex + EL_p_complex) - EL_w_ligand)
+       + α * ((VDW_w_complex + VDW_p_complex) - VDW_w_ligand) + γ
+
+Mean interaction energies and their standard errors are passed as arrays
+whose last axis holds TERMS, e.g. shaped (ligand, pose, replica, 4), and ΔG
+with its propagated error is computed for all of them at once. α, β and γ
+broadcast against the leading axes, so a grid of parameters can be evaluated
+in the same call. Pooling replicas or averaging over poses are reductions
+over axes of these arrays. delta_energies(), sweep_parameters() and
+fit_parameters() fit α, β and γ to the experimental ΔG of reference ligands.
+bootstrap_dg() resamples the energy time series of the runs for confidence
+intervals of ΔG, running_dg() follows ΔG along them for convergence and
+windowed_dg() resolves ΔG and its components over sliding windows.
+aggregate_poses() combines the ΔG of the docking poses of every ligand, and
+sequential_pose_test() tells running poses that cannot become the best one.
+"""
+
+import warnings
+from statistics import NormalDist
+
+import numpy as np
+
+import mdlog_energies as mdle
+
+# Last axis of the energy arrays: Q-wat and Q-prot el/vdW
+TERMS = ('el_w', 'vdw_w', 'el_p', 'vdw_p')
+EL_W, VDW_W, EL_P, VDW_P = range(len(TERMS))
+
+
+def terms_from_qterms(qterms):
+    """
+    Picks TERMS from the nested averages (or errors) returned by
+    mdlog_energies.get_q_energies().
+    """
+    return np.array([qterms[2][0], qterms[2][1], qterms[1][0], qterms[1][1]], dtype=float)
+
+
+def terms_from_energies(energies):
+    """
+    Picks TERMS from arrays in the mdlog_energies.QCOLUMNS layout (last axis).
+    Missing terms (NaN), e.g. Q-prot for a ligand in water, become 0.
+    """
+    terms = np.asarray(energies, dtype=float)[..., [4, 5, 2, 3]]
+    return np.where(np.isnan(terms), 0.0, terms)
+
+
+def compute_dg(lig_ave, lig_stderr, comp_ave, comp_stderr, alpha, beta, gamma):
+    """
+    LIE ΔG and its standard error from mean energies and errors shaped
+    (..., len(TERMS)) for the ligand in water and the complex.
+
+    The error propagates the electrostatic and vdW errors of the ligand in
+    water and of the complex (water and protein) as independent.
+    Returns (dg, dg_stderr) shaped like the leading axes.
+    """
+    lig_ave = np.asarray(lig_ave, dtype=float)
+    comp_ave = np.asarray(comp_ave, dtype=float)
+    lig_var = np.asarray(lig_stderr, dtype=float) ** 2
+    comp_var = np.asarray(comp_stderr, dtype=float) ** 2
+    alpha = np.asarray(alpha, dtype=float)
+    beta = np.asarray(beta, dtype=float)
+
+    dg = (beta * ((comp_ave[..., EL_W] + comp_ave[..., EL_P]) - lig_ave[..., EL_W]) +
+          alpha * ((comp_ave[..., VDW_W] + comp_ave[..., VDW_P]) - lig_ave[..., VDW_W]) + gamma)
+
+    dg_stderr = np.sqrt(beta ** 2 * (lig_var[..., EL_W] + comp_var[..., EL_W] + comp_var[..., EL_P]) +
+                        alpha ** 2 * (lig_var[..., VDW_W] + comp_var[..., VDW_W] + comp_var[..., VDW_P]))
+
+    return dg, dg_stderr
+
+
+def pool(ave, stderr, counts, axis):
+    """
+    Pools mean energies over an axis (e.g. replicas), weighting every entry by
+    its number of samples, as if their samples had been concatenated.
+    Errors of the entries are propagated as independent. Entries with zero
+    counts or NaN means are left out.
+    Returns (ave, stderr) with axis removed (the TERMS axis is kept).
+    """
+    ave = np.asarray(ave, dtype=float)
+    stderr = np.asarray(stderr, dtype=float)
+    counts = np.asarray(counts, dtype=float)
+
+    #Counts have no TERMS axis
+    weights = np.where(np.isnan(ave), 0.0, counts[..., np.newaxis])
+    total = np.sum(weights, axis=axis)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        pooled = np.sum(weights * np.nan_to_num(ave), axis=axis) / total
+        pooled_stderr = np.sqrt(np.sum(weights ** 2 * np.nan_to_num(stderr) ** 2, axis=axis)) / total
+
+    return pooled, pooled_stderr
+
+
+def reduce_dg(dg, dg_stderr, axis):
+    """
+    Averages ΔG over an axis (e.g. replicas of a pose, or poses of a ligand),
+    skipping NaN entries.
+    Returns (mean, stderr, std): the mean ΔG, its error propagated from the
+    entry errors, and the standard deviation of the entries around it.
+    """
+    dg = np.asarray(dg, dtype=float)
+    dg_stderr = np.asarray(dg_stderr, dtype=float)
+
+    valid = ~np.isnan(dg)
+    n = np.sum(valid, axis=axis)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.sum(np.where(valid, dg, 0.0), axis=axis) / n
+        stderr = np.sqrt(np.sum(np.where(valid, dg_stderr, 0.0) ** 2, axis=axis)) / n
+        std = np.sqrt(np.sum(np.where(valid, dg - np.expand_dims(mean, axis), 0.0) ** 2, axis=axis) / n)
+
+    return mean, stderr, std
+
+
+def bootstrap_block_size(runs):
+    """
+    Block length (samples) for the block bootstrap of runs given as term
+    series shaped (samples, len(TERMS)): twice the longest integrated
+    autocorrelation time of any term of any run, so blocks are decorrelated.
+    """
+    taus = [mdle.autocorrelation_time(np.asarray(run, dtype=float).T) for run in runs if len(run) > 1]
+    if not taus:
+        return 1
+    return max(1, int(np.ceil(2 * max(np.max(tau) for tau in taus))))
+
+
+def _block_means(runs, block_size):
+    """
+    Non-overlapping block means of every run, padded to (run, block, term),
+    and the number of blocks of each run. The last partial block is dropped;
+    a run shorter than one block is a single block.
+    """
+    nblocks = np.array([max(1, len(run) // block_size) for run in runs])
+    means = np.zeros((len(runs), nblocks.max(), len(TERMS)))
+    for i, run in enumerate(runs):
+        run = np.asarray(run, dtype=float)
+        if len(run) < block_size:
+            means[i, 0] = np.mean(run, axis=0)
+        else:
+            means[i, :nblocks[i]] = np.mean(run[:nblocks[i] * block_size].reshape(nblocks[i], block_size, -1), axis=1)
+    return means, nblocks
+
+
+def _resample_means(means, nblocks, n_boot, rng):
+    """
+    Mean terms of n_boot resamples: runs are drawn with replacement, and
+    every drawn run contributes as many blocks, drawn with replacement from
+    its own blocks, as it has.
+    """
+    nruns, max_blocks = means.shape[:2]
+    run_index = rng.integers(0, nruns, size=(n_boot, nruns))
+    run_blocks = nblocks[run_index]
+    block_index = (rng.random((n_boot, nruns, max_blocks)) * run_blocks[..., np.newaxis]).astype(int)
+    valid = np.arange(max_blocks) < run_blocks[..., np.newaxis]
+
+    picked = means[run_index[..., np.newaxis], block_index]
+    return np.sum(picked * valid[..., np.newaxis], axis=(1, 2)) / np.sum(valid, axis=(1, 2))[:, np.newaxis]
+
+
+def bootstrap_dg(lig_runs, comp_runs, alpha, beta, gamma, n_boot=10000, ci=95.0, block_size=None,
+                 seed=None, max_elements=2 ** 23):
+    """
+    Block bootstrap of the LIE ΔG of one ligand (or pose).
+
+    lig_runs and comp_runs are the term series (samples, len(TERMS)) of the
+    runs (replicas, or pose x replica) of the ligand in water and of the
+    complex, e.g. from terms_from_energies(). Every resample draws the runs
+    with replacement and decorrelated blocks of their time series (see
+    bootstrap_block_size()), so the spread includes the replica-to-replica
+    spread and the correlation between the el and vdW terms. The resamples
+    are drawn as batched index arrays, a chunk of at most max_elements
+    block picks at a time.
+
+    Returns a dict with the resampled dg, its std and the ci percent
+    percentile interval ci_low, ci_high.
+    """
+    rng = np.random.default_rng(seed)
+
+    systems = []
+    for runs in (lig_runs, comp_runs):
+        size = block_size or bootstrap_block_size(runs)
+        systems.append(_block_means(runs, size))
+    per_resample = max(means.shape[0] * means.shape[1] * means.shape[2] for means, nblocks in systems)
+    chunk = max(1, max_elements // per_resample)
+
+    dg = np.empty(n_boot)
+    for first in range(0, n_boot, chunk):
+        n = min(chunk, n_boot - first)
+        lig_ave, comp_ave = (_resample_means(means, nblocks, n, rng) for means, nblocks in systems)
+        dg[first:first + n] = compute_dg(lig_ave, np.zeros_like(lig_ave), comp_ave, np.zeros_like(comp_ave),
+                                         alpha, beta, gamma)[0]
+
+    ci_low, ci_high = np.percentile(dg, [(100.0 - ci) / 2, (100.0 + ci) / 2])
+    return {'dg': dg, 'std': np.std(dg), 'ci_low': ci_low, 'ci_high': ci_high}
+
+
+# Gas constant (kcal/mol/K) and the temperature of our production runs (K), as set in
+# ligands/production.inp and complex/production*.inp
+GAS_CONSTANT = 0.0019872041
+TEMPERATURE = 300.0
+
+
+def aggregate_poses(dg, dg_stderr=None, temperature=TEMPERATURE, axis=-1):
+    """
+    Combines the ΔG of the poses of every ligand along axis (NaN for missing
+    poses), e.g. shaped (ligand, pose) or (ligand, pose, resample):
+
+        ΔG_boltzmann = -RT ln Σ_i exp(-ΔG_i / RT)
+        p_i          = exp(-ΔG_i / RT) / Σ_j exp(-ΔG_j / RT)
+        ΔG_min       = min_i ΔG_i
+
+    With dg_stderr, the pose errors are propagated as independent: the
+    derivative of ΔG_boltzmann by ΔG_i is p_i, and ΔG_min takes the error of
+    the best pose. Returns a dict with dg_boltzmann, dg_min, best_pose (index
+    along axis, -1 if no pose has a ΔG), probability (shaped like dg) and,
+    with dg_stderr, dg_boltzmann_stderr and dg_min_stderr.
+    """
+    dg = np.asarray(dg, dtype=float)
+    rt = GAS_CONSTANT * temperature
+    valid = ~np.isnan(dg)
+    any_valid = np.any(valid, axis=axis)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        dg_min = np.min(np.where(valid, dg, np.inf), axis=axis)
+        dg_min = np.where(any_valid, dg_min, np.nan)
+        #Shifting by the lowest ΔG keeps the exponentials in range
+        boltzmann = np.where(valid, np.exp(-(dg - np.expand_dims(dg_min, axis)) / rt), 0.0)
+        total = np.sum(boltzmann, axis=axis)
+        probability = np.where(valid, boltzmann / np.expand_dims(total, axis), np.nan)
+        dg_boltzmann = dg_min - rt * np.log(total)
+
+    best_pose = np.where(any_valid, np.argmin(np.where(valid, dg, np.inf), axis=axis), -1)
+    result = {'dg_boltzmann': dg_boltzmann, 'dg_min': dg_min, 'best_pose': best_pose,
+              'probability': probability}
+
+    if dg_stderr is not None:
+        dg_stderr = np.asarray(dg_stderr, dtype=float)
+        result['dg_boltzmann_stderr'] = np.where(
+            any_valid, np.sqrt(np.nansum((probability * dg_stderr) ** 2, axis=axis)), np.nan)
+        best_stderr = np.take_along_axis(dg_stderr, np.expand_dims(np.maximum(best_pose, 0), axis), axis=axis)
+        result['dg_min_stderr'] = np.where(any_valid, np.squeeze(best_stderr, axis=axis), np.nan)
+
+    return result
+
+
+def bootstrap_poses(samples, temperature=TEMPERATURE, ci=95.0):
+    """
+    Bootstrap errors of aggregate_poses() from the resampled ΔG of every pose
+    shaped (ligand, pose, resample), e.g. the dg arrays of bootstrap_dg()
+    (NaN for missing poses). The poses are aggregated resample by resample
+    in one call for all ligands.
+
+    Returns a dict with the std and ci percent interval (*_std, *_ci_low,
+    *_ci_high) of dg_boltzmann and dg_min per ligand, and per pose its mean
+    probability over the resamples (probability_mean, probability_std) and
+    the fraction of resamples in which it is the best pose (p_best).
+    """
+    samples = np.asarray(samples, dtype=float)
+    aggregate = aggregate_poses(samples, temperature=temperature, axis=1)
+    limits = [(100.0 - ci) / 2, (100.0 + ci) / 2]
+
+    result = {}
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        for name in ('dg_boltzmann', 'dg_min'):
+            result[name + '_std'] = np.nanstd(aggregate[name], axis=-1)
+            result[name + '_ci_low'], result[name + '_ci_high'] = np.nanpercentile(aggregate[name], limits, axis=-1)
+        result['probability_mean'] = np.nanmean(aggregate['probability'], axis=-1)
+        result['probability_std'] = np.nanstd(aggregate['probability'], axis=-1)
+
+    poses = np.arange(samples.shape[1])[np.newaxis, :, np.newaxis]
+    best = aggregate['best_pose'][:, np.newaxis, :] == poses
+    result['p_best'] = np.where(np.all(np.isnan(samples), axis=-1), np.nan, np.mean(best, axis=-1))
+    return result
+
+
+def sequential_pose_test(dg, dg_stderr, fraction, margin=1.0, confidence=0.99, axis=-1):
+    """
+    Heuristic stopping rule for every pose against the best (lowest ΔG) pose
+    of its ligand along axis, on ΔG estimates of runs still going. A pose is
+    stopped when it is worse than the best pose by more than margin:
+
+        z = (ΔG_pose - ΔG_best - margin) / sqrt(σ_pose² + σ_best²) > z_c / sqrt(t)
+
+    where t is the fraction of the planned production done (0 < t <= 1) and
+    z_c the one-sided normal quantile of confidence. The boundary has the
+    O'Brien-Fleming shape, so early in the run much stronger evidence is
+    needed, but it is not calibrated for the number of polls nor for testing
+    against a best pose picked from the same noisy estimates: confidence sets
+    how strict the rule is, not its error rate. Returns (z, boundary, stop)
+    shaped like dg; the best pose and missing poses (NaN) are never stopped.
+    """
+    dg = np.asarray(dg, dtype=float)
+    var = np.asarray(dg_stderr, dtype=float) ** 2
+    valid = ~np.isnan(dg)
+
+    best = np.expand_dims(np.argmin(np.where(valid, dg, np.inf), axis=axis), axis)
+    is_best = np.zeros(dg.shape, dtype=bool)
+    np.put_along_axis(is_best, best, True, axis=axis)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        z = ((dg - np.take_along_axis(dg, best, axis=axis) - margin) /
+             np.sqrt(var + np.take_along_axis(var, best, axis=axis)))
+        boundary = NormalDist().inv_cdf(confidence) / np.sqrt(np.clip(fraction, 0.0, 1.0))
+
+    stop = valid & ~is_best & (z > boundary)
+    return z, boundary, stop
+
+
+RUNNING_MODES = ('forward', 'reverse', 'sliding')
+
+
+def running_mean(series, mode='forward', window=None):
+    """
+    Running means of a series (samples, ...) along its first axis from one
+    cumulative sum, in O(n):
+
+    forward   mean of samples 0..t (the average of a run stopped at t)
+    reverse   mean of samples t..n-1 (the average after discarding up to t)
+    sliding   mean of the window samples ending at t (NaN before the first
+              full window)
+    """
+    x = np.asarray(series, dtype=float)
+    n = len(x)
+    csum = np.concatenate([np.zeros((1,) + x.shape[1:]), np.cumsum(x, axis=0)])
+    count = np.arange(1, n + 1).reshape((n,) + (1,) * (x.ndim - 1))
+
+    if mode == 'forward':
+        return csum[1:] / count
+    if mode == 'reverse':
+        return (csum[-1] - csum[:-1]) / count[::-1]
+    if mode == 'sliding':
+        window = min(int(window or n), n)
+        means = np.full(x.shape, np.nan)
+        means[window - 1:] = (csum[window:] - csum[:n - window + 1]) / window
+        return means
+    raise ValueError(f"Unknown running mode {mode!r}, expected one of {RUNNING_MODES}")
+
+
+def running_dg(lig_series, comp_series, alpha, beta, gamma, mode='forward', window=None):
+    """
+    ΔG(t) of a ligand and a complex run given as term series
+    (samples, len(TERMS)) sampled at the same steps, using the running mean
+    of both up to (forward), from (reverse) or around (sliding) every
+    sample. The longer run is truncated to the length of the shorter one.
+    """
+    n = min(len(lig_series), len(comp_series))
+    lig_ave = running_mean(np.asarray(lig_series, dtype=float)[:n], mode, window)
+    comp_ave = running_mean(np.asarray(comp_series, dtype=float)[:n], mode, window)
+    zeros = np.zeros_like(lig_ave)
+    return compute_dg(lig_ave, zeros, comp_ave, zeros, alpha, beta, gamma)[0]
+
+
+def window_means(series, window, stride=1):
+    """
+    Means of the windows of window samples that start every stride samples
+    of a series (samples, ...), from one cumulative sum: no window is
+    copied, so thousands of windows cost O(n). Returns (starts, means) with
+    the first sample of every window.
+    """
+    x = np.asarray(series, dtype=float)
+    n = len(x)
+    window = min(int(window), n)
+    csum = np.concatenate([np.zeros((1,) + x.shape[1:]), np.cumsum(x, axis=0)])
+    starts = np.arange(0, n - window + 1, max(1, int(stride)))
+    return starts, (csum[starts + window] - csum[starts]) / window
+
+
+def windowed_dg(lig_ave, comp_series, alpha, beta, gamma, window, stride=1):
+    """
+    Time-resolved LIE of a complex run: ΔG and its ΔV_el and ΔV_vdW
+    components over sliding windows of the complex term series (samples,
+    len(TERMS)) against the mean terms lig_ave of the ligand in water, which
+    has no binding mode to resolve. Returns (starts, dg, dv_el, dv_vdw).
+    """
+    starts, comp_ave = window_means(comp_series, window, stride)
+    zeros = np.zeros_like(comp_ave)
+    dv_el, dv_vdw = delta_energies(lig_ave, zeros[0], comp_ave, zeros)[:2]
+    return starts, beta * dv_el + alpha * dv_vdw + gamma, dv_el, dv_vdw
+
+
+def delta_energies(lig_ave, lig_stderr, comp_ave, comp_stderr):
+    """
+    Interaction energy differences between the complex and the ligand in
+    water, the ΔV_el and ΔV_vdW that β and α multiply in the LIE equation.
+    Returns (dv_el, dv_vdw, dv_el_stderr, dv_vdw_stderr).
+    """
+    lig_ave = np.asarray(lig_ave, dtype=float)
+    comp_ave = np.asarray(comp_ave, dtype=float)
+    lig_var = np.asarray(lig_stderr, dtype=float) ** 2
+    comp_var = np.asarray(comp_stderr, dtype=float) ** 2
+
+    dv_el = (comp_ave[..., EL_W] + comp_ave[..., EL_P]) - lig_ave[..., EL_W]
+    dv_vdw = (comp_ave[..., VDW_W] + comp_ave[..., VDW_P]) - lig_ave[..., VDW_W]
+    dv_el_stderr = np.sqrt(lig_var[..., EL_W] + comp_var[..., EL_W] + comp_var[..., EL_P])
+    dv_vdw_stderr = np.sqrt(lig_var[..., VDW_W] + comp_var[..., VDW_W] + comp_var[..., VDW_P])
+
+    return dv_el, dv_vdw, dv_el_stderr, dv_vdw_stderr
+
+
+def _weights(dg_exp, weights):
+    if weights is None:
+        return np.ones_like(dg_exp)
+    weights = np.asarray(weights, dtype=float)
+    if np.any(weights < 0) or not np.any(weights > 0):
+        raise ValueError("weights must be non-negative and not all zero")
+    return weights
+
+
+def fit_metrics(dg, dg_exp, weights=None, axis=-1):
+    """
+    Weighted MAE, RMSE and R² (coefficient of determination, 1 - SSE/SST) of
+    calculated against experimental ΔG over the ligand axis.
+    Returns (mae, rmse, r2).
+    """
+    dg_exp = np.asarray(dg_exp, dtype=float)
+    w = _weights(dg_exp, weights)
+    residual = np.asarray(dg, dtype=float) - dg_exp
+
+    total = np.sum(w)
+    mae = np.sum(w * np.abs(residual), axis=axis) / total
+    sse = np.sum(w * residual ** 2, axis=axis)
+    sst = np.sum(w * (dg_exp - np.sum(w * dg_exp) / total) ** 2)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        r2 = 1.0 - sse / sst
+
+    return mae, np.sqrt(sse / total), r2
+
+
+def sweep_parameters(dv_el, dv_vdw, dg_exp, alphas, betas, gammas, weights=None, max_elements=2 ** 24):
+    """
+    MAE, RMSE and R² of the LIE ΔG of reference ligands against their
+    experimental ΔG on every point of an α x β x γ grid.
+
+    The grid is evaluated by broadcasting (α, β, γ, ligand) arrays, a few α
+    values at a time so that at most max_elements residuals are held in
+    memory. Returns (mae, rmse, r2) shaped (len(alphas), len(betas), len(gammas)).
+    """
+    dv_el = np.asarray(dv_el, dtype=float)
+    dv_vdw = np.asarray(dv_vdw, dtype=float)
+    dg_exp = np.asarray(dg_exp, dtype=float)
+    alphas = np.asarray(alphas, dtype=float)
+    betas = np.asarray(betas, dtype=float)
+    gammas = np.asarray(gammas, dtype=float)
+
+    shape = (len(alphas), len(betas), len(gammas))
+    mae = np.empty(shape)
+    rmse = np.empty(shape)
+    r2 = np.empty(shape)
+
+    #β * ΔV_el + γ does not depend on α and is shared by every chunk
+    el_part = (betas[:, np.newaxis, np.newaxis] * dv_el +
+               gammas[np.newaxis, :, np.newaxis])
+    chunk = max(1, max_elements // max(1, el_part.size))
+    for first in range(0, len(alphas), chunk):
+        a = alphas[first:first + chunk, np.newaxis, np.newaxis, np.newaxis]
+        dg = a * dv_vdw + el_part
+        mae[first:first + chunk], rmse[first:first + chunk], r2[first:first + chunk] = \
+            fit_metrics(dg, dg_exp, weights)
+
+    return mae, rmse, r2
+
+
+def _design(dv_el, dv_vdw, dg_exp, gamma=None):
+    """
+    Design matrix (ΔV_vdW, ΔV_el[, 1]) and target of the LIE least-squares
+    problem; with gamma fixed it is subtracted from the target instead.
+    """
+    columns = [np.asarray(dv_vdw, dtype=float), np.asarray(dv_el, dtype=float)]
+    target = np.asarray(dg_exp, dtype=float)
+    if gamma is None:
+        columns.append(np.ones_like(target))
+    else:
+        target = target - gamma
+    return np.column_stack(columns), target
+
+
+def _parameters(params, params_stderr, gamma):
+    """α, β, γ and their errors as a dict, γ taken from gamma when it is fixed."""
+    fitted_gamma = gamma is None
+    return {'alpha': params[..., 0], 'beta': params[..., 1],
+            'gamma': params[..., 2] if fitted_gamma else float(gamma),
+            'alpha_stderr': params_stderr[..., 0], 'beta_stderr': params_stderr[..., 1],
+            'gamma_stderr': params_stderr[..., 2] if fitted_gamma else 0.0}
+
+
+def fit_parameters(dv_el, dv_vdw, dg_exp, weights=None, gamma=None):
+    """
+    Closed-form weighted least-squares fit of α, β and γ to experimental ΔG.
+    With gamma given, γ is fixed to it and only α and β are fitted.
+
+    Parameter errors come from the covariance (XᵀWX)⁻¹ scaled by the
+    weighted residual variance, so weights only need to be relative.
+    Returns a dict with alpha, beta, gamma, their *_stderr, mae, rmse, r2
+    and the fitted dg.
+    """
+    dg_exp = np.asarray(dg_exp, dtype=float)
+    w = _weights(dg_exp, weights)
+    X, target = _design(dv_el, dv_vdw, dg_exp, gamma)
+    sqrt_w = np.sqrt(w)
+
+    params = np.linalg.lstsq(X * sqrt_w[:, np.newaxis], target * sqrt_w, rcond=None)[0]
+    dg = X @ params + (0.0 if gamma is None else gamma)
+
+    p = X.shape[1]
+    dof = np.sum(w > 0) - p
+    if dof > 0:
+        sigma2 = np.sum(w * (dg - dg_exp) ** 2) / dof
+        cov = sigma2 * np.linalg.pinv((X * w[:, np.newaxis]).T @ X)
+        params_stderr = np.sqrt(np.diag(cov))
+    else:
+        params_stderr = np.full(p, np.nan)
+
+    mae, rmse, r2 = fit_metrics(dg, dg_exp, w)
+    return dict(_parameters(params, params_stderr, gamma), mae=mae, rmse=rmse, r2=r2, dg=dg)
+
+
+def loo_parameters(dv_el, dv_vdw, dg_exp, weights=None, gamma=None):
+    """
+    Leave-one-out cross-validation of the weighted least-squares fit without
+    refitting: with the hat matrix diagonal h_i, the residual of ligand i
+    predicted by the fit without it is e_i / (1 - h_i), and the parameters
+    of that fit are θ - (XᵀWX)⁻¹ x_i w_i e_i / (1 - h_i).
+
+    Returns a dict with the jackknife α, β, γ errors (*_stderr), the
+    cross-validated mae, rmse and q2 (R² of the left-out predictions) and
+    the left-out predictions dg. Ligands that alone determine the fit
+    (h_i = 1) have NaN predictions and are left out of the metrics.
+    """
+    dg_exp = np.asarray(dg_exp, dtype=float)
+    w = _weights(dg_exp, weights)
+    X, target = _design(dv_el, dv_vdw, dg_exp, gamma)
+
+    inverse = np.linalg.pinv((X * w[:, np.newaxis]).T @ X)
+    params = inverse @ (X.T @ (w * target))
+    residual = X @ params - target
+    leverage = w * np.einsum('ni,ij,nj->n', X, inverse, X)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        scale = np.where(np.isclose(leverage, 1.0), np.nan, 1.0 / (1.0 - leverage))
+    dg = dg_exp + residual * scale
+    loo_params = params - (inverse @ X.T).T * (w * residual * scale)[:, np.newaxis]
+
+    valid = ~np.isnan(scale)
+    n = np.sum(valid)
+    if n > 1:
+        spread = loo_params[valid] - np.mean(loo_params[valid], axis=0)
+        params_stderr = np.sqrt((n - 1) / n * np.sum(spread ** 2, axis=0))
+    else:
+        params_stderr = np.full(X.shape[1], np.nan)
+
+    if np.any(w[valid] > 0):
+        mae, rmse, q2 = fit_metrics(dg[valid], dg_exp[valid], w[valid])
+    else:
+        mae = rmse = q2 = np.nan
+    return dict(_parameters(params, params_stderr, gamma), mae=mae, rmse=rmse, q2=q2, dg=dg)
+
+
+def kfold_count(n, parameters, folds=5):
+    """
+    Folds of a k-fold split of n ligands closest to folds (at most one per
+    ligand) whose training sets all keep at least parameters ligands; 0 when
+    n ligands are too few for any split.
+    """
+    if n <= parameters:
+        return 0
+    #The largest fold holds ceil(n / folds) ligands
+    return min(n, max(folds, -(-n // (n - parameters))))
+
+
+def kfold_parameters(dv_el, dv_vdw, dg_exp, weights=None, gamma=None, folds=5, repeats=1000, seed=None):
+    """
+    Repeated k-fold cross-validation of the weighted least-squares fit.
+
+    Every repeat splits the ligands at random into folds, and the normal
+    equations of all (repeat, fold) training sets are built with one einsum
+    and solved as a batch, so thousands of random splits cost a few array
+    operations. The number of folds is raised where needed so that every
+    training set determines the fit (kfold_count()); with no more ligands
+    than parameters a ValueError is raised, the leave-one-out fit
+    (loo_parameters()) is the only cross-validation left.
+
+    Returns a dict with the mae, rmse and q2 of the left-out predictions of
+    every repeat, and the fitted α, β, γ of every training set, shaped
+    (repeats, folds), with their spread over all splits as *_stderr, and
+    the number of folds used.
+    """
+    dg_exp = np.asarray(dg_exp, dtype=float)
+    w = _weights(dg_exp, weights)
+    X, target = _design(dv_el, dv_vdw, dg_exp, gamma)
+    n = len(target)
+    folds = kfold_count(n, X.shape[1], folds)
+    if not folds:
+        raise ValueError(f"{n} reference ligands are too few for k-fold cross-validation of "
+                         f"{X.shape[1]} parameters, use the leave-one-out fit")
+
+    #Fold of every ligand in every repeat, balanced like a shuffled round robin
+    rng = np.random.default_rng(seed)
+    order = np.argsort(rng.random((repeats, n)), axis=1)
+    fold_of = np.empty((repeats, n), dtype=int)
+    np.put_along_axis(fold_of, order, np.arange(n) % folds, axis=1)
+
+    test = fold_of[:, np.newaxis, :] == np.arange(folds)[np.newaxis, :, np.newaxis]
+    train_w = np.where(test, 0.0, w)
+    normal = np.einsum('rkn,ni,nj->rkij', train_w, X, X)
+    rhs = np.einsum('rkn,ni,n->rki', train_w, X, target)
+    params = np.einsum('rkij,rkj->rki', np.linalg.pinv(normal), rhs)
+    #Training sets with fewer ligands than parameters do not determine a fit
+    underdetermined = np.sum(train_w > 0, axis=-1) < X.shape[1]
+    params[underdetermined] = np.nan
+
+    #Every ligand is predicted by the fit of the fold that left it out
+    own_params = np.take_along_axis(params, fold_of[..., np.newaxis], axis=1)
+    dg = np.einsum('ni,rni->rn', X, own_params) + (dg_exp - target)
+
+    mae, rmse, q2 = fit_metrics(dg, dg_exp, w)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning)
+        params_stderr = np.nanstd(params.reshape(-1, X.shape[1]), axis=0)
+    return dict(_parameters(params, params_stderr, gamma), mae=mae, rmse=rmse, q2=q2, folds=folds)
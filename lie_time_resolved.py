@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+"""
+Time-resolved LIE: ΔG and its components over sliding windows.
+
+A whole-run average hides a ligand that changes its binding mode during
+production. For every ligand, pose and complex replica, ΔG, ΔV_el and
+ΔV_vdW are computed over windows of --window samples every --stride
+samples of the complex run, against the mean energies of the ligand in
+water of the same pose (lie_engine.windowed_dg). Window means come from one
+cumulative sum per run, so thousands of windows per run are cheap. The
+segments of an extended replica are joined with their steps continuing from
+the end of the previous segment (lie_convergence.join_segments).
+
+A binding-mode transition is flagged when the ΔG of two consecutive,
+non-overlapping windows differs by more than --threshold kcal/mol; the step
+of the largest jump of every run is reported.
+
+The windows are saved to one .npz file with NaN-padded arrays shaped
+(run, window), and one summary row per run to a CSV:
+
+    python lie_time_resolved.py --manifest results/ligands_manifest.csv --window 100 --stride 5
+"""
+
+import argparse
+import csv
+
+import numpy as np
+
+import analyze_LIE_noqgui as lie
+import energy_store
+import lie_convergence
+import lie_engine
+import mdlog_energies as mdle
+
+SUMMARY_COLUMNS = ('ligand', 'pose', 'replica', 'n_windows', 'dG_mean', 'dG_min', 'dG_max',
+                   'max_jump', 'jump_step', 'transition')
+
+
+def pose_runs(runs):
+    """
+    Groups the runs of energy_store.discover_runs() by (ligand, pose): the
+    ligand-in-water logs, and the complex logs of every replica in order.
+    """
+    order = {ligand: i for i, ligand in enumerate(dict.fromkeys(run['ligand'] for run in runs))}
+    poses = {}
+    for run in sorted(runs, key=lambda run: (order[run['ligand']], run['pose'], run['replica'], run['segment'])):
+        pose = poses.setdefault((run['ligand'], run['pose']), {'ligand': [], 'complex': {}})
+        if run['system'] == 'ligand':
+            pose['ligand'].append(run['path'])
+        else:
+            pose['complex'].setdefault(run['replica'], []).append(run['path'])
+    return {key: pose for key, pose in poses.items() if pose['ligand'] and pose['complex']}
+
+
+def transitions(dg, window, stride, threshold):
+    """
+    Largest ΔG change between consecutive, non-overlapping windows. Returns
+    (jump, index of the later window, transition) for one run.
+    """
+    lag = -(-window // stride)
+    if len(dg) <= lag:
+        return np.nan, -1, False
+    jumps = dg[lag:] - dg[:-lag]
+    i = int(np.argmax(np.abs(jumps)))
+    return jumps[i], i + lag, bool(abs(jumps[i]) > threshold)
+
+
+def time_resolved(poses, alpha, beta, gamma, window, stride=1, threshold=2.0,
+                  energy_source="log", workers=None, equilibrate=False):
+    """
+    Windowed ΔG of every complex replica of the poses. Returns a dict with
+    the ligand, pose and replica of every run, NaN-padded step (last step of
+    every window), dg, dv_el and dv_vdw arrays shaped (run, window), and the
+    summary rows.
+    """
+    files = []
+    for pose in poses.values():
+        files.extend(pose['ligand'])
+        for paths in pose['complex'].values():
+            files.extend(paths)
+    if energy_source == "en":
+        files = mdle.to_energy_files(files)
+    parsed = iter(mdle.read_q_energies_parallel(files, workers=workers))
+
+    curves = []
+    rows = []
+    for (ligand, pose), paths in poses.items():
+        lig_energies, lig_cuts = lie.trim_energies([next(parsed) for path in paths['ligand']], equilibrate)
+        lig_qene, lig_ave, lig_stderr = mdle.q_energy_statistics(lig_energies, "blocks")
+        lig_terms = lie_engine.terms_from_qterms(lig_ave)
+
+        for replica, segments in paths['complex'].items():
+            steps, energies = lie_convergence.join_segments([next(parsed) for path in segments])
+            (energies,), (cut,) = lie.trim_energies([(steps, energies)], equilibrate)
+            steps = steps[len(steps) - len(energies):]
+            if len(energies) == 0:
+                continue
+
+            starts, dg, dv_el, dv_vdw = lie_engine.windowed_dg(
+                lig_terms, lie_engine.terms_from_energies(energies), alpha, beta, gamma, window, stride)
+            ends = steps[starts + min(window, len(steps)) - 1]
+            jump, later, flagged = transitions(dg, min(window, len(steps)), stride, threshold)
+            curves.append((ligand, pose, replica, ends, dg, dv_el, dv_vdw))
+            rows.append([ligand, pose, replica, len(dg), round(np.mean(dg), 2), round(np.min(dg), 2),
+                         round(np.max(dg), 2), round(jump, 2), int(steps[starts[later]]) if later >= 0 else '',
+                         flagged])
+
+    length = max((len(curve[3]) for curve in curves), default=0)
+    result = {'ligand': np.array([curve[0] for curve in curves]),
+              'pose': np.array([curve[1] for curve in curves], dtype=int),
+              'replica': np.array([curve[2] for curve in curves], dtype=int),
+              'step': np.full((len(curves), length), -1, dtype=np.int64)}
+    for name in ('dg', 'dv_el', 'dv_vdw'):
+        result[name] = np.full((len(curves), length), np.nan, dtype=np.float32)
+    for k, curve in enumerate(curves):
+        for name, values in zip(('step', 'dg', 'dv_el', 'dv_vdw'), curve[3:]):
+            result[name][k, :len(values)] = values
+    return result, rows
+
+
+def main(args):
+    runs = []
+    if args.manifest:
+        for entry in energy_store.read_manifest(args.manifest):
+            runs.extend(energy_store.discover_runs(entry['id'], entry['ligand_dir'], entry['complex_dir']))
+    else:
+        runs = energy_store.discover_runs(args.ligand_name, args.ligand_dir, args.complex_dir)
+
+    poses = pose_runs(runs)
+    if not poses:
+        print("No ligand/complex poses with .log files found.")
+        return
+
+    result, rows = time_resolved(poses, args.alpha, args.beta, args.gamma, args.window, args.stride,
+                                 args.threshold, args.energy_source, args.workers, args.equilibrate)
+    np.savez_compressed(args.output, window=args.window, stride=args.stride, alpha=args.alpha, beta=args.beta,
+                        gamma=args.gamma, **result)
+
+    with open(args.summary, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(SUMMARY_COLUMNS)
+        writer.writerows(rows)
+
+    for row in rows:
+        if row[-1]:
+            print(f"{row[0]} pose {row[1]} replica {row[2]}: ΔG changes by {row[7]:+.2f} kcal/mol "
+                  f"at step {row[8]}, possible binding-mode transition")
+    print(f"{int(np.sum(~np.isnan(result['dg'])))} windows of {len(rows)} runs saved to "
+          f"{args.output}, {sum(row[-1] for row in rows)} transitions flagged in {args.summary}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time-resolved LIE ΔG over sliding windows of the complex runs")
+    parser.add_argument("--manifest", default=None,
+                        help="CSV with columns id,ligand_dir,complex_dir (as for analyze_LIE_noqgui.py)")
+    parser.add_argument("--ligand_dir", default="ligand", help="Ligand directory (without --manifest)")
+    parser.add_argument("--complex_dir", default="complex", help="Complex directory (without --manifest)")
+    parser.add_argument("--ligand_name", default="LIG", help="Ligand name (without --manifest)")
+    parser.add_argument("--alpha", type=float, default=0.18, help="Alpha parameter")
+    parser.add_argument("--beta", type=float, default=0.50, help="Beta parameter")
+    parser.add_argument("--gamma", type=float, default=0.00, help="Gamma parameter")
+    parser.add_argument("--window", type=int, default=50, help="Samples in every window")
+    parser.add_argument("--stride", type=int, default=1, help="Samples between the starts of consecutive windows")
+    parser.add_argument("--threshold", type=float, default=2.0,
+                        help="ΔG change (kcal/mol) between consecutive windows flagged as a transition")
+    parser.add_argument("--energy_source", choices=["log", "en"], default="log",
+                        help="Read energies from the .log files or from the binary Qdyn .en files")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Worker processes to read logs (default: CPUs allocated by SLURM)")
+    parser.add_argument("--equilibrate", action="store_true",
+                        help="Discard the equilibration region of every run first")
+    parser.add_argument("--output", default="LIE_time_resolved.npz", help="Output .npz file with the windows")
+    parser.add_argument("--summary", default="LIE_transitions.csv", help="CSV with one summary row per run")
+
+    mdle.add_cache_arguments(parser)
+
+    args = parser.parse_args()
+    mdle.configure_cache_from_args(args)
+    main(args)
@@ -2,36 +2,56 @@
 Script Usage Instructions:
 
 - Place this script in the main project directory that contains the 'complex_#' folders.
-  Each 'complex_#' folder should be inside a parent folder 'complex/', with subfolders '1' and '2' containing:
+  Each 'complex_#' folder should be inside a parent folder 'complex/', with replica subfolders
+  (or pose folders with replica subfolders) containing the production logs:
     complex/complex_#/1/production1_#.log
     complex/complex_#/2/production2_#.log
 
-- Adjust the ligand range in the script (default is 1 to 38) if you have more or fewer ligands.
-
 - Run the script using Python 3:
     python ligand-surrounding-energies.py
 
 - The script will process all matching log files, extract energies, compute errors,
-  and generate a combined energy plot saved as 'combined_energy_plot.png'.
+  and save one energy plot per log in 'individual_plots/', in the folders of the log below 'complex/'
+  (individual_plots/complex_#/1/production1_#_plot.png).
+
+- Plots are rendered off-screen (Agg) across the CPUs of the job, each worker reusing one
+  figure. The hash of every log is kept in 'individual_plots/plot_hashes.json', so only the
+  plots of new or changed logs are rendered again (--force renders all). All plots can also
+  be collected in one multi-page PDF (--pdf) or one contact sheet image (--contact_sheet):
+    python ligand-surrounding-energies.py --workers 8 --pdf individual_plots/energies.pdf
 
 Author: Marcia C
 """
 
 import os
+import json
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import matplotlib
+matplotlib.use("Agg")
 import matplotlib.pyplot as plt
+from matplotlib.backends.backend_pdf import PdfPages
 import numpy as np
+import mdlog_energies as mdle
+import check_high_errors
+
+#Bump when the plots change, so that plots of unchanged logs are rendered again
+PLOT_VERSION = 2
+HASH_FILE = "plot_hashes.json"
+
+#Values read at once by downsample_minmax()
+_CHUNK = 1 << 16
 
 def extract_qsurr_energies(filename):
-    vdws = []
-    elecs = []
-    with open(filename, 'r') as f:
-        for line in f:
-            if line.startswith("Q-surr."):
-                parts = line.split()
-                if len(parts) >= 5:
-                    elecs.append(float(parts[3]))
-                    vdws.append(float(parts[4]))
-    return np.array(elecs), np.array(vdws)
+    steps, energies = mdle.read_q_energies(filename)
+    steps, elecs, vdws = qsurr_energies(steps, energies)
+    return elecs, vdws
+
+def qsurr_energies(steps, energies):
+    elecs, vdws = energies[:, 6], energies[:, 7]
+    printed = ~np.isnan(elecs)
+    return steps[printed], elecs[printed], vdws[printed]
 
 def compute_error_bind_separate(elecs, vdws):
     half = len(elecs) // 2
@@ -43,57 +63,180 @@ def compute_error_bind_separate(elecs, vdws):
     error_el = abs(el_f - el_b) / 2
     return error_vdw, error_el, (el_b, el_f, vdW_b, vdW_f)
 
-def plot_single_energy(log_file, elecs, vdws, error_vdw, error_el, el_b, el_f, vdW_b, vdW_f, total_steps, total_ps):
-    plt.figure(figsize=(8, 5))
-    step_interval = 50
-    n_points = len(vdws)
-    steps = np.arange(n_points) * step_interval
-    ps = steps * (total_ps / total_steps)
-
-    plt.plot(ps, vdws, label=f"vdW (b={vdW_b:.2f}, f={vdW_f:.2f}, err={error_vdw:.2f})", linestyle='-')
-    plt.plot(ps, elecs, label=f"Electrostatic (b={el_b:.2f}, f={el_f:.2f}, err={error_el:.2f})", linestyle='--')
-
-    plt.xlabel("Time (ps)")
-    plt.ylabel("Energy (kcal/mol)")
-    plt.title(f"Energies for {os.path.basename(log_file)}")
-    plt.legend(fontsize=8)
-    plt.tight_layout()
-
-    os.makedirs("individual_plots", exist_ok=True)
-    outname = os.path.join("individual_plots", os.path.basename(log_file).replace(".log", "_plot.png"))
-    plt.savefig(outname, dpi=300)
-    plt.close()
-
-def main():
-    ligand_numbers = range(1, 39)  # Adjust as needed
-    total_steps = 20000
-    total_ps = 20
-
-    log_files = []
-    for ligand in ligand_numbers:
-        path1 = os.path.join("complex", f"complex_{ligand}", "1", f"production1_{ligand}.log")
-        path2 = os.path.join("complex", f"complex_{ligand}", "2", f"production2_{ligand}.log")
-        if os.path.isfile(path1):
-            log_files.append(path1)
-        if os.path.isfile(path2):
-            log_files.append(path2)
+def log_hash(log_file, known=None):
+    """
+    SHA-1 of a log file. known is the entry saved for the log at the last render
+    (size, mtime, hash); when size and mtime did not change its hash is reused
+    without reading the file.
+    """
+    stat = os.stat(log_file)
+    if known and known.get("size") == stat.st_size and known.get("mtime") == stat.st_mtime_ns:
+        return known["hash"]
+    digest = hashlib.sha1()
+    with open(log_file, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def downsample_minmax(x, y, bins):
+    """
+    Reduces a trace to the minimum and maximum of each of bins consecutive blocks
+    (in time order), so spikes stay visible at any length. Traces of up to 2 * bins
+    points are returned as they are. y is only read through strided views, so
+    memory-mapped arrays (e.g. energy_store columns) are not copied; only the
+    selected points of x and y are gathered.
+    """
+    n = len(y)
+    if bins <= 0 or n <= 2 * bins:
+        return x, y
+    size = n // bins
+    end = size * bins
+    blocks = np.lib.stride_tricks.sliding_window_view(y[:end], size)[::size]
+    #Blocks are reduced a chunk at a time, so at most _CHUNK values are buffered
+    chunk = max(1, _CHUNK // size)
+    index = np.empty((bins, 2), dtype=np.int64)
+    for start in range(0, bins, chunk):
+        part = blocks[start:start + chunk]
+        index[start:start + chunk, 0] = part.argmin(axis=1)
+        index[start:start + chunk, 1] = part.argmax(axis=1)
+    index = (np.sort(index, axis=1) + (np.arange(bins) * size)[:, np.newaxis]).ravel()
+    if end < n:
+        tail = y[end:]
+        index = np.concatenate([index, np.sort([end + np.argmin(tail), end + np.argmax(tail)])])
+    return x[index], y[index]
+
+class EnergyPlot:
+    """
+    One figure with the vdW and electrostatic lines, reused for every plot:
+    only the data, labels and title change between plots. With downsample the
+    traces are reduced to about one point per pixel of the axes (downsample_minmax()).
+    """
+
+    def __init__(self, dpi=300, downsample=True):
+        self.dpi = dpi
+        self.downsample = downsample
+        self.fig, self.ax = plt.subplots(figsize=(8, 5))
+        self.vdw_line, = self.ax.plot([], [], linestyle='-')
+        self.el_line, = self.ax.plot([], [], linestyle='--')
+        self.ax.set_xlabel("Time (ps)")
+        self.ax.set_ylabel("Energy (kcal/mol)")
+
+    def bins(self):
+        """Min/max pairs per trace: half the width of the axes in pixels of the saved image."""
+        if not self.downsample:
+            return 0
+        return int(self.ax.get_position().width * self.fig.get_figwidth() * self.dpi) // 2
+
+    def render(self, outname, title, ps, elecs, vdws, error_vdw, error_el, el_b, el_f, vdW_b, vdW_f):
+        bins = self.bins()
+        self.vdw_line.set_data(*downsample_minmax(ps, vdws, bins))
+        self.vdw_line.set_label(f"vdW (b={vdW_b:.2f}, f={vdW_f:.2f}, err={error_vdw:.2f})")
+        self.el_line.set_data(*downsample_minmax(ps, elecs, bins))
+        self.el_line.set_label(f"Electrostatic (b={el_b:.2f}, f={el_f:.2f}, err={error_el:.2f})")
+        self.ax.relim()
+        self.ax.autoscale_view()
+        self.ax.set_title(title)
+        self.ax.legend(fontsize=8)
+        self.fig.tight_layout()
+        self.fig.savefig(outname, dpi=self.dpi)
+        return outname
+
+def plot_name(log_file, complex_base="complex", output_dir="individual_plots"):
+    """
+    Plot path of a log: its path below complex_base, in output_dir, with _plot.png
+    (complex/complex_1/pose2/1/prod.log -> individual_plots/complex_1/pose2/1/prod_plot.png),
+    so logs with the same name in different ligand, pose or replica folders get their own plot.
+    """
+    relative = os.path.relpath(log_file, complex_base)
+    return os.path.join(output_dir, os.path.splitext(relative)[0] + "_plot.png")
+
+def plot_single_energy(log_file, ps, elecs, vdws, error_vdw, error_el, el_b, el_f, vdW_b, vdW_f,
+                       output_dir="individual_plots", outname=None, figure=None):
+    """
+    Saves the energy plot of one log to outname (default output_dir/<log name>_plot.png),
+    drawing on figure (an EnergyPlot) if given.
+    """
+    if outname is None:
+        outname = os.path.join(output_dir, os.path.basename(log_file).replace(".log", "_plot.png"))
+    os.makedirs(os.path.dirname(outname) or ".", exist_ok=True)
+    figure = figure or EnergyPlot()
+    return figure.render(outname, f"Energies for {log_file}", ps, elecs, vdws,
+                         error_vdw, error_el, el_b, el_f, vdW_b, vdW_f)
+
+#Figure of the worker process, created once by _init_renderer()
+_FIGURE = None
+
+def _init_renderer(dpi, downsample):
+    global _FIGURE
+    _FIGURE = EnergyPlot(dpi, downsample)
+
+def _render(task):
+    return plot_single_energy(*task, figure=_FIGURE)
+
+def render_plots(tasks, dpi=300, workers=None, downsample=True):
+    """
+    Renders the plots of the tasks (plot_single_energy() arguments) across a pool of
+    worker processes, one reused figure per worker. Returns the plot paths.
+    """
+    if workers is None:
+        workers = mdle.default_workers()
+    workers = min(workers, len(tasks))
+    if workers <= 1:
+        figure = EnergyPlot(dpi, downsample)
+        return [plot_single_energy(*task, figure=figure) for task in tasks]
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_renderer, initargs=(dpi, downsample)) as pool:
+        return list(pool.map(_render, tasks, chunksize=max(1, len(tasks) // (4 * workers))))
+
+def write_pdf(plots, pdf_file):
+    """Collects the plot images in one multi-page PDF, one plot per page."""
+    with PdfPages(pdf_file) as pdf:
+        for plot in plots:
+            image = plt.imread(plot)
+            fig = plt.figure(figsize=(image.shape[1] / 100, image.shape[0] / 100), dpi=100)
+            fig.figimage(image)
+            pdf.savefig(fig)
+            plt.close(fig)
+
+def write_contact_sheet(plots, sheet_file, columns=4, width=600):
+    """Tiles thumbnails (width pixels wide) of the plot images in one image."""
+    thumbs = []
+    for plot in plots:
+        image = plt.imread(plot)[..., :3]
+        step = max(1, image.shape[1] // width)
+        thumbs.append(image[::step, ::step])
+    height = max(thumb.shape[0] for thumb in thumbs)
+    width = max(thumb.shape[1] for thumb in thumbs)
+    columns = min(columns, len(thumbs))
+    rows = -(-len(thumbs) // columns)
+    sheet = np.ones((rows * height, columns * width, 3), dtype=thumbs[0].dtype)
+    for k, thumb in enumerate(thumbs):
+        r, c = divmod(k, columns)
+        sheet[r * height:r * height + thumb.shape[0], c * width:c * width + thumb.shape[1]] = thumb
+    plt.imsave(sheet_file, sheet)
+
+def main(complex_base="complex", output_dir="individual_plots", workers=None, dpi=300, force=False,
+         pdf=None, contact_sheet=None, columns=4, downsample=True):
+    runs = check_high_errors.scan_runs(complex_base=complex_base)
+    log_files = [run["path"] for run in runs if run["system"] == "complex"]
 
     if not log_files:
         print("No .log files found in the specified directories.")
         return
 
-    elec_data = {}
-    vdw_data = {}
-
-    errors_vdw = []
-    errors_el = []
-    vdws_bounds = []
-    els_bounds = []
+    hash_file = os.path.join(output_dir, HASH_FILE)
+    try:
+        with open(hash_file) as f:
+            hashes = json.load(f)
+    except (OSError, ValueError):
+        hashes = {}
 
     print("\n--- Energy Extraction and Binding Error Calculation ---\n")
 
-    for log_file in log_files:
-        elecs, vdws = extract_qsurr_energies(log_file)
+    tasks = []
+    plots = []
+    rendered = {}
+    for log_file, (steps, energies) in zip(log_files, mdle.read_q_energies_parallel(log_files, workers=workers)):
+        steps, elecs, vdws = qsurr_energies(steps, energies)
         if len(elecs) == 0 or len(vdws) == 0:
             print(f"{log_file}: No Q-surr energies found.")
             continue
@@ -106,18 +249,54 @@ def main():
         print(f"  Error vdW = {error_vdw:.2f}")
         print(f"  Error Electrostatic = {error_el:.2f}\n")
 
-        elec_data[log_file] = elecs
-        vdw_data[log_file] = vdws
-        errors_vdw.append(error_vdw)
-        errors_el.append(error_el)
-        vdws_bounds.append((vdW_b, vdW_f))
-        els_bounds.append((el_b, el_f))
+        # Individual plot, skipped when the log and the plot settings did not change
+        outname = plot_name(log_file, complex_base, output_dir)
+        plots.append(outname)
+        known = hashes.get(log_file)
+        digest = log_hash(log_file, known)
+        stat = os.stat(log_file)
+        rendered[log_file] = {"size": stat.st_size, "mtime": stat.st_mtime_ns, "hash": digest,
+                              "version": PLOT_VERSION, "dpi": dpi, "downsample": downsample, "plot": outname}
+        if (not force and known and os.path.isfile(outname)
+                and all(known.get(key) == rendered[log_file][key]
+                        for key in ("hash", "version", "dpi", "downsample", "plot"))):
+            continue
+        stepsize = mdle.read_run_info(log_file)["stepsize"] or 1.0
+        ps = steps * stepsize / 1000
+        tasks.append((log_file, ps, elecs, vdws, error_vdw, error_el, el_b, el_f, vdW_b, vdW_f, output_dir, outname))
 
-        # Individual plot
-        plot_single_energy(log_file, elecs, vdws, error_vdw, error_el, el_b, el_f, vdW_b, vdW_f, total_steps, total_ps)
+    os.makedirs(output_dir, exist_ok=True)
+    if tasks:
+        render_plots(tasks, dpi, workers, downsample)
+    hashes.update(rendered)
+    with open(hash_file, "w") as f:
+        json.dump(hashes, f, indent=1)
+    print(f"{len(tasks)} plots rendered, {len(plots) - len(tasks)} unchanged, in {output_dir}")
 
     # Optionally: combined plot
     # plot_energies_together(vdw_data, elec_data, errors_vdw, errors_el, vdws_bounds, els_bounds, total_steps, total_ps, "combined_energy_plot.png")
+    if pdf and plots:
+        write_pdf(plots, pdf)
+        print(f"All plots saved to {pdf}")
+    if contact_sheet and plots:
+        write_contact_sheet(plots, contact_sheet, columns)
+        print(f"Contact sheet saved to {contact_sheet}")
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Plot Q-surr. energies of the production runs")
+    parser.add_argument("--complex_base", default="complex", help="Folder with the complex_# folders to scan")
+    parser.add_argument("--output_dir", default="individual_plots", help="Folder of the plots")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Worker processes to read logs and render plots (default: CPUs allocated by SLURM)")
+    parser.add_argument("--dpi", type=int, default=300, help="Resolution of the plots")
+    parser.add_argument("--full_resolution", action="store_true",
+                        help="Plot every energy sample instead of the min/max of each pixel column")
+    parser.add_argument("--force", action="store_true", help="Render all plots, also those of unchanged logs")
+    parser.add_argument("--pdf", default=None, help="Also collect all plots in this multi-page PDF")
+    parser.add_argument("--contact_sheet", default=None, help="Also tile all plots in this image")
+    parser.add_argument("--columns", type=int, default=4, help="Plots per row of the contact sheet")
+    mdle.add_cache_arguments(parser)
+    args = parser.parse_args()
+    mdle.configure_cache_from_args(args)
+    main(args.complex_base, args.output_dir, args.workers, args.dpi, args.force, args.pdf,
+         args.contact_sheet, args.columns, not args.full_resolution)
@@ -21,7 +21,40 @@ Functions to prepare extract energies from MD log files from Qdyn
 """
 
 import numpy as np
+import hashlib
 import os
+from concurrent.futures import ProcessPoolExecutor
+
+import mden_energies
+
+#Q-energy rows printed by Qdyn and the energy columns each of them carries
+QTYPES = ('Q-Q', 'Q-prot', 'Q-wat', 'Q-surr.', 'Q-any')
+QCOLUMNS = ('qq_el', 'qq_vdw',
+            'qp_el', 'qp_vdw',
+            'qw_el', 'qw_vdw',
+            'qs_el', 'qs_vdw',
+            'qany_el', 'qany_vdw', 'qany_bnd', 'qany_ang', 'qany_tor', 'qany_imp')
+QTYPE_SLICES = {b'Q-Q': (0, 2), b'Q-prot': (2, 4), b'Q-wat': (4, 6),
+                b'Q-surr.': (6, 8), b'Q-any': (8, 14)}
+
+_STEP_HEADER = b'Q-atom energies at step'
+_FINAL_HEADER = b'FINAL Q-atom energies'
+_BLOCK_END = b'\n====='
+_HEAD_BYTES = 8192
+_FINGERPRINT_BYTES = 2048
+
+#Bump when the parsed arrays change, so that cached entries are not reused
+PARSER_VERSION = 1
+
+#Parsed-energy cache, see configure_cache()
+CACHE = {'enabled': True,
+         'rebuild': False,
+         'dir': os.environ.get('MDLOG_ENERGIES_CACHE', '.mdlog_cache'),
+         'max_bytes': 512 * 1024 ** 2}
+
+#Resume states of growing logs read in this process, see tail_q_energies()
+_RESUME = {}
+
 
 def is_md_log(file_to_test):
     """
@@ -37,124 +70,905 @@ def is_md_log(file_to_test):
 
     return mdlog
 
-def get_q_energies(logfiles=[], lambda_='1.00'):
+
+def _header_int(data, key, cast=int, separator=b'='):
+    """
+    Returns the integer printed after 'key =' in the Qdyn input echo, or None.
+    cast and separator read other numbers, e.g. float after 'key:'.
+    """
+    pos = data.find(key)
+    if pos == -1:
+        return None
+    try:
+        return cast(data[data.find(separator, pos) + 1:].split(None, 1)[0].split(b'(')[0])
+    except (ValueError, IndexError):
+        return None
+
+
+def _q_blocks(data, nsteps=None, interval=None, last_step=None):
+    """
+    Yields (step, rows, end) for every complete Q-atom energy block of a Qdyn
+    log buffer: the step of the block, the bytes of its rows and the offset in
+    data right after it. Only the rows between a 'Q-atom energies at step N'
+    (or 'FINAL Q-atom energies') header and its closing '=====' line are
+    returned. A block that is still being written is left out.
+
+    nsteps and interval come from the input echo of the log; last_step is the
+    step of the block before data when only the tail of a log is parsed.
+    """
+    previous = last_step
+    pos = 0
+    while True:
+        start = data.find(b'Q-atom energies', pos)
+        if start == -1:
+            break
+        line_end = data.find(b'\n', start)
+        end = data.find(_BLOCK_END, line_end)
+        if line_end == -1 or end == -1:
+            #Block is still being written
+            break
+        pos = end + 1
+
+        if data.startswith(_STEP_HEADER, start):
+            step = int(data[start + len(_STEP_HEADER):line_end].split(None, 1)[0])
+        elif data.startswith(_FINAL_HEADER, start - 6):
+            if nsteps is not None:
+                step = nsteps
+            elif previous is not None:
+                step = previous + (interval or 0)
+            else:
+                step = 0
+        else:
+            continue
+
+        previous = step
+        yield step, data[line_end + 1:end], pos
+
+
+def _capacity(data, nsteps, interval, last_step):
+    #Preallocate from the input echo, grow if the log is longer than announced
+    if nsteps and interval and last_step is None:
+        return nsteps // interval + 2
+    return data.count(b'Q-atom energies') + 1
+
+
+def _grow(array, capacity, n):
+    fill = np.nan if array.dtype.kind == 'f' else 0
+    grown = np.full((capacity,) + array.shape[1:], fill, dtype=array.dtype)
+    grown[:n] = array[:n]
+    return grown
+
+
+def _parse_q_blocks(data, lambda_, nsteps=None, interval=None, last_step=None):
+    """
+    Scans a Qdyn log buffer for Q-atom energy blocks (see _q_blocks()).
+
+    Returns the step of every block, an (n_blocks, len(QCOLUMNS)) array where
+    terms at lambda_ that are missing in a block are NaN, and the offset in
+    data right after the last complete block.
+    """
+    lam = float(lambda_)
+
+    capacity = _capacity(data, nsteps, interval, last_step)
+    steps = np.zeros(capacity, dtype=np.int64)
+    energies = np.full((capacity, len(QCOLUMNS)), np.nan)
+
+    n = 0
+    pos = 0
+    for step, rows, pos in _q_blocks(data, nsteps, interval, last_step):
+        if n == capacity:
+            capacity *= 2
+            steps = _grow(steps, capacity, n)
+            energies = _grow(energies, capacity, n)
+
+        row = energies[n]
+        for line in rows.split(b'\n'):
+            if not line.startswith(b'Q-'):
+                continue
+            parts = line.split()
+            cols = QTYPE_SLICES.get(parts[0])
+            if cols is None or len(parts) < 3 + cols[1] - cols[0]:
+                continue
+            if float(parts[2]) != lam:
+                continue
+            row[cols[0]:cols[1]] = [float(x) for x in parts[3:3 + cols[1] - cols[0]]]
+
+        steps[n] = step
+        n += 1
+
+    return steps[:n], energies[:n], pos
+
+
+def _parse_state_blocks(data, nsteps=None, interval=None, last_step=None):
+    """
+    Like _parse_q_blocks(), but keeps the rows of every FEP state in one pass.
+
+    Returns (steps, states, end) where states maps (state, lambda) to an
+    (n_blocks, len(QCOLUMNS)) array; blocks before a state first appears
+    are NaN.
+    """
+    capacity = _capacity(data, nsteps, interval, last_step)
+    steps = np.zeros(capacity, dtype=np.int64)
+    by_label = {}
+
+    n = 0
+    pos = 0
+    for step, rows, pos in _q_blocks(data, nsteps, interval, last_step):
+        if n == capacity:
+            capacity *= 2
+            steps = _grow(steps, capacity, n)
+            by_label = {label: _grow(energies, capacity, n) for label, energies in by_label.items()}
+
+        for line in rows.split(b'\n'):
+            if not line.startswith(b'Q-'):
+                continue
+            parts = line.split()
+            cols = QTYPE_SLICES.get(parts[0])
+            if cols is None or len(parts) < 3 + cols[1] - cols[0]:
+                continue
+            #Labels are kept as printed and converted once per state at the end
+            label = (parts[1], parts[2])
+            energies = by_label.get(label)
+            if energies is None:
+                energies = by_label[label] = np.full((capacity, len(QCOLUMNS)), np.nan)
+            energies[n, cols[0]:cols[1]] = [float(x) for x in parts[3:3 + cols[1] - cols[0]]]
+
+        steps[n] = step
+        n += 1
+
+    states = {}
+    for (state, lam), energies in sorted(by_label.items(), key=lambda item: (int(item[0][0]), float(item[0][1]))):
+        states[(int(state), round(float(lam), 6))] = energies[:n]
+
+    return steps[:n], states, pos
+
+
+def _run_header(head):
+    """
+    Returns (nsteps, interval) from the input echo at the top of a log.
+    """
+    return (_header_int(head, b'Number of MD steps'),
+            _header_int(head, b'Energy summary print-out interval'))
+
+
+def read_q_energy_blocks(logfile, lambda_='1.00'):
+    """
+    Parses the Q-atom energy blocks of one Qdyn MD logfile in a single pass.
+
+    Returns (steps, energies): the MD step of every printed block and a
+    (n_blocks, len(QCOLUMNS)) array with the Q-Q, Q-prot, Q-wat, Q-surr. and
+    Q-any terms at lambda_. Terms that are not printed (e.g. Q-prot for a
+    ligand in water) are NaN.
+    """
+    with open(logfile, 'rb') as mdlog:
+        data = mdlog.read()
+
+    nsteps, interval = _run_header(data[:_HEAD_BYTES])
+    steps, energies, end = _parse_q_blocks(data, lambda_, nsteps, interval)
+
+    return steps, energies
+
+
+def read_q_energy_state_blocks(logfile):
+    """
+    Parses the Q-atom energy blocks of every FEP state of one Qdyn MD logfile
+    in a single pass. Returns (steps, states) with states mapping
+    (state, lambda) to an (n_blocks, len(QCOLUMNS)) array as
+    read_q_energy_blocks() returns for one lambda.
+    """
+    with open(logfile, 'rb') as mdlog:
+        data = mdlog.read()
+
+    nsteps, interval = _run_header(data[:_HEAD_BYTES])
+    steps, states, end = _parse_state_blocks(data, nsteps, interval)
+
+    return steps, states
+
+
+def read_run_info(logfile):
+    """
+    Length and cost of one Qdyn MD run from the input echo and the last
+    lines of its logfile. Returns a dict with nsteps, stepsize (fs),
+    interval (steps between Q-energy blocks), terminated, and wall_time,
+    the seconds of the main loop (None while the run is going).
+    """
+    with open(logfile, 'rb') as mdlog:
+        head = mdlog.read(_HEAD_BYTES)
+        mdlog.seek(max(0, os.fstat(mdlog.fileno()).st_size - _HEAD_BYTES))
+        tail = mdlog.read()
+
+    nsteps, interval = _run_header(head)
+    terminated = b'terminated normally' in tail
+    return {'nsteps': nsteps,
+            'stepsize': _header_int(head, b'Stepsize (fs)', float),
+            'interval': interval,
+            'terminated': terminated,
+            'wall_time': _header_int(tail, b'Total time of main loop', float, b':') if terminated else None}
+
+
+def find_energy_file(logfile):
+    """
+    Returns (path, interval) of the binary energy file (.en) written by the run
+    of an MD logfile, or (None, None) if it cannot be found.
+
+    The file name and write interval are taken from the input echo of the log.
+    Qdyn writes the .en file in the run directory, so it is looked up next to
+    the log and in up to two parent directories
+    (e.g. complex/complex_1/1/production1_1.log -> complex/prod1_complex_1.en).
+    """
+    with open(logfile, 'rb') as mdlog:
+        head = mdlog.read(_HEAD_BYTES)
+
+    interval = _header_int(head, b'Energy file write interval')
+    pos = head.find(b'Energy output file')
+    if pos == -1:
+        return None, None
+    name = head[head.find(b'=', pos) + 1:].split(None, 1)[0].decode()
+
+    directory = os.path.dirname(os.path.abspath(logfile))
+    for _ in range(3):
+        candidate = os.path.join(directory, name)
+        if os.path.isfile(candidate):
+            return os.path.relpath(candidate), interval
+        directory = os.path.dirname(directory)
+
+    return None, None
+
+
+class EnergyFile(str):
+    """
+    Path of a binary energy file (.en) that carries the `energy` write
+    interval of its run, needed to number the frames. Works as a plain path.
+    """
+
+    def __new__(cls, path, interval=None):
+        enfile = super().__new__(cls, path)
+        enfile.interval = interval
+        return enfile
+
+    def __reduce__(self):
+        return EnergyFile, (str(self), self.interval)
+
+
+def to_energy_files(logfiles):
+    """
+    Replaces every MD logfile by the binary energy file of its run, as an
+    EnergyFile with the write interval from the input echo of the log.
+    Logfiles whose energy file cannot be found are kept as they are.
+    """
+    files = []
+    for logfile in logfiles:
+        enfile, interval = find_energy_file(logfile)
+        if enfile is None:
+            print(f'No energy file found for {logfile}, using the log instead.')
+            files.append(logfile)
+        else:
+            files.append(EnergyFile(enfile, interval))
+
+    return files
+
+
+def _read_energy_file(filename):
+    """Frames of a .en file, numbered with its write interval when known."""
+    interval = getattr(filename, 'interval', None)
+    if interval:
+        return mden_energies.read_energy_file(filename, interval)
+
+    return mden_energies.read_energy_file(filename)
+
+
+def configure_cache(enabled=None, rebuild=None, directory=None, max_bytes=None):
+    """
+    Changes the settings of the parsed-energy cache.
+
+    enabled:   read and write cache entries at all
+    rebuild:   re-parse every file and overwrite its cache entry
+    directory: where the .npz entries are kept (default .mdlog_cache, or
+               $MDLOG_ENERGIES_CACHE)
+    max_bytes: total size of the cache; least recently used entries are
+               removed above it
+    """
+    for key, value in (('enabled', enabled), ('rebuild', rebuild),
+                       ('dir', directory), ('max_bytes', max_bytes)):
+        if value is not None:
+            CACHE[key] = value
+
+
+def add_cache_arguments(parser):
+    """
+    Adds the --no-cache and --rebuild-cache switches to an argparse parser.
+    """
+    parser.add_argument('--no-cache', dest='no_cache', action='store_true',
+                        help='Do not read or write the parsed-energy cache')
+    parser.add_argument('--rebuild-cache', dest='rebuild_cache', action='store_true',
+                        help='Re-parse all energy files and overwrite their cache entries')
+
+
+def configure_cache_from_args(args):
+    """
+    Applies the switches added by add_cache_arguments().
+    """
+    configure_cache(enabled=not args.no_cache, rebuild=args.rebuild_cache)
+
+
+def _cache_path(filename, lambda_):
+    """
+    Path of the cache entry of a file. The key changes whenever the file is
+    modified (size, mtime) or the parser changes. lambda_ None is the entry
+    of all states (read_q_energy_states()).
+    """
+    stat = os.stat(filename)
+    key = '%s|%d|%d|%d|%s' % (os.path.abspath(filename), stat.st_size, stat.st_mtime_ns,
+                              PARSER_VERSION, 'states' if lambda_ is None else float(lambda_))
+    #Frames of .en files are numbered with the write interval of the run
+    if getattr(filename, 'interval', None):
+        key += '|%d' % filename.interval
+    name = hashlib.sha1(key.encode()).hexdigest() + '.npz'
+
+    return os.path.join(CACHE['dir'], name)
+
+
+def _evict_cache():
+    """
+    Removes the least recently used entries until the cache fits in max_bytes.
+    Entries are touched on every hit, so their mtime is the last use.
+    """
+    try:
+        entries = [os.path.join(CACHE['dir'], name) for name in os.listdir(CACHE['dir'])
+                   if name.endswith('.npz')]
+        stats = [(os.stat(entry), entry) for entry in entries]
+    except OSError:
+        return
+
+    total = sum(stat.st_size for stat, entry in stats)
+    for stat, entry in sorted(stats, key=lambda item: item[0].st_mtime):
+        if total <= CACHE['max_bytes']:
+            break
+        try:
+            os.remove(entry)
+        except OSError:
+            continue
+        total -= stat.st_size
+
+
+def _save_entry(entry, **arrays):
+    """
+    Writes a cache entry under a temporary name first, so that concurrent
+    readers never see half an entry.
+    """
+    try:
+        os.makedirs(CACHE['dir'], exist_ok=True)
+        tmp = '%s.%d.tmp' % (entry, os.getpid())
+        with open(tmp, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp, entry)
+        _evict_cache()
+    except OSError:
+        pass
+
+
+def _resume_path(logfile, lambda_):
+    """
+    Path of the resume state of a log. Unlike _cache_path() the key does not
+    change while the log grows.
+    """
+    key = '%s|%d|%s' % (os.path.abspath(logfile), PARSER_VERSION, float(lambda_))
+    name = hashlib.sha1(key.encode()).hexdigest() + '.resume.npz'
+
+    return os.path.join(CACHE['dir'], name)
+
+
+def _load_resume(entry):
+    if entry in _RESUME:
+        return _RESUME[entry]
+    try:
+        with np.load(entry) as saved:
+            return {'fingerprint': str(saved['fingerprint']),
+                    'offset': int(saved['offset']),
+                    'steps': saved['steps'],
+                    'energies': saved['energies']}
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def tail_q_energies(logfile, lambda_='1.00', restart=False):
+    """
+    Parses only what was appended to an MD logfile since the previous call.
+
+    The resume state of every log (byte offset after the last complete
+    Q-energy block and the arrays parsed so far) is kept in memory and in
+    the cache directory, so a running simulation can be polled cheaply, also
+    from separate processes. The state is dropped when the log is replaced
+    (its first bytes change) or truncated, and once the run has terminated.
+
+    Returns (steps, energies, finished) with all blocks written so far.
+    """
+    entry = _resume_path(logfile, lambda_)
+    state = None if restart else _load_resume(entry)
+
+    with open(logfile, 'rb') as mdlog:
+        head = mdlog.read(_HEAD_BYTES)
+        fingerprint = hashlib.sha1(head[:_FINGERPRINT_BYTES]).hexdigest()
+        size = os.fstat(mdlog.fileno()).st_size
+
+        if state is None or state['fingerprint'] != fingerprint or state['offset'] > size:
+            state = {'fingerprint': fingerprint,
+                     'offset': 0,
+                     'steps': np.zeros(0, dtype=np.int64),
+                     'energies': np.zeros((0, len(QCOLUMNS)))}
+
+        mdlog.seek(state['offset'])
+        data = mdlog.read()
+
+    nsteps, interval = _run_header(head)
+    last_step = int(state['steps'][-1]) if len(state['steps']) else None
+    steps, energies, end = _parse_q_blocks(data, lambda_, nsteps, interval, last_step)
+
+    if len(steps):
+        state['steps'] = np.concatenate((state['steps'], steps))
+        state['energies'] = np.concatenate((state['energies'], energies))
+    state['offset'] += end
+
+    finished = b'terminated normally' in data[end:]
+    if finished:
+        _RESUME.pop(entry, None)
+        try:
+            os.remove(entry)
+        except OSError:
+            pass
+    elif CACHE['enabled']:
+        _RESUME[entry] = state
+        if len(steps) or not os.path.isfile(entry):
+            _save_entry(entry, fingerprint=np.array(state['fingerprint']),
+                        offset=np.array(state['offset']),
+                        steps=state['steps'], energies=state['energies'])
+
+    return state['steps'], state['energies'], finished
+
+
+def _parse_file(filename, lambda_):
+    if filename.endswith('.en'):
+        steps, states = _read_energy_file(filename)
+        return steps, mden_energies.to_q_columns(states, lambda_)
+
+    return read_q_energy_blocks(filename, lambda_)
+
+
+def read_q_energies(filename, lambda_='1.00'):
+    """
+    Returns (steps, energies) in the QCOLUMNS layout for an MD logfile or for a
+    Qdyn binary energy file (.en).
+
+    Parsed arrays are kept in the on-disk cache (see configure_cache()), so
+    reading an unchanged file again only loads a small .npz file. Logs of
+    runs that are still going are read with tail_q_energies(), so only the
+    new part of a growing log is parsed.
+    """
+    if not CACHE['enabled']:
+        return _parse_file(filename, lambda_)
+
+    entry = _cache_path(filename, lambda_)
+    if not CACHE['rebuild'] and os.path.isfile(entry):
+        try:
+            with np.load(entry) as cached:
+                steps, energies = cached['steps'], cached['energies']
+            os.utime(entry)
+            return steps, energies
+        except (OSError, ValueError, KeyError):
+            pass
+
+    if filename.endswith('.en'):
+        steps, energies = _parse_file(filename, lambda_)
+    else:
+        steps, energies, finished = tail_q_energies(filename, lambda_, restart=CACHE['rebuild'])
+        if not finished:
+            return steps, energies
+
+    _save_entry(entry, steps=steps, energies=energies)
+
+    return steps, energies
+
+
+def _parse_states(filename):
+    if filename.endswith('.en'):
+        steps, states = _read_energy_file(filename)
+        return steps, mden_energies.to_state_columns(states)
+
+    return read_q_energy_state_blocks(filename)
+
+
+def read_q_energy_states(filename):
+    """
+    Returns (steps, states) for an MD logfile or a Qdyn binary energy file
+    (.en), where states maps every (state, lambda) found in the file to an
+    array in the QCOLUMNS layout. The file is read once for all states, and
+    the result is kept in the on-disk cache like read_q_energies().
+    Logs of runs that have not terminated are parsed but not cached.
+    """
+    if not CACHE['enabled']:
+        return _parse_states(filename)
+
+    entry = _cache_path(filename, None)
+    if not CACHE['rebuild'] and os.path.isfile(entry):
+        try:
+            with np.load(entry) as cached:
+                steps = cached['steps']
+                states = {(int(state), float(lam)): energies
+                          for (state, lam), energies in zip(cached['keys'], cached['energies'])}
+            os.utime(entry)
+            return steps, states
+        except (OSError, ValueError, KeyError):
+            pass
+
+    steps, states = _parse_states(filename)
+    if not filename.endswith('.en'):
+        with open(filename, 'rb') as mdlog:
+            mdlog.seek(max(0, os.fstat(mdlog.fileno()).st_size - _HEAD_BYTES))
+            if b'terminated normally' not in mdlog.read():
+                return steps, states
+
+    keys = np.array(list(states), dtype=float).reshape(-1, 2)
+    energies = np.array(list(states.values())).reshape(len(keys), len(steps), len(QCOLUMNS))
+    _save_entry(entry, steps=steps, keys=keys, energies=energies)
+
+    return steps, states
+
+
+def default_workers():
+    """
+    Number of worker processes to use: the CPUs allocated to the SLURM job,
+    otherwise the CPUs this process may run on.
+    """
+    for variable in ('SLURM_CPUS_PER_TASK', 'SLURM_CPUS_ON_NODE'):
+        try:
+            return max(1, int(os.environ[variable]))
+        except (KeyError, ValueError):
+            continue
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def _init_worker(cache):
+    CACHE.update(cache)
+
+
+def _read_q_energies_or_empty(filename, lambda_):
+    if not os.path.isfile(filename):
+        return np.zeros(0, dtype=np.int64), np.zeros((0, len(QCOLUMNS)))
+
+    return read_q_energies(filename, lambda_)
+
+
+def _read_q_energy_states_or_empty(filename):
+    if not os.path.isfile(filename):
+        return np.zeros(0, dtype=np.int64), {}
+
+    return read_q_energy_states(filename)
+
+
+def _map_files(function, filenames, args, workers):
+    """
+    Calls function(filename, *args) for every file across a pool of worker
+    processes, keeping the order of filenames.
+    """
+    filenames = list(filenames)
+    if workers is None:
+        workers = default_workers()
+    workers = min(workers, len(filenames))
+
+    if workers <= 1:
+        return [function(filename, *args) for filename in filenames]
+
+    chunksize = max(1, len(filenames) // (4 * workers))
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(dict(CACHE),)) as pool:
+        return list(pool.map(function, filenames,
+                             *[[arg] * len(filenames) for arg in args], chunksize=chunksize))
+
+
+def read_q_energies_parallel(filenames, lambda_='1.00', workers=None):
+    """
+    Reads many MD logfiles or .en files across a pool of worker processes.
+
+    Returns a list with the (steps, energies) arrays of every file, in the
+    order of filenames; missing files give empty arrays. workers defaults to
+    default_workers(). The cache settings of this process are used by the
+    workers, so cached files are only loaded.
+    """
+    return _map_files(_read_q_energies_or_empty, filenames, (lambda_,), workers)
+
+
+def read_q_energy_states_parallel(filenames, workers=None):
+    """
+    Like read_q_energies_parallel(), but returns the (steps, states) of every
+    file with all its (state, lambda) pairs (see read_q_energy_states()).
+    """
+    return _map_files(_read_q_energy_states_or_empty, filenames, (), workers)
+
+
+def get_q_energies(logfiles=[], lambda_='1.00', error_method='blocks', equilibrate=False, state=None):
     """
     Collects Q-energies at defined lambda from MD logfiles.
+    Binary energy files (.en) are accepted in place of logfiles.
+    error_method selects the standard error estimator in ERROR_METHODS.
+    With equilibrate, the equilibration region of every file is discarded
+    first (see trim_equilibration()). With state, only the rows of that FEP
+    state at lambda_ are used (see read_q_energy_states()).
     """
 
     if len(logfiles) == 0:
         print('No MD logfiles specified! Aborting!')
         return
 
-    qq_el = []
-    qq_vdw = []
-    qp_el = []
-    qp_vdw = []
-    qw_el = []
-    qw_vdw = []
-    qs_el = []
-    qs_vdw = []
-
-    qany_el = []
-    qany_vdw = []
-    qany_bnd = []
-    qany_ang = []
-    qany_tor = []
-    qany_imp = []
-
-    qtypes = ['Q-Q', 'Q-prot', 'Q-wat', 'Q-surr.', 'Q-any']
-    qterms = [[qq_el, qq_vdw], [qp_el, qp_vdw], [qw_el, qw_vdw], [qs_el, qs_vdw],
-              [qany_el, qany_vdw, qany_bnd, qany_ang, qany_tor, qany_imp]]
-
-    #Go through logfiles and get Q energies:
-    for logfile in logfiles:
-        if os.path.isfile(logfile):
-            with open(logfile) as mdlog:
-                for line in mdlog:
-                    try:
-                        if line.split()[0] in qtypes:
-                            if float(line.split()[2]) == float(lambda_):
-                                #Decide qtype and get index:
-                                for qindex in range(len(qtypes)):
-                                    if qtypes[qindex] == line.split()[0]:
-                                        insert_index = 0
-                                        for eneterm in range(3, len(qterms[qindex]) + 3):
-                                            qterms[qindex][insert_index].append(float(line.split()[eneterm]))
-                                            insert_index += 1
-                    except:
-                        continue
-        else:
-            continue
+    logfiles = [logfile for logfile in logfiles if os.path.isfile(logfile)]
+    if state is None:
+        parsed = [read_q_energies(logfile, lambda_) for logfile in logfiles]
+    else:
+        parsed = [select_state(read_q_energy_states(logfile), state, lambda_) for logfile in logfiles]
+    if equilibrate:
+        blocks = trim_equilibration(parsed)[0]
+    else:
+        blocks = [energies for steps, energies in parsed]
 
-    #Check if qterms are missing and if, add zero:
-    for i in range(len(qterms)):
-        for j in range(len(qterms[i])):
-            if len(qterms[i][j]) == 0:
-                qterms[i][j].append(0)
-
-    qterms_ave = []
-    qterms_stderr = []
-    for interactions in range(len(qterms)):
-        tmp_ave = []
-        tmp_stderr = []
-        for energy_type in range(len(qterms[interactions])):
-            tmp_ave.append(np.average(qterms[interactions][energy_type]))
-            tmp_stderr.append(estimate_error(qterms[interactions][energy_type]))
-        qterms_ave.append(tmp_ave)
-        qterms_stderr.append(tmp_stderr)
+    return q_energy_statistics(blocks, error_method)
+
+
+def select_state(parsed_states, state, lambda_='1.00'):
+    """
+    (steps, energies) of one (state, lambda) of the result of
+    read_q_energy_states(); all NaN if the file does not have it.
+    """
+    steps, states = parsed_states
+    key = (int(state), round(float(lambda_), 6))
+    if key in states:
+        return steps, states[key]
+    return steps, np.full((len(steps), len(QCOLUMNS)), np.nan)
+
+
+def q_energy_statistics(blocks, error_method='blocks'):
+    """
+    Pools the parsed energies of one or more files (arrays in the QCOLUMNS
+    layout) and returns (qterms, qterms_ave, qterms_stderr) as get_q_energies().
+    """
+    if blocks:
+        energies = np.concatenate(blocks)
+    else:
+        energies = np.empty((0, len(QCOLUMNS)))
+
+    #Drop terms not printed in a block, and if a term is missing, add zero:
+    columns = []
+    for j in range(len(QCOLUMNS)):
+        column = energies[:, j]
+        column = column[~np.isnan(column)]
+        if len(column) == 0:
+            column = np.zeros(1)
+        columns.append(column)
+
+    #Estimate the errors of all terms with the same number of samples at once:
+    estimator = ERROR_METHODS[error_method]
+    stderr = [0.0] * len(columns)
+    by_length = {}
+    for j in range(len(columns)):
+        by_length.setdefault(len(columns[j]), []).append(j)
+    for indices in by_length.values():
+        errors = estimator(np.vstack([columns[j] for j in indices]))
+        for j, error in zip(indices, errors):
+            stderr[j] = error
+
+    ave = [np.average(column) for column in columns]
+
+    groups = [slice(0, 2), slice(2, 4), slice(4, 6), slice(6, 8), slice(8, 14)]
+    qterms = [columns[group] for group in groups]
+    qterms_ave = [ave[group] for group in groups]
+    qterms_stderr = [stderr[group] for group in groups]
 
     return qterms, qterms_ave, qterms_stderr
 
 
+#Block counts averaged by estimate_error()
+_ERROR_BLOCKS = range(5, 11)
+
+
 def estimate_error(enelist):
     """
     Estimetaes the standard error of a sample by computing the statistical inefficiency
+
+    The statistical inefficiency s is the average over dividing the sample in
+    5 - 10 blocks of t * var(block averages) / var(sample). Block averages for
+    all block counts come from one cumulative sum of the deviations from the
+    mean. enelist can be 1-D, or 2-D (terms x samples, runs x samples) to get
+    the standard error of every row in one call.
     """
+    x = np.asarray(enelist, dtype=float)
+    if x.ndim == 1:
+        return estimate_error(x[np.newaxis, :])[0]
+
+    t_max = x.shape[-1]
+    ave_tot = np.mean(x, axis=-1)
+
+    #Block boundaries for every block count, the last block takes the remainder
+    starts = []
+    ends = []
+    sizes = []
+    for b in _ERROR_BLOCKS:
+        t = int(t_max / float(b))
+        starts.extend(i * t for i in range(b))
+        ends.extend((i + 1) * t for i in range(b - 1))
+        ends.append(t_max)
+        sizes.append(t)
+    starts = np.array(starts)
+    ends = np.array(ends)
+    first_block = np.cumsum([0] + list(_ERROR_BLOCKS)[:-1])
 
-    if np.average(enelist) == 0:
-        return 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dev = np.zeros(x.shape[:-1] + (t_max + 1,))
+        np.cumsum(x - ave_tot[..., np.newaxis], axis=-1, out=dev[..., 1:])
 
-    var_tot = (np.std(enelist)) ** 2
-    ave_tot = np.average(enelist)
-    s_list = list()
+        #Deviation of every block average from the sample average
+        block_dev = (dev[..., ends] - dev[..., starts]) / (ends - starts)
+        bloc_var = np.add.reduceat(block_dev ** 2, first_block, axis=-1) / np.array(_ERROR_BLOCKS)
 
-    t_max = len(enelist)
+        var_tot = np.mean((x - ave_tot[..., np.newaxis]) ** 2, axis=-1)
+        s_list = np.array(sizes) * (bloc_var / var_tot[..., np.newaxis])
+        s_b = np.mean(s_list, axis=-1)
 
-    #Estimate s as average of dividing sample in blocks of 4 - 10
-    for b in range(5, 11):
+        se = np.sqrt(var_tot) / np.sqrt(t_max / s_b)
 
+    se[ave_tot == 0] = 0
 
-        blocks = list()
+    return se
 
-        #Find block size
-        t = int(t_max / float(b))
 
-        for i in range(b):
-            if i < b - 1:
+def autocorrelation_time(enelist, c=5.0):
+    """
+    Integrated autocorrelation time (in samples) of a sample, or of every row
+    of a 2-D array.
+
+    The autocorrelation function is computed with FFT in O(n log n) and summed
+    up to the self-consistent window M >= c * tau (Sokal). tau is not allowed
+    below 1, so anti-correlated series are treated as uncorrelated.
+    """
+    x = np.asarray(enelist, dtype=float)
+    if x.ndim == 1:
+        return autocorrelation_time(x[np.newaxis, :], c)[0]
 
-                blocks.append(enelist[i * t: (i + 1) * t])
+    n = x.shape[-1]
+    if n < 2:
+        return np.ones(x.shape[:-1])
 
-            elif i == b - 1:
-                blocks.append(enelist[i * t:])
+    #Zero padding to 2n avoids the circular wrap-around of the FFT
+    size = 1 << (2 * n - 1).bit_length()
+    dev = x - np.mean(x, axis=-1, keepdims=True)
+    spectrum = np.fft.rfft(dev, n=size, axis=-1)
+    acov = np.fft.irfft(spectrum * np.conjugate(spectrum), n=size, axis=-1)[..., :n]
 
-        block_ave = list()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rho = acov / acov[..., :1]
+    taus = 2 * np.cumsum(rho, axis=-1) - 1
 
-        for j in blocks:
-            block_ave.append(np.average(j))
+    window = np.arange(n) >= c * taus
+    m = np.where(window.any(axis=-1), window.argmax(axis=-1), n - 1)
+    tau = np.take_along_axis(taus, m[..., np.newaxis], axis=-1)[..., 0]
 
-        #bloc_var = (np.std(block_ave)) ** 2
-        bloc_var = 0
-        for ave in block_ave:
-            bloc_var += (ave - ave_tot) ** 2
+    #Constant series have no autocorrelation
+    tau[~np.isfinite(tau)] = 1
 
-        bloc_var *= (1.0 / len(block_ave))
+    return np.maximum(tau, 1)
 
-        s = float(t) * (bloc_var / var_tot)
 
-        s_list.append(s)
+def effective_sample_size(enelist):
+    """
+    Number of statistically independent samples, n / tau, of a sample or of
+    every row of a 2-D array.
+    """
+    x = np.asarray(enelist, dtype=float)
 
-    s_b = np.average(s_list)
+    return x.shape[-1] / autocorrelation_time(x)
 
-    se = np.std(enelist) / np.sqrt(len(enelist) / s_b)
 
-    return se
+def estimate_error_acf(enelist):
+    """
+    Estimates the standard error of a sample from its integrated
+    autocorrelation time, std / sqrt(n_eff). Accepts 2-D input like
+    estimate_error().
+    """
+    x = np.asarray(enelist, dtype=float)
+
+    return np.std(x, axis=-1) / np.sqrt(effective_sample_size(x))
+
+
+#Error estimators selectable by name in get_q_energies() and the analysis scripts
+ERROR_METHODS = {'blocks': estimate_error,
+                 'acf': estimate_error_acf}
+
+
+#Columns the LIE averages depend on (Q-prot and Q-wat el/vdW), used to place the equilibration cut
+_EQUILIBRATION_COLUMNS = slice(2, 6)
+
+
+def detect_equilibration(enelist, max_discard=0.5, block_size=None):
+    """
+    Detects the start of the equilibrated part of a sample, or of every row
+    of a 2-D array: the discard point t0 that maximizes the effective number
+    of samples (n - t0) / g(t0) of x[t0:].
+
+    The statistical inefficiency g(t0) = b * var(block averages) / var(x[t0:])
+    uses blocks of b samples aligned to the end of the sample, twice the
+    autocorrelation time of the whole sample unless block_size is given.
+    Means and variances of every candidate suffix come from prefix sums, so
+    all candidates (block boundaries up to max_discard of the sample) are
+    evaluated at once. Returns (t0, g, n_eff).
+    """
+    x = np.asarray(enelist, dtype=float)
+    if x.ndim == 1:
+        t0, g, n_eff = detect_equilibration(x[np.newaxis, :], max_discard, block_size)
+        return t0[0], g[0], n_eff[0]
+
+    rows, n = x.shape
+    b = block_size or (int(np.ceil(2 * np.max(autocorrelation_time(x)))) if n > 1 else 1)
+    nblocks = n // b
+    if nblocks < 4:
+        return np.zeros(rows, dtype=int), np.ones(rows), np.full(rows, float(n))
+
+    #Centering keeps the prefix sums of squares well conditioned
+    x = x - np.mean(x, axis=-1, keepdims=True)
+    offset = n - nblocks * b
+    block_ave = np.mean(x[:, offset:].reshape(rows, nblocks, b), axis=-1)
+
+    #Suffixes that start at every block boundary (the first one at t0 = 0)
+    starts = offset + b * np.arange(nblocks)
+    starts[0] = 0
+    m = nblocks - np.arange(nblocks)
+    s1 = np.cumsum(block_ave[:, ::-1], axis=-1)[:, ::-1]
+    s2 = np.cumsum(block_ave[:, ::-1] ** 2, axis=-1)[:, ::-1]
+
+    csum = np.concatenate([np.zeros((rows, 1)), np.cumsum(x, axis=-1)], axis=-1)
+    csum2 = np.concatenate([np.zeros((rows, 1)), np.cumsum(x ** 2, axis=-1)], axis=-1)
+    count = n - starts
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        var_blocks = (s2 - s1 ** 2 / m) / (m - 1)
+        mean = (csum[:, -1:] - csum[:, starts]) / count
+        var = (csum2[:, -1:] - csum2[:, starts]) / count - mean ** 2
+        g = np.where(var > 0, b * var_blocks / var, 1.0)
+    g = np.maximum(np.nan_to_num(g, nan=1.0), 1.0)
+    n_eff = count / g
+
+    #Keep enough blocks for the variance and do not discard most of the run
+    allowed = (m >= 4) & (starts <= max_discard * n)
+    n_eff = np.where(allowed, n_eff, -np.inf)
+    best = np.argmax(n_eff, axis=-1)
+    pick = np.arange(rows)
+
+    return starts[best], g[pick, best], n_eff[pick, best]
+
+
+def equilibration_cut(energies, max_discard=0.5):
+    """
+    Discard point of one run (array in the QCOLUMNS layout): the latest of
+    the equilibration starts of the Q-prot and Q-wat el/vdW energies printed
+    in every sample.
+    """
+    columns = np.asarray(energies, dtype=float)[:, _EQUILIBRATION_COLUMNS].T
+    columns = columns[~np.any(np.isnan(columns), axis=-1)]
+    if len(columns) == 0 or columns.shape[-1] < 2:
+        return 0
+    t0, g, n_eff = detect_equilibration(columns, max_discard)
+    return int(np.max(t0))
+
+
+def trim_equilibration(parsed, max_discard=0.5):
+    """
+    Removes the equilibration region from every (steps, energies) pair, as
+    returned by read_q_energies(). Returns (blocks, cut_steps): the trimmed
+    energies and the first step kept of every run.
+    """
+    blocks = []
+    cut_steps = []
+    for steps, energies in parsed:
+        t0 = equilibration_cut(energies, max_discard) if len(steps) else 0
+        blocks.append(energies[t0:])
+        cut_steps.append(int(steps[t0]) if len(steps) else 0)
+    return blocks, cut_steps
@@ -0,0 +1,443 @@
+#!/usr/bin/env python3
+"""
+Live monitor of the Q-surr. energy errors of running Qdyn jobs.
+
+check_high_errors.py tells whether a run meets the 1 kcal/mol criterion
+only once it is over. This script keeps running next to the jobs: it
+watches the complex/ and ligands/ trees (inotify where the kernel provides
+it, otherwise polling the size and mtime of the logs), parses only the
+Q-energy blocks appended to a log since its previous update
+(mdlog_energies.tail_q_energies) and keeps the electrostatic and vdW
+errors of every run in memory.
+
+With the default half-trajectory error, every run keeps cumulative sums of
+its Q-surr. energies, so an update costs the new blocks only, whatever the
+length of the run; the status row of the run is replaced in place. Only
+logs laid out as runs (replica/*.log or pose#/replica/*.log inside a
+ligand_# or complex_# folder) are read: events of equilibration logs,
+restart and trajectory files are ignored, and only the ligand of a new
+pose or replica folder is searched for new runs. The updated runs are
+printed as a table after every round, and the status of all runs is
+written to a JSON snapshot at most every --snapshot_interval seconds
+(replaced atomically, so it can be read at any time; only the rows of the
+updated runs are serialized again).
+
+inotify only sees writes made on the node the monitor runs on; on shared
+cluster filesystems the logs are also swept every --interval seconds,
+and --poll disables inotify altogether.
+
+Usage:
+    python monitor_LIE_runs.py --systems ligand complex --interval 60
+    python monitor_LIE_runs.py --manifest results/ligands_manifest.csv --once
+"""
+
+import argparse
+import ctypes
+import ctypes.util
+import json
+import os
+import select
+import struct
+import time
+
+import numpy as np
+
+import check_high_errors
+import energy_store
+import mdlog_energies as mdle
+
+STATUS_COLUMNS = ('ligand', 'system', 'pose', 'replica', 'segment', 'step', 'nsteps', 'fraction',
+                  'samples', 'error_el', 'error_vdw', 'high_error', 'finished')
+
+#inotify events of a log being written, created or moved in, or of a new folder
+_IN_MODIFY = 0x002
+_IN_CLOSE_WRITE = 0x008
+_IN_MOVED_TO = 0x080
+_IN_CREATE = 0x100
+_IN_ISDIR = 0x40000000
+_IN_EVENT = struct.Struct('iIII')
+
+
+class InotifyWatcher:
+    """
+    Folders watched with the Linux inotify API (through libc, no extra
+    package). Raises OSError where inotify is not available.
+    """
+
+    def __init__(self, bases):
+        libc_name = ctypes.util.find_library('c')
+        if not libc_name:
+            raise OSError("libc not found")
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise OSError("inotify not available")
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.folders = {}
+        for base in bases:
+            for path, dirs, files in os.walk(base):
+                self.add(path)
+
+    def add(self, path):
+        mask = _IN_MODIFY | _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_CREATE
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd >= 0:
+            self.folders[wd] = path
+
+    def wait(self, timeout):
+        """
+        Paths of the logs written and of the folders created within timeout
+        seconds (empty sets if none).
+        """
+        changed, folders = set(), set()
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return changed, folders
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return changed, folders
+
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = _IN_EVENT.unpack_from(data, offset)
+            offset += _IN_EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            if wd not in self.folders:
+                continue
+            path = os.path.join(self.folders[wd], name)
+            if mask & _IN_ISDIR:
+                if not mask & (_IN_CREATE | _IN_MOVED_TO):
+                    continue
+                #New ligand, pose or replica folder: watch it and its subfolders too
+                for folder, dirs, files in os.walk(path):
+                    self.add(folder)
+                    folders.add(folder)
+                    changed.update(os.path.join(folder, f) for f in files if f.endswith('.log'))
+            elif name.endswith('.log'):
+                changed.add(path)
+        return changed, folders
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollWatcher:
+    """Fallback watcher: sleeps, the sweep of the logs finds the changes."""
+
+    def wait(self, timeout):
+        time.sleep(timeout)
+        return set(), set()
+
+    def close(self):
+        pass
+
+
+class LiveRun:
+    """
+    Q-surr. energies of one log and its errors, updated with the blocks
+    appended since the previous update.
+    """
+
+    def __init__(self, run):
+        self.run = run
+        self.path = run['path']
+        self.signature = None
+        self.nsteps = None
+        self.reset()
+
+    def reset(self):
+        self.blocks = 0
+        self.step = 0
+        self.finished = False
+        self.samples = 0
+        self.qsurr = np.zeros((0, 2))
+        #Cumulative sums of the el and vdW energies, row i holds the sum of the first i samples
+        self.sums = np.zeros((1, 2))
+
+    def _append(self, qsurr):
+        n = self.samples + len(qsurr)
+        if n + 1 > len(self.sums):
+            capacity = max(n + 1, 2 * len(self.sums))
+            self.sums = np.resize(self.sums, (capacity, 2))
+            self.qsurr = np.resize(self.qsurr, (capacity, 2))
+        self.qsurr[self.samples:n] = qsurr
+        self.sums[self.samples + 1:n + 1] = self.sums[self.samples] + np.cumsum(qsurr, axis=0)
+        self.samples = n
+
+    def update(self):
+        """
+        Reads the blocks appended to the log. Returns False when the log did
+        not change since the previous update.
+        """
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return False
+        signature = (stat.st_size, stat.st_mtime_ns)
+        if signature == self.signature:
+            return False
+        restart = self.finished
+        self.signature = signature
+
+        steps, energies, finished = mdle.tail_q_energies(self.path, restart=restart)
+        #A replaced or truncated log is parsed again from its start
+        if restart or len(steps) < self.blocks or (self.blocks and steps[self.blocks - 1] != self.step):
+            self.reset()
+        qsurr = energies[self.blocks:, 6:8]
+        self._append(qsurr[~np.isnan(qsurr).any(axis=1)])
+        self.blocks = len(steps)
+        self.step = int(steps[-1]) if len(steps) else 0
+        self.finished = finished
+        if self.nsteps is None:
+            self.nsteps = mdle.read_run_info(self.path)['nsteps']
+        return True
+
+    def errors(self, error_method="halves"):
+        """Electrostatic and vdW errors of the energies read so far (NaN before 2 samples)."""
+        n = self.samples
+        if n < 2:
+            return np.nan, np.nan
+        if error_method == "halves":
+            #Half the difference of the mean energies of the two halves, from the cumulative sums
+            half = n // 2
+            first = self.sums[half] / half
+            second = (self.sums[n] - self.sums[half]) / (n - half)
+            error_el, error_vdw = np.abs(second - first) / 2
+            return error_el, error_vdw
+        error_vdw, error_el = check_high_errors.ERROR_METHODS[error_method](self.qsurr[:n, 0], self.qsurr[:n, 1])
+        return error_el, error_vdw
+
+    def status(self, error_method="halves", threshold=1.0):
+        """Status row of the run (STATUS_COLUMNS and path)."""
+        error_el, error_vdw = self.errors(error_method)
+        fraction = 1.0 if self.finished else min(self.step / self.nsteps, 1.0) if self.nsteps else 0.0
+        row = {key: self.run[key] for key in ('ligand', 'system', 'pose', 'replica', 'segment', 'path')}
+        row.update({'step': self.step, 'nsteps': self.nsteps, 'fraction': round(fraction, 3),
+                    'samples': self.samples,
+                    'error_el': None if np.isnan(error_el) else round(float(error_el), 4),
+                    'error_vdw': None if np.isnan(error_vdw) else round(float(error_vdw), 4),
+                    'high_error': bool(error_el > threshold or error_vdw > threshold),
+                    'finished': self.finished})
+        return row
+
+
+class Monitor:
+    """
+    Live runs of the watched trees with their status rows and counts, both
+    updated in place, run by run. ligands() lists the (ligand id, ligand
+    folder, complex folder) of the campaign.
+    """
+
+    def __init__(self, ligands, systems=("ligand", "complex"), error_method="halves", threshold=1.0):
+        self.ligands = ligands
+        self.systems = systems
+        self.error_method = error_method
+        self.threshold = threshold
+        self.folders = {}
+        self.runs = {}
+        self.rows = {}
+        #Status rows already serialized for the snapshot, replaced when the run is updated
+        self.lines = {}
+        self.ignored = set()
+        self.counts = {'runs': 0, 'running': 0, 'finished': 0, 'high_error': 0}
+
+    def _count(self, row, sign):
+        self.counts['runs'] += sign
+        self.counts['finished' if row['finished'] else 'running'] += sign
+        self.counts['high_error'] += sign * row['high_error']
+
+    def refresh_ligands(self):
+        """Lists the ligand and complex folders of every ligand again."""
+        self.folders = {}
+        for ligand_id, ligand_dir, complex_dir in self.ligands():
+            for system, folder in zip(energy_store.SYSTEMS, (ligand_dir, complex_dir)):
+                self.folders[os.path.abspath(folder)] = (ligand_id, system, ligand_dir, complex_dir)
+
+    def locate(self, path):
+        """
+        Ligand folder entry of path and the number of levels of path below
+        the ligand or complex folder, or None outside of them.
+        """
+        folder = os.path.abspath(path)
+        for depth in range(4):
+            if folder in self.folders:
+                return self.folders[folder], depth
+            folder = os.path.dirname(folder)
+        return None
+
+    def add_ligand_runs(self, entry):
+        """Searches the runs of one ligand and adds the new ones."""
+        ligand_id, system, ligand_dir, complex_dir = entry
+        for run in energy_store.discover_runs(ligand_id, ligand_dir, complex_dir):
+            path = os.path.normpath(run['path'])
+            if run['system'] in self.systems and path not in self.runs:
+                self.runs[path] = LiveRun(run)
+                self.ignored.discard(path)
+
+    def add_runs(self):
+        """Searches the runs of every ligand and adds the new ones."""
+        self.refresh_ligands()
+        entries = {entry[0]: entry for entry in self.folders.values()}
+        for entry in entries.values():
+            self.add_ligand_runs(entry)
+
+    def add_folder(self, folder):
+        """Adds the runs of a new ligand, pose or replica folder."""
+        located = self.locate(folder)
+        if located is None:
+            #A new ligand_# or complex_# folder
+            self.refresh_ligands()
+            located = self.locate(folder)
+        if located is not None and located[1] <= 2 and located[0][1] in self.systems:
+            self.add_ligand_runs(located[0])
+
+    def is_run_log(self, path):
+        """Whether path is laid out as the log of a run: replica/*.log or pose#/replica/*.log."""
+        if not path.endswith('.log') or path in self.ignored:
+            return False
+        located = self.locate(path)
+        return located is not None and located[1] in (2, 3) and located[0][1] in self.systems
+
+    def update(self, path):
+        """Reads the new blocks of one log and replaces its status row. Returns whether it changed."""
+        path = os.path.normpath(path)
+        if path not in self.runs:
+            if not self.is_run_log(path):
+                return False
+            #A log of a folder created before it was watched
+            self.add_ligand_runs(self.locate(path)[0])
+            if path not in self.runs:
+                self.ignored.add(path)
+                return False
+        live = self.runs[path]
+        if not live.update():
+            return False
+        old = self.rows.get(path)
+        if old is not None:
+            self._count(old, -1)
+        row = live.status(self.error_method, self.threshold)
+        self._count(row, +1)
+        self.rows[path] = row
+        self.lines[path] = json.dumps(row)
+        return True
+
+    def sweep(self):
+        """Finds new runs and updates every log whose size or mtime changed. Returns the updated paths."""
+        self.add_runs()
+        return [path for path in self.runs if self.update(path)]
+
+    def snapshot(self):
+        """Status JSON of all runs, from the serialized rows."""
+        header = json.dumps({'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'error_method': self.error_method,
+                             'threshold': self.threshold, 'counts': self.counts})
+        return header[:-1] + ', "runs": [\n' + ',\n'.join(self.lines.values()) + '\n]}\n'
+
+
+def write_snapshot(snapshot, output):
+    """Writes the status JSON through a temporary file, so readers never see it half written."""
+    tmp = output + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(snapshot)
+    os.replace(tmp, output)
+
+
+def print_table(monitor, updated):
+    """Prints the updated runs and the counts of all runs."""
+    print(f"{time.strftime('%H:%M:%S')}  runs: {monitor.counts['runs']}  running: {monitor.counts['running']}  "
+          f"finished: {monitor.counts['finished']}  error > {monitor.threshold:g}: {monitor.counts['high_error']}")
+    for path in updated:
+        row = monitor.rows[path]
+        error_el = '-' if row['error_el'] is None else f"{row['error_el']:.2f}"
+        error_vdw = '-' if row['error_vdw'] is None else f"{row['error_vdw']:.2f}"
+        state = 'done' if row['finished'] else f"{row['fraction']:.0%}"
+        flag = '  HIGH' if row['high_error'] else ''
+        print(f"  {row['ligand']:>12} {row['system']:>7} pose {row['pose']} rep {row['replica']} "
+              f"seg {row['segment']}  {state:>5}  el {error_el:>6}  vdW {error_vdw:>6}{flag}")
+
+
+def main(args):
+    if args.manifest:
+        ligands = lambda: [(entry["id"], entry["ligand_dir"], entry["complex_dir"])
+                           for entry in energy_store.read_manifest(args.manifest)]
+        bases = set()
+        for ligand_id, ligand_dir, complex_dir in ligands():
+            bases.update(os.path.dirname(os.path.normpath(folder)) or '.' for folder in (ligand_dir, complex_dir))
+    else:
+        ligands = lambda: check_high_errors.scan_ligands(args.ligand_base, args.complex_base)
+        bases = {args.ligand_base, args.complex_base}
+    bases = sorted(base for base in bases if os.path.isdir(base))
+
+    monitor = Monitor(ligands, args.systems, args.error_method, args.threshold)
+    watcher = PollWatcher()
+    if not args.poll and not args.once:
+        try:
+            watcher = InotifyWatcher(bases)
+        except OSError as error:
+            print(f"inotify not available ({error}), polling every {args.interval:g} s")
+
+    updated = monitor.sweep()
+    last_sweep = time.monotonic()
+    last_write = None
+    pending = True
+    try:
+        while True:
+            if updated:
+                print_table(monitor, updated)
+                pending = True
+            done = args.once or (args.exit_when_done and monitor.counts['runs'] and not monitor.counts['running'])
+            if pending and (done or last_write is None or time.monotonic() - last_write >= args.snapshot_interval):
+                write_snapshot(monitor.snapshot(), args.output)
+                last_write = time.monotonic()
+                pending = False
+            if done:
+                break
+            #Changes seen by inotify are read at once, the sweep catches everything else
+            wait = max(0.0, args.interval - (time.monotonic() - last_sweep))
+            if pending:
+                wait = min(wait, max(0.0, args.snapshot_interval - (time.monotonic() - last_write)))
+            changed, folders = watcher.wait(min(wait, args.latency) if isinstance(watcher, InotifyWatcher) else wait)
+            for folder in sorted(folders):
+                monitor.add_folder(folder)
+            updated = [path for path in changed if monitor.update(path)]
+            if time.monotonic() - last_sweep >= args.interval:
+                updated = list(dict.fromkeys(updated + monitor.sweep()))
+                last_sweep = time.monotonic()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+    if pending:
+        write_snapshot(monitor.snapshot(), args.output)
+
+    print(f"Status of {monitor.counts['runs']} runs saved to {args.output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Live Q-surr. energy errors of running Qdyn jobs")
+    parser.add_argument("--manifest", default=None,
+                        help="CSV with columns id,ligand_dir,complex_dir (default: scan --ligand_base and --complex_base)")
+    parser.add_argument("--ligand_base", default="ligands", help="Folder with the ligand_# folders to watch")
+    parser.add_argument("--complex_base", default="complex", help="Folder with the complex_# folders to watch")
+    parser.add_argument("--systems", nargs="+", choices=["ligand", "complex"], default=["ligand", "complex"],
+                        help="Systems whose runs are monitored")
+    parser.add_argument("--error_method", choices=sorted(check_high_errors.ERROR_METHODS), default="halves",
+                        help="Error estimate: half-trajectory difference (constant time per update) or "
+                             "FFT autocorrelation standard error (recomputed on every update)")
+    parser.add_argument("--threshold", type=float, default=1.0, help="Error (kcal/mol) above which a run is flagged")
+    parser.add_argument("--interval", type=float, default=60, help="Seconds between sweeps of all logs")
+    parser.add_argument("--latency", type=float, default=2, help="Seconds between reads of the inotify events")
+    parser.add_argument("--poll", action="store_true", help="Do not use inotify, only sweep every --interval")
+    parser.add_argument("--once", action="store_true", help="Sweep once, write the status and exit")
+    parser.add_argument("--exit_when_done", action="store_true", help="Exit when all monitored runs have finished")
+    parser.add_argument("--output", default="LIE_live_status.json", help="JSON snapshot of the status of all runs")
+    parser.add_argument("--snapshot_interval", type=float, default=10,
+                        help="Minimum seconds between writes of the JSON snapshot")
+
+    mdle.add_cache_arguments(parser)
+
+    args = parser.parse_args()
+    mdle.configure_cache_from_args(args)
+    main(args)
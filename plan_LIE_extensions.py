@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+"""
+Plans which production runs to extend within a CPU-hour budget.
+
+check_high_errors.py flags every run above 1 kcal/mol; this script instead
+estimates, for every replica of every pose and ligand of the manifest, how
+much one more production segment would reduce the uncertainty that matters
+and what it would cost, and fills the budget with the most useful
+extensions first.
+
+For every replica run the ΔG contribution series (β ΔV_el + α ΔV_vdW terms
+of that run) gives a per-sample variance σ² and an integrated
+autocorrelation time τ, so the variance of the pooled pose mean is
+
+    Σ_r n_r σ_r² τ_r / (Σ_r n_r)²    (complex and ligand in water added)
+
+and adding k samples to run r has a closed-form effect on it. Poses are
+combined into the ligand ΔG with Boltzmann weights (lie_engine.aggregate_poses).
+The cost of a segment is taken from the main-loop time of the finished logs.
+Extensions are picked greedily by gain per CPU-hour, where the gain is the
+decrease of
+
+    ranking    the expected number of ligand pairs in the wrong order,
+               Σ Φ(-|ΔG_i - ΔG_j| / sqrt(σ_i² + σ_j²)), or
+    variance   the summed ΔG variance of the ligands.
+
+Usage:
+    python plan_LIE_extensions.py --manifest results/ligands_manifest.csv --cpu_hours 500 --alpha 0.68 --beta 0.11
+"""
+
+import argparse
+import csv
+
+import numpy as np
+from scipy.special import ndtr
+
+import analyze_LIE_noqgui as lie
+import energy_store
+import lie_engine
+import mdlog_energies as mdle
+
+OBJECTIVES = ('ranking', 'variance')
+PLAN_COLUMNS = ('job', 'ligand', 'pose', 'system', 'replica', 'extension', 'log', 'steps', 'ns', 'cpu_hours',
+                'cumulative_cpu_hours', 'dG', 'dG_stderr_before', 'dG_stderr_after', 'stderr_reduction_per_ns')
+
+
+def replica_units(entries, alpha, beta, workers=None, equilibrate=False):
+    """
+    One dict per replica run of every pose of the manifest entries, with its
+    index (ligand, pose, system, replica), last log, number of samples n,
+    mean and per-sample variance times autocorrelation time (a = σ² τ) of
+    its ΔG contribution, and the length and cost of its last segment.
+    """
+    runs = []
+    for entry in entries:
+        runs.extend(energy_store.discover_runs(entry['id'], entry['ligand_dir'], entry['complex_dir']))
+    parsed = mdle.read_q_energies_parallel([run['path'] for run in runs], workers=workers)
+
+    replicas = {}
+    for run, (steps, energies) in zip(runs, parsed):
+        key = (run['ligand'], run['pose'], run['system'], run['replica'])
+        replicas.setdefault(key, []).append((run, steps, energies))
+
+    keys = list(replicas)
+    joined = []
+    for key in keys:
+        segments = sorted(replicas[key], key=lambda segment: segment[0]['segment'])
+        replicas[key] = segments
+        joined.append((np.concatenate([steps for run, steps, energies in segments]),
+                       np.concatenate([energies for run, steps, energies in segments])))
+    energies, cuts = lie.trim_energies(joined, equilibrate)
+
+    #ΔG contribution of every term: the complex adds, the ligand in water subtracts
+    coefficients = np.array([beta, alpha, beta, alpha])
+    units = []
+    for key, ene in zip(keys, energies):
+        ligand, pose, system, replica = key
+        series = lie_engine.terms_from_energies(ene) @ coefficients * (1.0 if system == 'complex' else -1.0)
+        series = series[~np.isnan(ene[:, 4])]
+        if len(series) < 2:
+            print(f"{ligand} pose {pose} {system} replica {replica}: too few Q-energies, skipped.")
+            continue
+
+        infos = [mdle.read_run_info(run['path']) for run, steps, ene in replicas[key]]
+        last = infos[-1]
+        timed = [info for info in infos if info['wall_time'] and info['nsteps']]
+        units.append({'ligand': ligand, 'pose': pose, 'system': system, 'replica': replica,
+                      'log': replicas[key][-1][0]['path'],
+                      'n': len(series), 'mean': np.mean(series),
+                      'a': np.var(series, ddof=1) * mdle.autocorrelation_time(series),
+                      'nsteps': last['nsteps'], 'stepsize': last['stepsize'] or 1.0, 'interval': last['interval'],
+                      'seconds_per_step': (sum(info['wall_time'] for info in timed) /
+                                           sum(info['nsteps'] for info in timed)) if timed else None})
+    return units
+
+
+def unit_arrays(units, chunk_ns=None, cores=1):
+    """
+    Samples and CPU-hours of one extension of every unit. Without chunk_ns an
+    extension repeats the last segment of the run. Runs without a finished
+    timed segment take the median cost per step of their system.
+    """
+    steps = np.array([unit['nsteps'] if chunk_ns is None else round(chunk_ns * 1e6 / unit['stepsize'])
+                      for unit in units], dtype=float)
+    samples = np.floor(steps / np.array([unit['interval'] for unit in units], dtype=float))
+
+    seconds = np.array([unit['seconds_per_step'] or np.nan for unit in units], dtype=float)
+    for system in energy_store.SYSTEMS:
+        same = np.array([unit['system'] == system for unit in units])
+        missing = same & np.isnan(seconds)
+        if np.any(missing):
+            if np.all(np.isnan(seconds[same])):
+                raise ValueError(f"No finished {system} run to estimate the cost of an extension from")
+            seconds[missing] = np.nanmedian(seconds[same])
+    cpu_hours = steps * seconds * cores / 3600.0
+    return steps, samples, cpu_hours
+
+
+def objective_gain(dg, var, ligand, new_var, objective):
+    """
+    Decrease of the objective when the ΔG variance of ligand[r] becomes
+    new_var[r], for every candidate r at once.
+    """
+    if objective == 'variance':
+        return var[ligand] - new_var
+
+    d = np.abs(dg[ligand][:, np.newaxis] - dg[np.newaxis, :])
+    other = np.arange(len(dg))[np.newaxis, :] != ligand[:, np.newaxis]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        before = ndtr(-d / np.sqrt(var[ligand][:, np.newaxis] + var[np.newaxis, :]))
+        after = ndtr(-d / np.sqrt(new_var[:, np.newaxis] + var[np.newaxis, :]))
+    return np.sum(np.where(other, np.nan_to_num(before - after), 0.0), axis=1)
+
+
+def plan_extensions(units, budget, gamma=0.0, chunk_ns=None, cores=1, max_extensions=3,
+                    objective='ranking', temperature=lie_engine.TEMPERATURE):
+    """
+    Greedy allocation of extension segments to units within budget CPU-hours.
+    Returns (jobs, ligands, dg, stderr_before, stderr_after), with jobs as
+    dicts in the order they were picked.
+    """
+    ligands = list(dict.fromkeys(unit['ligand'] for unit in units))
+    poses = sorted({unit['pose'] for unit in units})
+    groups = list(dict.fromkeys((unit['ligand'], unit['pose'], unit['system']) for unit in units))
+
+    group = np.array([groups.index((unit['ligand'], unit['pose'], unit['system'])) for unit in units])
+    ligand = np.array([ligands.index(unit['ligand']) for unit in units])
+    pose = np.array([poses.index(unit['pose']) for unit in units])
+    n = np.array([unit['n'] for unit in units], dtype=float)
+    a = np.array([unit['a'] for unit in units])
+    mean = np.array([unit['mean'] for unit in units])
+    steps, samples, cpu_hours = unit_arrays(units, chunk_ns, cores)
+
+    #Pose ΔG from the pooled means of both systems; poses missing one system are NaN
+    dg = np.full((len(ligands), len(poses)), float(gamma))
+    has_system = np.zeros((len(energy_store.SYSTEMS),) + dg.shape, dtype=bool)
+    for g, (lig, p, system) in enumerate(groups):
+        k, i = ligands.index(lig), poses.index(p)
+        members = group == g
+        dg[k, i] += np.sum(n[members] * mean[members]) / np.sum(n[members])
+        has_system[energy_store.SYSTEMS.index(system), k, i] = True
+    has_both = np.all(has_system, axis=0)
+    dg[~has_both] = np.nan
+
+    #Pose probabilities are kept fixed: extending a run only shrinks variances
+    aggregate = lie_engine.aggregate_poses(dg, temperature=temperature, axis=1)
+    probability = np.nan_to_num(aggregate['probability'])
+    ligand_dg = aggregate['dg_boltzmann']
+    group_ligand = np.array([ligands.index(lig) for lig, p, s in groups])
+    group_pose = np.array([poses.index(p) for lig, p, s in groups])
+    weight = probability[group_ligand, group_pose] ** 2
+    weight[~has_both[group_ligand, group_pose]] = 0.0
+
+    def ligand_variance(n):
+        group_n = np.bincount(group, weights=n, minlength=len(groups))
+        group_var = np.bincount(group, weights=n * a, minlength=len(groups)) / group_n ** 2
+        return np.bincount(group_ligand, weights=weight * group_var, minlength=len(ligands)), group_n, group_var
+
+    var, group_n, group_var = ligand_variance(n)
+    stderr_before = np.sqrt(var)
+    extensions = np.zeros(len(units), dtype=int)
+    feasible = has_both[ligand, pose] & (samples > 0)
+    spent = 0.0
+    jobs = []
+    while True:
+        candidates = feasible & (extensions < max_extensions) & (spent + cpu_hours <= budget)
+        if not np.any(candidates):
+            break
+        #Variance of the pose group of every candidate with its extension added
+        new_group_var = ((group_var[group] * group_n[group] ** 2 + samples * a) /
+                         (group_n[group] + samples) ** 2)
+        new_var = var[ligand] - weight[group] * (group_var[group] - new_group_var)
+        gain = objective_gain(ligand_dg, var, ligand, new_var, objective) / cpu_hours
+        gain[~candidates] = -np.inf
+        r = int(np.argmax(gain))
+        if gain[r] <= 0:
+            break
+
+        before = np.sqrt(var[ligand[r]])
+        n[r] += samples[r]
+        extensions[r] += 1
+        spent += cpu_hours[r]
+        var, group_n, group_var = ligand_variance(n)
+        unit = units[r]
+        jobs.append({'job': len(jobs) + 1, 'ligand': unit['ligand'], 'pose': unit['pose'], 'system': unit['system'],
+                     'replica': unit['replica'], 'extension': int(extensions[r]),
+                     'log': unit['log'], 'steps': int(steps[r]), 'ns': steps[r] * unit['stepsize'] * 1e-6,
+                     'cpu_hours': cpu_hours[r], 'cumulative_cpu_hours': spent, 'dG': ligand_dg[ligand[r]],
+                     'dG_stderr_before': before, 'dG_stderr_after': np.sqrt(var[ligand[r]])})
+        jobs[-1]['stderr_reduction_per_ns'] = ((jobs[-1]['dG_stderr_before'] - jobs[-1]['dG_stderr_after']) /
+                                               jobs[-1]['ns'])
+
+    return jobs, ligands, ligand_dg, stderr_before, np.sqrt(var)
+
+
+def main(args):
+    entries = lie.read_manifest(args.manifest)
+    units = replica_units(entries, args.alpha, args.beta, args.workers, args.equilibrate)
+    if not units:
+        print("No production runs with Q-energies found.")
+        return
+
+    jobs, ligands, dg, stderr_before, stderr_after = plan_extensions(
+        units, args.cpu_hours, args.gamma, args.chunk_ns, args.cores, args.max_extensions,
+        args.objective, args.temperature)
+
+    with open(args.output, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(PLAN_COLUMNS)
+        for job in jobs:
+            writer.writerow([round(job[name], 4) if isinstance(job[name], float) else job[name]
+                             for name in PLAN_COLUMNS])
+
+    for k, ligand in enumerate(ligands):
+        print(f"{ligand}: ΔG = {dg[k]:.2f} kcal/mol, error {stderr_before[k]:.2f} -> {stderr_after[k]:.2f} "
+              f"with {sum(job['ligand'] == ligand for job in jobs)} extensions")
+    spent = jobs[-1]['cumulative_cpu_hours'] if jobs else 0.0
+    print(f"{len(jobs)} extension jobs ({spent:.1f} of {args.cpu_hours:g} CPU-hours) saved to {args.output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Prioritized LIE production extensions within a CPU-hour budget")
+    parser.add_argument("--manifest", required=True,
+                        help="CSV with columns id,ligand_dir,complex_dir (as for analyze_LIE_noqgui.py)")
+    parser.add_argument("--cpu_hours", type=float, required=True, help="CPU-hour budget of the extensions")
+    parser.add_argument("--alpha", type=float, default=0.18, help="Alpha parameter")
+    parser.add_argument("--beta", type=float, default=0.50, help="Beta parameter")
+    parser.add_argument("--gamma", type=float, default=0.00, help="Gamma parameter")
+    parser.add_argument("--objective", choices=OBJECTIVES, default="ranking",
+                        help="Reduce the expected number of mis-ranked ligand pairs, or the summed ΔG variance")
+    parser.add_argument("--chunk_ns", type=float, default=None,
+                        help="Length of one extension (default: the length of the last segment of the run)")
+    parser.add_argument("--max_extensions", type=int, default=3, help="Extensions of one run at most")
+    parser.add_argument("--cores", type=int, default=1, help="CPUs of one production job (--cpus-per-task)")
+    parser.add_argument("--temperature", type=float, default=lie_engine.TEMPERATURE,
+                        help="Temperature (K) of the Boltzmann weights of the poses")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="Worker processes to read logs (default: CPUs allocated by SLURM)")
+    parser.add_argument("--equilibrate", action="store_true",
+                        help="Discard the equilibration region of every run before estimating variances")
+    parser.add_argument("--output", default="LIE_extension_plan.csv", help="CSV with the prioritized extension jobs")
+
+    mdle.add_cache_arguments(parser)
+
+    args = parser.parse_args()
+    mdle.configure_cache_from_args(args)
+    main(args)
@@ -34,7 +34,8 @@ ligand name.
 Usage:
 ------
 - Ensure all input CSV files are placed in the 'results' directory and follow the naming 
-  convention 'LIE_result_#.csv', where # can be any number.
+  convention 'LIE_result_#.csv', where # can be any number. If the consolidated table
+  'results/LIE_results.csv' (analyze_LIE_noqgui.py --manifest) exists, it is read instead.
 - Each CSV file must contain at least the following columns: 'ligand_name', 'dG_calc', 'stderr'.
 - Run the script in an environment with pandas, matplotlib, numpy, and glob installed.
 - The resulting plot is saved as 'results/LIE_dG_comparison_publication.png' with 300 dpi resolution.
@@ -64,8 +65,12 @@ def ligand_num(ligand_name):
     m = re.search(r'ligand_(\d+)', ligand_name)
     return int(m.group(1)) if m else 9999
 
-# Read all LIE result CSV files
-results_df = read_results('results/LIE_result_*.csv')
+# Read the consolidated table written by analyze_LIE_noqgui.py --manifest,
+# or all per-ligand LIE result CSV files
+if os.path.isfile('results/LIE_results.csv'):
+    results_df = read_results('results/LIE_results.csv')
+else:
+    results_df = read_results('results/LIE_result_*.csv')
 
 # Define reference ligands based on ligand_name (e.g. ligand_1, ligand_2, ligand_3)
 reference_ligands = {'ligand_1', 'ligand_2', 'ligand_3'}